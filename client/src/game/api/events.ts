@@ -19,21 +19,27 @@ import { layerManager } from "@/game/layers/manager";
 import { addFloor } from "@/game/layers/utils";
 import { gameManager } from "@/game/manager";
 import { Note, ServerFloor } from "@/game/models/general";
+import { ServerShape } from "@/game/models/shapes";
 import { gameStore } from "@/game/store";
 import { router } from "@/router";
 
 import { coreStore } from "../../core/store";
-import { floorStore } from "../layers/store";
+import { Layer } from "../layers/layer";
+import { floorStore, getFloorId } from "../layers/store";
 import { Location } from "../models/settings";
 import { deleteShapes } from "../shapes/utils";
 import { visibilityStore } from "../visibility/store";
 
+// The journal version of the location that this client is synchronized to,
+// which allows a reconnect to only receive the changes that were missed in the meantime.
+let syncVersion: { journal: string; location: number; version: number } | undefined;
+
 // Core WS events
 
 socket.on("connect", () => {
     console.log("Connected");
     gameStore.setConnected(true);
-    socket.emit("Location.Load");
+    socket.emit("Location.Load", gameStore.isBoardInitialized ? syncVersion : undefined);
     coreStore.setLoading(true);
 });
 socket.on("disconnect", (reason: string) => {
@@ -59,6 +65,7 @@ socket.on("redirect", (destination: string) => {
 // Bootup events
 
 socket.on("Board.Locations.Set", (locationInfo: Location[]) => {
+    syncVersion = undefined;
     gameStore.clear();
     visibilityStore.clear();
     gameStore.setLocations({ locations: locationInfo, sync: false });
@@ -84,6 +91,47 @@ socket.on("Board.Floor.Set", (floor: ServerFloor) => {
     }
 });
 
+socket.on("Board.Shapes.Stream", (data: { shapes: ServerShape[]; indices: number[] }) => {
+    const layers = new Set<Layer>();
+    const visionFloors = new Set<number>();
+    const movementFloors = new Set<number>();
+    for (const [i, shape] of data.shapes.entries()) {
+        const floorId = getFloorId(shape.floor);
+        const layer = layerManager.getLayer(layerManager.getFloor(floorId)!, shape.layer);
+        if (layer === undefined) continue;
+        layer.insertServerShape(shape, data.indices[i]);
+        layers.add(layer);
+        if (shape.vision_obstruction) visionFloors.add(floorId);
+        if (shape.movement_obstruction) movementFloors.add(floorId);
+    }
+    for (const floorId of visionFloors) visibilityStore.recalculateVision(floorId);
+    for (const floorId of movementFloors) visibilityStore.recalculateMovement(floorId);
+    for (const layer of layers) layer.invalidate(false);
+});
+
+socket.on("Location.Version.Set", (data: { journal: string; location: number; version: number }) => {
+    syncVersion = data;
+});
+
+socket.on("Location.Resync", (data: { shapes: ServerShape[]; removed: string[] }) => {
+    // We use ! on the get here even though to silence the typechecker as we filter undefineds later.
+    const removed = data.removed.map((s) => layerManager.UUIDMap.get(s)!).filter((s) => s !== undefined);
+    deleteShapes(removed, SyncMode.NO_SYNC);
+    for (const shape of data.shapes) {
+        const old = layerManager.UUIDMap.get(shape.uuid);
+        let index = -1;
+        if (old) {
+            index = old.layer.getShapes({ skipUiHelpers: false, includeComposites: false }).indexOf(old);
+            old.layer.removeShape(old, SyncMode.NO_SYNC, true);
+        }
+        const sh = gameManager.addShape(shape, SyncMode.NO_SYNC);
+        // Keep the updated shape at the same depth
+        if (sh !== undefined && index >= 0 && sh.layer === old!.layer)
+            sh.layer.moveShapeOrder(sh, index, SyncMode.NO_SYNC);
+    }
+    coreStore.setLoading(false);
+});
+
 // Varia
 
 socket.on("Position.Set", (data: { floor?: string; x: number; y: number; zoom?: number }) => {
@@ -42,6 +42,10 @@ export class Layer {
     points: Map<string, Set<string>> = new Map();
     postDrawCallbacks: (() => void)[] = [];
 
+    // The position of the shapes in the server's order of this layer, when the layer is loaded progressively.
+    // Shapes that arrive later are inserted according to this position.
+    private loadOrder: Map<string, number> = new Map();
+
     constructor(canvas: HTMLCanvasElement, public name: string, public floor: number, public index: number) {
         this.canvas = canvas;
         this.ctx = canvas.getContext("2d")!;
@@ -158,10 +162,11 @@ export class Layer {
         }
     }
 
-    setServerShapes(shapes: ServerShape[]): void {
+    setServerShapes(shapes: ServerShape[], indices?: number[]): void {
         // We need to ensure composites are added after all their variants have been added
         const composites = [];
-        for (const serverShape of shapes) {
+        for (const [i, serverShape] of shapes.entries()) {
+            if (indices !== undefined) this.loadOrder.set(serverShape.uuid, indices[i]);
             if (serverShape.type_ === "togglecomposite") {
                 composites.push(serverShape);
             } else {
@@ -172,13 +177,37 @@ export class Layer {
         this.clearSelection(); // TODO: Fix keeping selection on those items that are not moved.
     }
 
-    private setServerShape(serverShape: ServerShape): void {
+    private setServerShape(serverShape: ServerShape): Shape | undefined {
         const shape = createShapeFromDict(serverShape);
         if (shape === undefined) {
             console.log(`Shape with unknown type ${serverShape.type_} could not be added`);
             return;
         }
         this.addShape(shape, SyncMode.NO_SYNC, InvalidationMode.NO);
+        return shape;
+    }
+
+    /**
+     * Adds a shape of a progressively loaded layer at its position in the server's order of this layer.
+     * Shapes without a known position were created after the layer was loaded and stay on top.
+     */
+    insertServerShape(serverShape: ServerShape, index: number): void {
+        const shape = this.setServerShape(serverShape);
+        if (shape === undefined) return;
+        this.loadOrder.set(shape.uuid, index);
+
+        // The positions of the shapes are increasing, so the first shape with a higher position can be searched for
+        let low = 0;
+        let high = this.shapes.length - 1;
+        while (low < high) {
+            const mid = Math.floor((low + high) / 2);
+            if ((this.loadOrder.get(this.shapes[mid].uuid) ?? Infinity) > index) high = mid;
+            else low = mid + 1;
+        }
+        if (low < this.shapes.length - 1) {
+            this.shapes.pop();
+            this.shapes.splice(low, 0, shape);
+        }
     }
 
     removeShape(shape: Shape, sync: SyncMode, recalculate: boolean): boolean {
@@ -106,7 +106,7 @@ function createLayer(layerInfo: ServerLayer, floor: Floor): void {
     }
 
     // Load layer shapes
-    layer.setServerShapes(layerInfo.shapes);
+    layer.setServerShapes(layerInfo.shapes, layerInfo.indices);
 }
 
 export async function dropAsset(
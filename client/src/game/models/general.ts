@@ -40,6 +40,8 @@ export interface ServerLayer {
     layer: string;
     groups: ServerGroup[];
     shapes: ServerShape[];
+    // Position of the shapes in the complete layer, when only part of the shapes is sent
+    indices?: number[];
     selectable: boolean;
     player_editable: boolean;
     player_visible: boolean;
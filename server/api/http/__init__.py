@@ -1,17 +1,22 @@
+from typing import Optional, Tuple
+
 from aiohttp import web
 from aiohttp_security import check_authorized
 
+import api.http.assets
 import api.http.auth
 import api.http.notifications
 import api.http.rooms
+import api.http.static
 import api.http.users
 import api.http.version
 
 from api.socket.constants import GAME_NS
 from app import sio
 from models import PlayerRoom, Room
+from models.db import run_db, use_room
 from models.role import Role
-from state.game import game_state
+from state.game import get_campaign_user_room
 
 import urllib.parse
 
@@ -19,12 +24,17 @@ import urllib.parse
 async def claim_invite(request):
     user = await check_authorized(request)
     data = await request.json()
-    room = Room.get_or_none(invitation_code=data["code"])
-    if room is None:
-        return web.HTTPNotFound()
-    else:
-        if user != room.creator and not PlayerRoom.get_or_none(player=user, room=room):
-            query = PlayerRoom.select().where(PlayerRoom.room == room)
+
+    def claim() -> Tuple[Optional[Room], bool]:
+        room = Room.get_or_none(invitation_code=data["code"])
+        if room is None:
+            return None, False
+        # Used for the session url and the socket.io room name
+        room.creator
+        if user == room.creator or PlayerRoom.get_or_none(player=user, room=room):
+            return room, False
+        query = PlayerRoom.select().where(PlayerRoom.room == room)
+        with use_room(room.id):
             try:
                 loc = query.where(PlayerRoom.role == Role.PLAYER)[0].active_location
             except IndexError:
@@ -32,14 +42,19 @@ async def claim_invite(request):
             PlayerRoom.create(
                 player=user, room=room, role=Role.PLAYER, active_location=loc
             )
+        return room, True
 
-            for csid in game_state.get_sids(player=room.creator, room=room):
-                await sio.emit(
-                    "Room.Info.Players.Add",
-                    {"id": user.id, "name": user.name},
-                    room=csid,
-                    namespace=GAME_NS,
-                )
+    room, joined = await run_db(claim)
+    if room is None:
+        return web.HTTPNotFound()
+    else:
+        if joined:
+            await sio.emit(
+                "Room.Info.Players.Add",
+                {"id": user.id, "name": user.name},
+                room=get_campaign_user_room(room, room.creator),
+                namespace=GAME_NS,
+            )
         return web.json_response(
             {
                 "sessionUrl": f"/game/{urllib.parse.quote(room.creator.name, safe='')}/{urllib.parse.quote(room.name, safe='')}"
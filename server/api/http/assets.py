@@ -0,0 +1,118 @@
+import asyncio
+import io
+from typing import List, Optional
+
+from aiohttp import web
+from aiohttp_security import check_authorized
+
+from api.http.static import file_response
+from api.socket.asset_manager import AssetDict, export_asset, store
+from api.socket.asset_manager.archive import get_codec
+from api.socket.asset_manager.variants import VARIANTS, get_variant
+from models import Asset, User
+from models.db import run_db
+from paa import write_archive
+from utils import logger
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ResponseWriter(io.RawIOBase):
+    """
+    Synchronous file object that writes to a streaming response from a worker thread.
+
+    Every write waits until the response accepted the data, so a slow client slows down the writer
+    instead of the data piling up in memory.
+    """
+
+    def __init__(
+        self, response: web.StreamResponse, loop: asyncio.AbstractEventLoop
+    ) -> None:
+        super().__init__()
+        self.response = response
+        self.loop = loop
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        asyncio.run_coroutine_threadsafe(
+            self.response.write(bytes(data)), self.loop
+        ).result()
+        return len(data)
+
+
+async def get_file(request: web.Request):
+    """
+    Serves an asset file from the content store under its original flat url (static/assets/<hash>).
+    """
+    file_hash = request.match_info["file_hash"]
+    path = store.get_path(file_hash)
+    if not path.is_file():
+        return web.HTTPNotFound()
+    return file_response(request, path, etag=file_hash, immutable=True)
+
+
+async def get_file_variant(request: web.Request):
+    """
+    Serves a downscaled variant (e.g. a thumbnail) of an asset file.
+    """
+    variant = request.match_info["variant"]
+    if variant not in VARIANTS:
+        return web.HTTPNotFound()
+    file_hash = request.match_info["file_hash"]
+    path = await get_variant(file_hash, variant)
+    if path is None:
+        return web.HTTPNotFound()
+    return file_response(request, path, etag=f"{variant}-{file_hash}", immutable=True)
+
+
+async def export(request: web.Request):
+    user: User = await check_authorized(request)
+
+    try:
+        selection = [int(asset) for asset in request.query["selection"].split(",")]
+    except (KeyError, ValueError):
+        return web.HTTPBadRequest()
+
+    def get_selection() -> Optional[List[AssetDict]]:
+        assets = [Asset.get_or_none(id=asset) for asset in selection]
+        if any(asset is None or asset.owner_id != user.id for asset in assets):
+            return None
+        return [asset.as_dict(True, True) for asset in assets]
+
+    full_selection = await run_db(get_selection)
+    if full_selection is None:
+        return web.HTTPForbidden()
+
+    asset_data = export_asset(full_selection)
+    files = [
+        (file_hash, str(store.get_path(file_hash)))
+        for file_hash in asset_data["file_hashes"]
+    ]
+    codec = get_codec(request.query.get("codec"))
+
+    response = web.StreamResponse(
+        headers={
+            "Content-Type": "application/octet-stream",
+            "Content-Disposition": 'attachment; filename="assets.paa"',
+        }
+    )
+    await response.prepare(request)
+
+    loop = asyncio.get_event_loop()
+
+    def write():
+        with io.BufferedWriter(
+            ResponseWriter(response, loop), buffer_size=CHUNK_SIZE
+        ) as writer:
+            write_archive(writer, asset_data["data"], files, codec)  # type: ignore
+
+    try:
+        await loop.run_in_executor(None, write)
+    except ConnectionResetError:
+        logger.info(f"Asset export of {user.name} was cancelled by the client")
+        return response
+
+    await response.write_eof()
+    return response
@@ -2,7 +2,7 @@ from aiohttp import web
 from aiohttp_security import authorized_userid, forget, remember
 
 from models import User
-from models.db import db
+from models.db import db, run_db
 from models.user import UserOptions
 
 
@@ -24,7 +24,7 @@ async def login(request):
     data = await request.json()
     username = data["username"]
     password = data["password"]
-    u = User.by_name(username)
+    u = await run_db(User.by_name, username)
     if u is None or not u.check_password(password):
         return web.HTTPUnauthorized(reason="Username and/or Password do not match")
     response = web.json_response({"email": u.email})
@@ -41,14 +41,15 @@ async def register(request):
     username = data["username"]
     password = data["password"]
     email = data.get("email", None)
-    if User.by_name(username):
+    if await run_db(User.by_name, username):
         return web.HTTPConflict(reason="Username already taken")
     elif not username:
         return web.HTTPBadRequest(reason="Please provide a username")
     elif not password:
         return web.HTTPBadRequest(reason="Please provide a password")
     else:
-        try:
+
+        def create_user():
             with db.atomic():
                 u = User(name=username)
                 u.set_password(password)
@@ -58,6 +59,9 @@ async def register(request):
                 default_options.save()
                 u.default_options = default_options
                 u.save()
+
+        try:
+            await run_db(create_user)
         except:
             return web.HTTPServerError(
                 reason="An unexpected error occured on the server during account creation.  Operation reverted."
@@ -1,10 +1,12 @@
 import uuid
+from typing import Dict, List
 
 from aiohttp import web
 
 from app import sio
 from api.socket.constants import GAME_NS
 from models import Notification
+from models.db import run_db
 
 
 async def create(request: web.Request) -> web.Response:
@@ -12,8 +14,9 @@ async def create(request: web.Request) -> web.Response:
     message = data.get("message", None)
     if message:
         try:
-            notification = Notification.create(uuid=uuid.uuid4(), message=message)
-            notification.save()
+            notification = await run_db(
+                Notification.create, uuid=uuid.uuid4(), message=message
+            )
             await sio.emit(
                 "Notification.Show",
                 {"uuid": str(notification.uuid), "message": notification.message},
@@ -27,22 +30,24 @@ async def create(request: web.Request) -> web.Response:
 
 
 async def collect(request: web.Request) -> web.Response:
-    notifications = [
-        {"uuid": str(n.uuid), "message": n.message} for n in Notification.select()
-    ]
-    return web.json_response(notifications)
+    def get_notifications() -> List[Dict[str, str]]:
+        return [
+            {"uuid": str(n.uuid), "message": n.message} for n in Notification.select()
+        ]
+
+    return web.json_response(await run_db(get_notifications))
 
 
 async def delete(request: web.Request) -> web.Response:
     uuid = request.match_info.get("uuid", None)
     if uuid:
         try:
-            notification = Notification.get_by_id(uuid)
+            notification = await run_db(Notification.get_by_id, uuid)
         except Notification.DoesNotExist:
             return web.HTTPNotFound(
                 reason="Notification with given uuid was not found."
             )
-        notification.delete_instance()
+        await run_db(notification.delete_instance)
         return web.HTTPOk(text=f"Removed notification with id {notification.uuid}")
     else:
         return web.HTTPBadRequest(reason="Missing uuid.")
@@ -1,17 +1,19 @@
+from typing import Any, Dict, List
+
 from aiohttp import web
 from aiohttp.web_exceptions import HTTPUnauthorized
 from aiohttp_security import check_authorized
 
 from models import Location, LocationOptions, PlayerRoom, Room, User
-from models.db import db
+from models.db import db, run_db, use_room
 from models.role import Role
 
 
 async def get_list(request: web.Request):
     user: User = await check_authorized(request)
 
-    return web.json_response(
-        {
+    def get_rooms() -> Dict[str, List[Dict[str, Any]]]:
+        return {
             "owned": [
                 r.as_dashboard_dict() for r in user.rooms_created.select().join(User)
             ],
@@ -23,7 +25,8 @@ async def get_list(request: web.Request):
                 .where(Room.creator != user)
             ],
         }
-    )
+
+    return web.json_response(await run_db(get_rooms))
 
 
 async def get_info(request: web.Request):
@@ -32,12 +35,13 @@ async def get_info(request: web.Request):
     creator = request.match_info["creator"]
     roomname = request.match_info["roomname"]
 
-    room = (
+    room: List[PlayerRoom] = await run_db(
+        list,
         PlayerRoom.select()
         .join(Room)
         .join(User)
         .filter(player=user)
-        .where((User.name == creator) & (Room.name == roomname))
+        .where((User.name == creator) & (Room.name == roomname)),
     )
 
     if len(room) != 1:
@@ -61,12 +65,13 @@ async def set_info(request: web.Request):
 
     data = await request.json()
 
-    rooms = (
+    rooms: List[PlayerRoom] = await run_db(
+        list,
         PlayerRoom.select()
         .join(Room)
         .join(User)
         .filter(player=user)
-        .where((User.name == creator) & (Room.name == roomname))
+        .where((User.name == creator) & (Room.name == roomname)),
     )
 
     if len(rooms) != 1:
@@ -76,7 +81,7 @@ async def set_info(request: web.Request):
 
     if "notes" in data:
         room.notes = data["notes"]
-    room.save()
+    await run_db(room.save)
 
     return web.HTTPOk()
 
@@ -90,24 +95,38 @@ async def create(request: web.Request):
         return web.HTTPBadRequest()
     else:
 
-        if Room.get_or_none(name=roomname, creator=user):
+        def create_room() -> bool:
+            if Room.get_or_none(name=roomname, creator=user):
+                return False
+
+            with db.atomic():
+                default_options = LocationOptions.create()
+                room = Room.create(
+                    name=roomname,
+                    creator=user,
+                    default_options=default_options,
+                )
+
+                if logo >= 0:
+                    room.logo_id = logo
+                    room.save()
+
+            # The room has to exist before its own database can be used
+            try:
+                with use_room(room.id), db.atomic():
+                    loc = Location.create(room=room, name="start", index=1)
+                    loc.create_floor()
+                    PlayerRoom.create(
+                        player=user, room=room, role=Role.DM, active_location=loc
+                    )
+            except Exception:
+                with use_room(room.id):
+                    room.delete_instance(True)
+                raise
+            return True
+
+        if not await run_db(create_room):
             return web.HTTPConflict()
-
-        with db.atomic():
-            default_options = LocationOptions.create()
-            room = Room.create(
-                name=roomname,
-                creator=user,
-                default_options=default_options,
-            )
-
-            if logo >= 0:
-                room.logo_id = logo
-
-            loc = Location.create(room=room, name="start", index=1)
-            loc.create_floor()
-            PlayerRoom.create(player=user, room=room, role=Role.DM, active_location=loc)
-            room.save()
         return web.HTTPOk()
 
 
@@ -127,18 +146,23 @@ async def patch(request: web.Request):
     if not any([new_name, new_logo]):
         return web.HTTPBadRequest()
 
-    room = Room.get_or_none(name=roomname, creator=user)
-    if room is None:
-        return web.HTTPBadRequest()
+    def update_room() -> bool:
+        room = Room.get_or_none(name=roomname, creator=user)
+        if room is None:
+            return False
 
-    if new_name:
-        if Room.filter(name=new_name, creator=user).count() > 0:
-            return web.HTTPBadRequest()
+        if new_name:
+            if Room.filter(name=new_name, creator=user).count() > 0:
+                return False
 
-        room.name = new_name
+            room.name = new_name
 
-    if new_logo:
-        room.logo_id = new_logo
+        if new_logo:
+            room.logo_id = new_logo
 
-    room.save()
+        room.save()
+        return True
+
+    if not await run_db(update_room):
+        return web.HTTPBadRequest()
     return web.HTTPOk()
@@ -0,0 +1,66 @@
+"""
+Serving of static files with caching headers and precompressed variants.
+
+Files whose content never changes for a given url (content addressed assets and hashed client bundles)
+are marked as immutable, so browsers do not even revalidate them.
+Other files have to be revalidated, which is cheap thanks to their Last-Modified header.
+
+When the client accepts it, a precompressed `.br` or `.gz` file next to the requested file is served instead.
+"""
+
+import mimetypes
+import re
+from pathlib import Path
+from typing import Optional
+
+from aiohttp import web
+
+from utils import FILE_DIR
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+STATIC_DIR = (FILE_DIR / "static").resolve()
+
+# The client build appends a content hash to the names of its bundles (e.g. app.1a2b3c4d.js)
+HASHED_NAME = re.compile(r"\.[0-9a-f]{8,}\.[a-z0-9]+$")
+
+# Content-Encoding -> file extension, in order of preference
+PRECOMPRESSED = (("br", ".br"), ("gzip", ".gz"))
+
+
+def file_response(
+    request: web.Request, path: Path, etag: Optional[str] = None, immutable=False
+) -> web.StreamResponse:
+    headers = {"Cache-Control": IMMUTABLE if immutable else REVALIDATE}
+    if etag is not None:
+        etag = f'"{etag}"'
+        headers["ETag"] = etag
+        if etag in request.headers.get("If-None-Match", ""):
+            return web.HTTPNotModified(headers=headers)
+
+    content_type, _ = mimetypes.guess_type(path.name)
+    accept_encoding = request.headers.get("Accept-Encoding", "")
+    for encoding, extension in PRECOMPRESSED:
+        compressed = path.with_name(path.name + extension)
+        if encoding in accept_encoding and compressed.is_file():
+            headers["Content-Encoding"] = encoding
+            headers["Vary"] = "Accept-Encoding"
+            headers["Content-Type"] = content_type or "application/octet-stream"
+            path = compressed
+            break
+
+    return web.FileResponse(path, headers=headers)
+
+
+async def get_static(request: web.Request):
+    try:
+        path = (STATIC_DIR / request.match_info["path"]).resolve()
+        path.relative_to(STATIC_DIR)
+    except ValueError:
+        return web.HTTPForbidden()
+    if not path.is_file():
+        return web.HTTPNotFound()
+    return file_response(
+        request, path, immutable=HASHED_NAME.search(path.name) is not None
+    )
@@ -2,13 +2,14 @@ from aiohttp import web
 from aiohttp_security import check_authorized, forget
 
 from models import User
+from models.db import run_db
 
 
 async def set_email(request: web.Request):
     user: User = await check_authorized(request)
     data = await request.json()
     user.email = data["email"]
-    user.save()
+    await run_db(user.save)
     return web.HTTPOk()
 
 
@@ -16,13 +17,13 @@ async def set_password(request: web.Request):
     user: User = await check_authorized(request)
     data = await request.json()
     user.set_password(data["password"])
-    user.save()
+    await run_db(user.save)
     return web.HTTPOk()
 
 
 async def delete_account(request: web.Request):
     user: User = await check_authorized(request)
-    user.delete_instance(recursive=True)
+    await run_db(user.delete_instance, recursive=True)
     response = web.HTTPOk()
     await forget(request, response)
     return response
@@ -6,7 +6,7 @@ import auth
 from api.socket.constants import GAME_NS
 from app import app, sio
 from models import Floor, Layer, LocationUserOption, PlayerRoom
-from models.db import db
+from models.db import db, run_db
 from models.user import UserOptions
 from state.game import game_state
 
@@ -47,9 +47,11 @@ class ClientOptions(TypedDict, total=False):
 async def set_client_default_options(sid: str, data: ClientOptions):
     pr: PlayerRoom = game_state.get(sid)
 
-    UserOptions.update(**data).where(
-        UserOptions.id == pr.player.default_options
-    ).execute()
+    await run_db(
+        UserOptions.update(**data)
+        .where(UserOptions.id == pr.player.default_options_id)
+        .execute
+    )
 
 
 @sio.on("Client.Options.Room.Set", namespace=GAME_NS)
@@ -57,12 +59,17 @@ async def set_client_default_options(sid: str, data: ClientOptions):
 async def set_client_room_options(sid: str, data: ClientOptions):
     pr: PlayerRoom = game_state.get(sid)
 
-    with db.atomic():
-        if pr.user_options is None:
-            pr.user_options = UserOptions.create_empty()
-            pr.save()
+    def update_options():
+        with db.atomic():
+            if pr.user_options is None:
+                pr.user_options = UserOptions.create_empty()
+                pr.save()
 
-        UserOptions.update(**data).where(UserOptions.id == pr.user_options).execute()
+            UserOptions.update(**data).where(
+                UserOptions.id == pr.user_options
+            ).execute()
+
+    await run_db(update_options)
 
 
 @sio.on("Client.Options.Location.Set", namespace=GAME_NS)
@@ -70,14 +77,18 @@ async def set_client_room_options(sid: str, data: ClientOptions):
 async def set_client_location_options(sid: str, data: LocationOptions):
     pr: PlayerRoom = game_state.get(sid)
 
-    LocationUserOption.update(
-        pan_x=data["pan_x"],
-        pan_y=data["pan_y"],
-        zoom_factor=data["zoom_factor"],
-    ).where(
-        (LocationUserOption.location == pr.active_location)
-        & (LocationUserOption.user == pr.player)
-    ).execute()
+    await run_db(
+        LocationUserOption.update(
+            pan_x=data["pan_x"],
+            pan_y=data["pan_y"],
+            zoom_factor=data["zoom_factor"],
+        )
+        .where(
+            (LocationUserOption.location == pr.active_location)
+            & (LocationUserOption.user == pr.player)
+        )
+        .execute
+    )
 
 
 @sio.on("Client.ActiveLayer.Set", namespace=GAME_NS)
@@ -85,12 +96,17 @@ async def set_client_location_options(sid: str, data: LocationOptions):
 async def set_layer(sid: str, data: Dict[str, Any]):
     pr: PlayerRoom = game_state.get(sid)
 
-    try:
-        floor = pr.active_location.floors.select().where(Floor.name == data["floor"])[0]
-        layer = floor.layers.select().where(Layer.name == data["layer"])[0]
-    except IndexError:
-        pass
-    else:
-        luo = LocationUserOption.get(user=pr.player, location=pr.active_location)
-        luo.active_layer = layer
-        luo.save()
+    def set_active_layer():
+        try:
+            floor = pr.active_location.floors.select().where(
+                Floor.name == data["floor"]
+            )[0]
+            layer = floor.layers.select().where(Layer.name == data["layer"])[0]
+        except IndexError:
+            pass
+        else:
+            luo = LocationUserOption.get(user=pr.player, location=pr.active_location)
+            luo.active_layer = layer
+            luo.save()
+
+    await run_db(set_active_layer)
@@ -4,6 +4,7 @@ import auth
 from api.socket.constants import GAME_NS
 from app import app, sio
 from models import Asset, PlayerRoom
+from models.db import run_db
 from models.role import Role
 from state.game import game_state
 from utils import logger
@@ -23,7 +24,7 @@ async def get_asset_options(sid: str, asset_id: int):
         logger.warning(f"{pr.player.name} attempted to request asset options")
         return
 
-    asset = Asset.get_or_none(id=asset_id)
+    asset = await run_db(Asset.get_or_none, id=asset_id)
 
     if asset is None:
         options = {"success": False, "error": "AssetNotFound"}
@@ -42,11 +43,14 @@ async def set_asset_options(sid: str, asset_options: AssetOptions):
         logger.warning(f"{pr.player.name} attempted to set asset options")
         return
 
-    asset = Asset.get_or_none(id=asset_options["asset"])
-    if asset is None:
-        asset = Asset.create(
-            name="T",
-            owner=game_state.get_user(sid),
-        )
-    asset.options = asset_options["options"]
-    asset.save()
+    def update():
+        asset = Asset.get_or_none(id=asset_options["asset"])
+        if asset is None:
+            asset = Asset.create(
+                name="T",
+                owner=game_state.get_user(sid),
+            )
+        asset.options = asset_options["options"]
+        asset.save()
+
+    await run_db(update)
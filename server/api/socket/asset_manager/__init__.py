@@ -1,14 +1,10 @@
-import hashlib
-import io
-import json
+import asyncio
 import os
-import shutil
-import tarfile
 import tempfile
-import time
 from collections import defaultdict
+from contextlib import suppress
 from pathlib import Path
-from typing import cast, Dict, List, Optional, Union
+from typing import cast, Any, Dict, List, Optional, Union
 from typing_extensions import TypedDict
 
 from aiohttp import web
@@ -18,11 +14,17 @@ from uuid import uuid4
 import auth
 from app import app, sio
 from models import Asset
+from models.db import run_db
+from paa import create_archive, extract_archive
 from state.asset import asset_state
 from utils import logger
 from ..constants import ASSET_NS
-from .common import UploadData
-from .ddraft import ASSETS_DIR, handle_ddraft_file
+from .archive import EXPORT_DIR, get_codec, run_archive_job
+from . import store
+from .common import ASSETS_DIR, UploadData
+from .ddraft import handle_ddraft_file
+from .upload import PendingUpload, add_upload_slice, discard_uploads
+from .variants import get_variant
 
 
 class AssetDict(TypedDict):
@@ -45,24 +47,32 @@ async def assetmgmt_connect(sid: str, environ):
         await sio.emit("redirect", "/", room=sid, namespace=ASSET_NS)
     else:
         await asset_state.add_sid(sid, user)
-        root = Asset.get_root_folder(user)
+        root = await run_db(Asset.get_root_folder, user)
         await sio.emit("Folder.Root.Set", root.id, room=sid, namespace=ASSET_NS)
 
 
+@sio.on("disconnect", namespace=ASSET_NS)
+async def assetmgmt_disconnect(sid: str):
+    discard_uploads(sid)
+
+
 @sio.on("Folder.Get", namespace=ASSET_NS)
 async def get_folder(sid: str, folder=None):
     user = asset_state.get_user(sid)
 
-    if folder is None:
-        folder = Asset.get_root_folder(user)
-    else:
-        folder = Asset.get_by_id(folder)
+    def get_folder_data() -> AssetDict:
+        if folder is None:
+            target = Asset.get_root_folder(user)
+        else:
+            target = Asset.get_by_id(folder)
+
+        if target.owner_id != user.id:
+            raise web.HTTPForbidden
+        return target.as_dict(children=True)
 
-    if folder.owner != user:
-        raise web.HTTPForbidden
     await sio.emit(
         "Folder.Set",
-        {"folder": folder.as_dict(children=True)},
+        {"folder": await run_db(get_folder_data)},
         room=sid,
         namespace=ASSET_NS,
     )
@@ -73,34 +83,41 @@ async def get_folder_by_path(sid: str, folder):
     user = asset_state.get_user(sid)
 
     folder = folder.strip("/")
-    target_folder = Asset.get_root_folder(user)
 
-    id_path = []
+    def get_folder_data() -> Optional[Dict[str, Any]]:
+        target_folder = Asset.get_root_folder(user)
 
-    if folder:
-        for path in folder.split("/"):
-            try:
-                target_folder = target_folder.get_child(path)
-                id_path.append(target_folder.id)
-            except Asset.DoesNotExist:
-                return await get_folder_by_path(sid, "/")
+        id_path = []
 
-    await sio.emit(
-        "Folder.Set",
-        {"folder": target_folder.as_dict(children=True), "path": id_path},
-        room=sid,
-        namespace=ASSET_NS,
-    )
+        if folder:
+            for path in folder.split("/"):
+                try:
+                    target_folder = target_folder.get_child(path)
+                    id_path.append(target_folder.id)
+                except Asset.DoesNotExist:
+                    return None
+
+        return {"folder": target_folder.as_dict(children=True), "path": id_path}
+
+    data = await run_db(get_folder_data)
+    if data is None:
+        return await get_folder_by_path(sid, "/")
+
+    await sio.emit("Folder.Set", data, room=sid, namespace=ASSET_NS)
 
 
 @sio.on("Folder.Create", namespace=ASSET_NS)
 @auth.login_required(app, sio)
 async def create_folder(sid: str, data):
     user = asset_state.get_user(sid)
-    parent = data.get("parent", None)
-    if parent is None:
-        parent = Asset.get_root_folder(user)
-    asset = Asset.create(name=data["name"], owner=user, parent=parent)
+
+    def create() -> Asset:
+        parent = data.get("parent", None)
+        if parent is None:
+            parent = Asset.get_root_folder(user)
+        return Asset.create(name=data["name"], owner=user, parent=parent)
+
+    asset = await run_db(create)
     await sio.emit("Folder.Create", asset.as_dict(), room=sid, namespace=ASSET_NS)
 
 
@@ -108,112 +125,107 @@ async def create_folder(sid: str, data):
 @auth.login_required(app, sio)
 async def move_inode(sid: str, data):
     user = asset_state.get_user(sid)
-    target = data.get("target", None)
-    if target is None:
-        target = Asset.get_root_folder(user)
 
-    asset = Asset.get_by_id(data["inode"])
-    if asset.owner != user:
-        logger.warning(f"{user.name} attempted to move files it doesn't own.")
-        return
-    asset.parent = target
-    asset.save()
+    def move():
+        target = data.get("target", None)
+        if target is None:
+            target = Asset.get_root_folder(user)
+
+        asset = Asset.get_by_id(data["inode"])
+        if asset.owner_id != user.id:
+            logger.warning(f"{user.name} attempted to move files it doesn't own.")
+            return
+        asset.parent = target
+        asset.save()
+
+    await run_db(move)
 
 
 @sio.on("Asset.Rename", namespace=ASSET_NS)
 @auth.login_required(app, sio)
 async def assetmgmt_rename(sid: str, data):
     user = asset_state.get_user(sid)
-    asset = Asset.get_by_id(data["asset"])
-    if asset.owner != user:
-        logger.warning(f"{user.name} attempted to rename a file it doesn't own.")
-        return
-    asset.name = data["name"]
-    asset.save()
+
+    def rename():
+        asset = Asset.get_by_id(data["asset"])
+        if asset.owner_id != user.id:
+            logger.warning(f"{user.name} attempted to rename a file it doesn't own.")
+            return
+        asset.name = data["name"]
+        asset.save()
+
+    await run_db(rename)
 
 
 @sio.on("Asset.Remove", namespace=ASSET_NS)
 @auth.login_required(app, sio)
 async def assetmgmt_rm(sid: str, data):
     user = asset_state.get_user(sid)
-    asset = Asset.get_by_id(data)
-    if asset.owner != user:
+    asset = await run_db(Asset.get_by_id, data)
+    if asset.owner_id != user.id:
         logger.warning(f"{user.name} attempted to remove a file it doesn't own.")
         return
-    asset.delete_instance(recursive=True, delete_nullable=True)
-
-    if asset.file_hash is not None and (ASSETS_DIR / asset.file_hash).exists():
-        if Asset.select().where(Asset.file_hash == asset.file_hash).count() == 0:
-            logger.info(
-                f"No asset maps to file {asset.file_hash}, removing from server"
-            )
-            (ASSETS_DIR / asset.file_hash).unlink()
-
-
-def get_safe_members(
-    members: List[tarfile.TarInfo], directory: str
-) -> List[tarfile.TarInfo]:
-    safe_members: List[tarfile.TarInfo] = []
-    for member in members:
-        if member.islnk() or member.issym():
-            continue
-        if member.name.startswith("/") or ".." in member.name:
-            continue
-        # there is no real harm in extracting other files, but doesn't hurt to be a bit more strict
-        if member.name != "data" and not member.name.startswith("files"):
-            continue
-        safe_members.append(member)
-    return safe_members
-
-
-async def handle_paa_file(upload_data: UploadData, data: bytes, sid: str):
-    with tempfile.TemporaryDirectory() as tmpdir:
-        with tarfile.open(fileobj=io.BytesIO(data), mode="r:bz2") as tar:
-            files = tarfile.TarInfo("files")
-            files.type = tarfile.DIRTYPE
-            # We need to explicitly list our members for security reasons
-            # this is upload data so people could upload malicious stuff that breaks out of the path etc
-            tar.extractall(
-                path=tmpdir, members=get_safe_members(tar.getmembers(), tmpdir)
+    file_hashes = export_asset(await run_db(asset.as_dict, True, True))["file_hashes"]
+    await run_db(asset.delete_instance, recursive=True, delete_nullable=True)
+
+    for file_hash in set(file_hashes):
+        await run_db(store.remove_if_unreferenced, file_hash)
+
+
+async def handle_paa_file(upload_data: UploadData, path: Path, sid: str):
+    try:
+        # Extracted next to the store, so that the files can be moved into it without copying
+        with tempfile.TemporaryDirectory(
+            dir=str(ASSETS_DIR), prefix=".import-"
+        ) as tmpdir:
+            raw_assets: List[AssetDict] = await run_archive_job(
+                sid,
+                "Asset.Import.Progress",
+                {"name": upload_data["name"]},
+                extract_archive,
+                str(path),
+                tmpdir,
             )
+            files_dir = Path(tmpdir) / "files"
+            if files_dir.is_dir():
+                for file_path in files_dir.iterdir():
+                    if file_path.is_file():
+                        store.add_file(file_path, file_path.name)
+    finally:
+        with suppress(FileNotFoundError):
+            path.unlink()
 
-        tmp_path = Path(tmpdir)
-        for asset in os.listdir(tmp_path / "files"):
-            if not (ASSETS_DIR / asset).exists():
-                shutil.move(str(tmp_path / "files" / asset), str(ASSETS_DIR / asset))
+    user = asset_state.get_user(sid)
 
-        with open(tmp_path / "data") as json_data:
-            raw_assets: List[AssetDict] = json.load(json_data)
+    def create_assets():
+        parent_map: Dict[int, int] = defaultdict(lambda: upload_data["directory"])
 
-    user = asset_state.get_user(sid)
-    parent_map: Dict[int, int] = defaultdict(lambda: upload_data["directory"])
-
-    for raw_asset in raw_assets:
-        new_asset = Asset.create(
-            name=raw_asset["name"],
-            file_hash=raw_asset["file_hash"],
-            owner=user,
-            parent=parent_map[raw_asset["parent"]],
-            options=raw_asset["options"],
-        )
-        parent_map[raw_asset["id"]] = new_asset.id
+        for raw_asset in raw_assets:
+            new_asset = Asset.create(
+                name=raw_asset["name"],
+                file_hash=raw_asset["file_hash"],
+                owner=user,
+                parent=parent_map[raw_asset["parent"]],
+                options=raw_asset["options"],
+            )
+            parent_map[raw_asset["id"]] = new_asset.id
+
+    await run_db(create_assets)
 
     await sio.emit(
         "Asset.Import.Finish", upload_data["name"], room=sid, namespace=ASSET_NS
     )
 
 
-async def handle_regular_file(upload_data: UploadData, data: bytes, sid: str):
-    sh = hashlib.sha1(data)
-    hashname = sh.hexdigest()
-
-    if not (ASSETS_DIR / hashname).exists():
-        with open(ASSETS_DIR / hashname, "wb") as f:
-            f.write(data)
+async def handle_regular_file(upload_data: UploadData, upload: PendingUpload, sid: str):
+    hashname = upload.store()
+    # Prepare the preview that the asset manager will request right away
+    asyncio.ensure_future(get_variant(hashname, "thumbnail"))
 
     user = asset_state.get_user(sid)
 
-    asset = Asset.create(
+    asset = await run_db(
+        Asset.create,
         name=upload_data["name"],
         file_hash=hashname,
         owner=user,
@@ -226,29 +238,22 @@ async def handle_regular_file(upload_data: UploadData, data: bytes, sid: str):
 @sio.on("Asset.Upload", namespace=ASSET_NS)
 @auth.login_required(app, sio)
 async def assetmgmt_upload(sid: str, upload_data: UploadData):
-    uuid = upload_data["uuid"]
-
-    if uuid not in asset_state.pending_file_upload_cache:
-        asset_state.pending_file_upload_cache[uuid] = {}
-    asset_state.pending_file_upload_cache[uuid][upload_data["slice"]] = upload_data
-    if len(asset_state.pending_file_upload_cache[uuid]) != upload_data["totalSlices"]:
+    upload = add_upload_slice(sid, upload_data)
+    if upload is None or not upload.done:
         # wait for the rest of the slices
         return
 
-    # All slices are present
-    data = b""
-    for slice_ in range(upload_data["totalSlices"]):
-        data += asset_state.pending_file_upload_cache[uuid][slice_]["data"]
-
-    del asset_state.pending_file_upload_cache[upload_data["uuid"]]
-
-    file_name = upload_data["name"]
-    if file_name.endswith(".paa"):
-        await handle_paa_file(upload_data, data, sid)
-    elif file_name.endswith(".dd2vtt"):
-        await handle_ddraft_file(upload_data, data, sid)
-    else:
-        await handle_regular_file(upload_data, data, sid)
+    # All slices are written
+    try:
+        file_name = upload_data["name"]
+        if file_name.endswith(".paa"):
+            await handle_paa_file(upload_data, upload.path, sid)
+        elif file_name.endswith(".dd2vtt"):
+            await handle_ddraft_file(upload_data, upload.path, sid)
+        else:
+            await handle_regular_file(upload_data, upload, sid)
+    finally:
+        upload.discard()
 
 
 def export_asset(asset: Union[AssetDict, List[AssetDict]], parent=-1) -> AssetExport:
@@ -278,42 +283,28 @@ def export_asset(asset: Union[AssetDict, List[AssetDict]], parent=-1) -> AssetEx
 
 @sio.on("Asset.Export", namespace=ASSET_NS)
 @auth.login_required(app, sio)
-async def assetmgmt_export(sid: str, selection: List[int]):
+async def assetmgmt_export(sid: str, selection: List[int], codec: Optional[str] = None):
+    def get_selection() -> List[AssetDict]:
+        return [Asset.get_by_id(asset).as_dict(True, True) for asset in selection]
 
-    full_selection: List[AssetDict] = [
-        Asset.get_by_id(asset).as_dict(True, True) for asset in selection
-    ]
+    full_selection = await run_db(get_selection)
 
     asset_data = export_asset(full_selection)
-    json_data = json.dumps(asset_data["data"])
-
-    data_tar_info = tarfile.TarInfo(
-        "data",
-    )
-    data_tar_info.size = len(json_data)
-    data_tar_info.mode = 0o755
-    data_tar_info.mtime = time.time()  # type: ignore
-
-    files_tar_info = tarfile.TarInfo("files")
-    files_tar_info.type = tarfile.DIRTYPE
-    files_tar_info.mode = 0o755
-    files_tar_info.mtime = time.time()  # type: ignore
 
     uuid = uuid4()
-    static_folder = Path("static")
-    os.makedirs(static_folder / "temp", exist_ok=True)
-    with tarfile.open(static_folder / "temp" / f"{uuid}.paa", "w:bz2") as tar:
-        tar.addfile(data_tar_info, io.BytesIO(json_data.encode("utf-8")))
-        tar.addfile(files_tar_info)
-        for file_hash in asset_data["file_hashes"]:
-            try:
-                file_path = static_folder / "assets" / file_hash
-                info = tar.gettarinfo(str(file_path))
-                info.name = f"files/{file_hash}"
-                info.mtime = time.time()  # type: ignore
-                info.mode = 0o755
-                tar.addfile(info, open(file_path, "rb"))  # type: ignore
-            except FileNotFoundError:
-                pass
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    await run_archive_job(
+        sid,
+        "Asset.Export.Progress",
+        {"uuid": str(uuid)},
+        create_archive,
+        str(EXPORT_DIR / f"{uuid}.paa"),
+        asset_data["data"],
+        [
+            (file_hash, str(store.get_path(file_hash)))
+            for file_hash in asset_data["file_hashes"]
+        ],
+        get_codec(codec),
+    )
 
     await sio.emit("Asset.Export.Finish", str(uuid), room=sid, namespace=ASSET_NS)
@@ -0,0 +1,100 @@
+"""
+Runs the (de)compression of .paa archives in worker processes,
+so that large imports and exports do not block the event loop.
+"""
+
+import asyncio
+import multiprocessing
+import queue
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, Optional
+
+from app import sio
+from config import config
+from paa import CODECS
+from utils import FILE_DIR, logger
+from ..constants import ASSET_NS
+
+ARCHIVE_WORKERS = config.getint("Assets", "archive_workers", fallback=2)
+EXPORT_CODEC = config.get("Assets", "export_codec", fallback="bz2")
+EXPORT_RETENTION = config.getint("Assets", "export_retention", fallback=3600)
+PROGRESS_INTERVAL = 0.5
+
+EXPORT_DIR = FILE_DIR / "static" / "temp"
+
+archive_executor = ProcessPoolExecutor(max_workers=ARCHIVE_WORKERS)
+_manager: Optional[Any] = None
+
+
+def get_codec(codec: Optional[str]) -> str:
+    if codec in CODECS:
+        return codec  # type: ignore
+    return EXPORT_CODEC if EXPORT_CODEC in CODECS else "bz2"
+
+
+def _get_manager():
+    global _manager
+    if _manager is None:
+        _manager = multiprocessing.Manager()
+    return _manager
+
+
+def _get_latest(progress) -> Optional[Any]:
+    latest = None
+    try:
+        while True:
+            latest = progress.get_nowait()
+    except queue.Empty:
+        return latest
+
+
+async def run_archive_job(
+    sid: str, event: str, data: Dict[str, Any], fn: Callable[..., Any], *args: Any
+) -> Any:
+    """
+    Runs `fn(*args, progress)` in the archive worker pool.
+
+    While it runs, `event` is emitted to `sid` with `data` and the latest reported progress (done/total).
+    """
+    progress = _get_manager().Queue()
+    job: "partial[Any]" = partial(fn, *args, progress)
+    future = asyncio.get_event_loop().run_in_executor(archive_executor, job)
+    while True:
+        done, _ = await asyncio.wait([future], timeout=PROGRESS_INTERVAL)
+        latest = _get_latest(progress)
+        if latest is not None:
+            await sio.emit(
+                event,
+                {**data, "done": latest[0], "total": latest[1]},
+                room=sid,
+                namespace=ASSET_NS,
+            )
+        if done:
+            return future.result()
+
+
+def remove_old_exports() -> None:
+    deadline = time.time() - EXPORT_RETENTION
+    for path in EXPORT_DIR.glob("*.paa"):
+        if path.stat().st_mtime < deadline:
+            path.unlink()
+
+
+async def clean_exports() -> None:
+    """
+    Periodically removes exported archives that are older than EXPORT_RETENTION seconds.
+    """
+    while True:
+        try:
+            remove_old_exports()
+        except Exception:
+            logger.exception("Could not clean up old asset exports")
+        await asyncio.sleep(max(EXPORT_RETENTION / 10, 1))
+
+
+def shutdown_archive_workers() -> None:
+    archive_executor.shutdown()
+    if _manager is not None:
+        _manager.shutdown()
@@ -1,14 +1,17 @@
 import base64
 import json
 import hashlib
+from pathlib import Path
 from typing import List
 from typing_extensions import TypedDict
 
 from app import sio
 from models import Asset
+from models.db import run_db
 from state.asset import asset_state
 from ..constants import ASSET_NS
-from .common import ASSETS_DIR, UploadData
+from . import store
+from .common import UploadData
 
 
 class Coord(TypedDict):
@@ -38,17 +41,16 @@ class DDraftData(TypedDict):
     image: str
 
 
-async def handle_ddraft_file(upload_data: UploadData, data: bytes, sid: str):
-    ddraft_file: DDraftData = json.loads(data)
+async def handle_ddraft_file(upload_data: UploadData, path: Path, sid: str):
+    with open(path, "rb") as f:
+        ddraft_file: DDraftData = json.load(f)
 
     image = base64.b64decode(ddraft_file["image"])
 
     sh = hashlib.sha1(image)
     hashname = sh.hexdigest()
 
-    if not (ASSETS_DIR / hashname).exists():
-        with open(ASSETS_DIR / hashname, "wb") as f:
-            f.write(image)
+    store.add_data(hashname, image)
 
     template = {
         "version": "0",
@@ -64,7 +66,8 @@ async def handle_ddraft_file(upload_data: UploadData, data: bytes, sid: str):
 
     user = asset_state.get_user(sid)
 
-    asset = Asset.create(
+    asset = await run_db(
+        Asset.create,
         name=upload_data["name"],
         file_hash=hashname,
         owner=user,
@@ -0,0 +1,145 @@
+"""
+Content addressed storage of the asset files.
+
+Files are named by their SHA-1 hash and sharded over two levels of subdirectories (`ab/cd/abcd...`),
+so that no single directory grows too large to list or modify quickly.
+The same file is stored once, no matter how many assets refer to it.
+Files that are no longer referenced by any asset are removed when their last asset is removed
+or by the periodic garbage collection.
+
+Downscaled variants of images (see .variants) are stored with the same layout per variant in `static/variants`.
+"""
+
+import asyncio
+import os
+import time
+from pathlib import Path
+from typing import Iterator, Set
+
+from config import config
+from models import Asset
+from models.db import run_db
+from utils import FILE_DIR, logger
+from .common import ASSETS_DIR
+
+GC_INTERVAL = config.getint("Assets", "gc_interval", fallback=3600)
+# Unreferenced files younger than this are kept, as their asset might still be in the process of being created
+GC_GRACE_PERIOD = 3600
+
+VARIANTS_DIR = FILE_DIR / "static" / "variants"
+
+
+def get_path(file_hash: str) -> Path:
+    return ASSETS_DIR / file_hash[:2] / file_hash[2:4] / file_hash
+
+
+def get_variant_path(file_hash: str, variant: str) -> Path:
+    """
+    Returns the path of a variant of the file, without the extension.
+    """
+    return VARIANTS_DIR / variant / file_hash[:2] / file_hash[2:4] / file_hash
+
+
+def remove_variants(file_hash: str) -> None:
+    if not VARIANTS_DIR.is_dir():
+        return
+    for variant in os.listdir(VARIANTS_DIR):
+        path = get_variant_path(file_hash, variant)
+        for variant_file in path.parent.glob(f"{file_hash}.*"):
+            variant_file.unlink()
+
+
+def exists(file_hash: str) -> bool:
+    return get_path(file_hash).exists()
+
+
+def add_file(path: Path, file_hash: str) -> None:
+    """
+    Moves the file at `path` into the store, or removes it if the store already contains the file.
+
+    `path` should be on the same filesystem as the store, as the move is done with an atomic rename.
+    """
+    target = get_path(file_hash)
+    if target.exists():
+        path.unlink()
+        return
+    target.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(str(path), str(target))
+    # The moved file can be older than the garbage collection grace period
+    os.utime(str(target))
+
+
+def add_data(file_hash: str, data: bytes) -> None:
+    target = get_path(file_hash)
+    if target.exists():
+        return
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(f".{file_hash}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(str(tmp), str(target))
+
+
+def is_referenced(file_hash: str) -> bool:
+    return Asset.select().where(Asset.file_hash == file_hash).exists()
+
+
+def remove_if_unreferenced(file_hash: str) -> None:
+    if is_referenced(file_hash):
+        return
+    remove_variants(file_hash)
+    try:
+        get_path(file_hash).unlink()
+    except FileNotFoundError:
+        return
+    logger.info(f"No asset maps to file {file_hash}, removing from server")
+
+
+def _iter_files() -> Iterator[os.DirEntry]:
+    for first in os.scandir(ASSETS_DIR):
+        if not first.is_dir() or first.name.startswith("."):
+            continue
+        for second in os.scandir(first.path):
+            if not second.is_dir():
+                continue
+            for entry in os.scandir(second.path):
+                if entry.is_file() and not entry.name.startswith("."):
+                    yield entry
+
+
+def _get_referenced_hashes() -> Set[str]:
+    return {
+        asset.file_hash
+        for asset in Asset.select(Asset.file_hash)
+        .where(Asset.file_hash.is_null(False))
+        .distinct()
+    }
+
+
+def _remove_unreferenced(referenced: Set[str]) -> int:
+    deadline = time.time() - GC_GRACE_PERIOD
+    removed = 0
+    for entry in _iter_files():
+        if entry.name in referenced or entry.stat().st_mtime > deadline:
+            continue
+        os.unlink(entry.path)
+        remove_variants(entry.name)
+        removed += 1
+    return removed
+
+
+async def collect_garbage() -> None:
+    """
+    Periodically removes the files that are not referenced by any asset.
+    """
+    while True:
+        await asyncio.sleep(GC_INTERVAL)
+        try:
+            referenced = await run_db(_get_referenced_hashes)
+            removed = await asyncio.get_event_loop().run_in_executor(
+                None, _remove_unreferenced, referenced
+            )
+            if removed:
+                logger.info(f"Removed {removed} unreferenced asset files")
+        except Exception:
+            logger.exception("Could not collect unreferenced asset files")
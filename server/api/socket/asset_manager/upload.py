@@ -0,0 +1,189 @@
+"""
+Streaming reassembly of sliced asset uploads.
+
+Slices are appended to a temporary file next to the assets as soon as they can be written in order,
+while the SHA-1 of the file is computed on the fly.
+Only slices that arrive ahead of their turn are kept in memory,
+so the memory used by an upload does not depend on the size of the file.
+The number of slices a client can send ahead and the memory they take are limited,
+an upload that goes over these limits is aborted.
+"""
+
+import asyncio
+import hashlib
+import shutil
+import time
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Dict, Optional
+
+from config import config
+from state.asset import asset_state
+from utils import logger
+from . import store
+from .common import ASSETS_DIR, UploadData
+
+UPLOAD_TIMEOUT = config.getint("Assets", "upload_timeout", fallback=600)
+# In MB
+UPLOAD_BUFFER_SIZE = config.getint("Assets", "upload_buffer_size", fallback=32)
+CLIENT_UPLOAD_BUFFER_SIZE = config.getint(
+    "Assets", "client_upload_buffer_size", fallback=64
+)
+# Number of slices after the next expected one that are accepted
+UPLOAD_WINDOW = 64
+
+
+class PendingUpload:
+    def __init__(self, sid: str, upload_data: UploadData) -> None:
+        self.sid = sid
+        self.uuid = upload_data["uuid"]
+        self.name = upload_data["name"]
+        self.directory = upload_data["directory"]
+        self.total_slices = upload_data["totalSlices"]
+        self.next_slice = 0
+        # slices that arrived before one of their predecessors
+        self.early_slices: Dict[int, bytes] = {}
+        self.buffered = 0
+        self.sha1 = hashlib.sha1()
+        self.last_activity = time.monotonic()
+        # Created in the assets folder so that the final rename does not cross filesystems
+        self._file = NamedTemporaryFile(
+            dir=str(ASSETS_DIR), prefix=".upload-", delete=False
+        )
+        self.path = Path(self._file.name)
+
+    @property
+    def done(self) -> bool:
+        return self.next_slice == self.total_slices
+
+    def add_slice(self, index: int, data: bytes, buffer_limit: int) -> bool:
+        """
+        Writes or buffers a slice, returns whether it was accepted.
+
+        Slices that would have to be buffered are only accepted if they are within the upload window
+        and take at most `buffer_limit` bytes in total.
+        """
+        self.last_activity = time.monotonic()
+        if not 0 <= index < self.total_slices or not isinstance(data, bytes):
+            return False
+        if index < self.next_slice or index in self.early_slices:
+            # Sent again
+            return True
+        if index != self.next_slice:
+            if index >= self.next_slice + UPLOAD_WINDOW:
+                return False
+            if self.buffered + len(data) > buffer_limit:
+                return False
+            self.early_slices[index] = data
+            self.buffered += len(data)
+            return True
+
+        self._write(data)
+        self.next_slice += 1
+        while self.next_slice in self.early_slices:
+            data = self.early_slices.pop(self.next_slice)
+            self.buffered -= len(data)
+            self._write(data)
+            self.next_slice += 1
+        if self.done:
+            self._file.close()
+        return True
+
+    def _write(self, data: bytes) -> None:
+        self._file.write(data)
+        self.sha1.update(data)
+
+    def store(self) -> str:
+        """
+        Moves the completed upload into the assets folder and returns its hash.
+        """
+        file_hash = self.sha1.hexdigest()
+        store.add_file(self.path, file_hash)
+        return file_hash
+
+    def discard(self) -> None:
+        self._file.close()
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def add_upload_slice(sid: str, upload_data: UploadData) -> Optional[PendingUpload]:
+    """
+    Adds a slice to its upload, which is returned unless it was aborted because the slice was rejected.
+    """
+    uuid = upload_data["uuid"]
+    upload = asset_state.pending_file_upload_cache.get(uuid)
+    if upload is None:
+        total_slices = upload_data["totalSlices"]
+        if not isinstance(total_slices, int) or total_slices <= 0:
+            logger.warning(f"Rejected upload of {upload_data['name']}: no slices")
+            return None
+        upload = asset_state.pending_file_upload_cache[uuid] = PendingUpload(
+            sid, upload_data
+        )
+    elif upload.sid != sid:
+        logger.warning(f"Rejected slice of {upload.name} from another client")
+        return None
+
+    client_buffered = sum(
+        other.buffered
+        for other in asset_state.pending_file_upload_cache.values()
+        if other.sid == sid and other is not upload
+    )
+    buffer_limit = min(
+        UPLOAD_BUFFER_SIZE * 1024 * 1024,
+        CLIENT_UPLOAD_BUFFER_SIZE * 1024 * 1024 - client_buffered,
+    )
+    if not upload.add_slice(upload_data["slice"], upload_data["data"], buffer_limit):
+        logger.warning(
+            f"Aborted upload of {upload.name}: slice {upload_data['slice']} was rejected"
+        )
+        del asset_state.pending_file_upload_cache[uuid]
+        upload.discard()
+        return None
+    if upload.done:
+        del asset_state.pending_file_upload_cache[uuid]
+    return upload
+
+
+def discard_uploads(sid: str) -> None:
+    """
+    Discards the unfinished uploads of a client.
+    """
+    for uuid, upload in list(asset_state.pending_file_upload_cache.items()):
+        if upload.sid == sid:
+            del asset_state.pending_file_upload_cache[uuid]
+            upload.discard()
+
+
+def expire_uploads() -> None:
+    deadline = time.monotonic() - UPLOAD_TIMEOUT
+    for uuid, upload in list(asset_state.pending_file_upload_cache.items()):
+        if upload.last_activity < deadline:
+            logger.warning(f"Discarding abandoned upload of {upload.name}")
+            del asset_state.pending_file_upload_cache[uuid]
+            upload.discard()
+
+
+def remove_stale_upload_files() -> None:
+    """
+    Removes the temporary files of uploads and imports that were interrupted by a server shutdown.
+    """
+    for path in ASSETS_DIR.glob(".upload-*"):
+        path.unlink()
+    for path in ASSETS_DIR.glob(".import-*"):
+        shutil.rmtree(str(path), ignore_errors=True)
+
+
+async def clean_uploads() -> None:
+    """
+    Periodically discards uploads that did not receive a slice for UPLOAD_TIMEOUT seconds.
+    """
+    while True:
+        await asyncio.sleep(max(UPLOAD_TIMEOUT / 10, 1))
+        try:
+            expire_uploads()
+        except Exception:
+            logger.exception("Could not clean up abandoned uploads")
@@ -0,0 +1,92 @@
+"""
+Downscaled variants of image assets, used for previews and logos.
+
+Variants are created in worker processes the first time they are requested
+and are afterwards served from disk (see store.get_variant_path).
+When an image is already small enough, or is not an image at all, a marker file is stored instead
+and the original file is served.
+The original file is also served when creating the variant failed, which is tried again on the next request.
+"""
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from config import config
+from images import create_variant
+from utils import logger
+from . import store
+
+# variant name -> maximum width/height
+VARIANTS: Dict[str, int] = {"thumbnail": 256, "small": 1024, "medium": 2048}
+
+EXTENSIONS = (".jpg", ".png")
+USE_ORIGINAL = ".orig"
+
+IMAGE_WORKERS = config.getint("Assets", "image_workers", fallback=2)
+
+variant_executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+_pending: Dict[Tuple[str, str], "asyncio.Future[Optional[str]]"] = {}
+
+
+def _forget_pending(
+    key: Tuple[str, str], _future: "asyncio.Future[Optional[str]]"
+) -> None:
+    _pending.pop(key, None)
+
+
+def _find_variant(path: Path) -> Optional[Path]:
+    for extension in (*EXTENSIONS, USE_ORIGINAL):
+        variant_path = path.with_name(path.name + extension)
+        if variant_path.exists():
+            return variant_path
+    return None
+
+
+async def get_variant(file_hash: str, variant: str) -> Optional[Path]:
+    """
+    Returns the path of the file to serve for the given variant of a file, creating the variant if needed.
+
+    This is the original file if no smaller variant exists and None if the file itself does not exist.
+    """
+    original = store.get_path(file_hash)
+    if not original.is_file():
+        return None
+
+    path = store.get_variant_path(file_hash, variant)
+    variant_path = _find_variant(path)
+    if variant_path is None:
+        key = (file_hash, variant)
+        future = _pending.get(key)
+        if future is None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            future = _pending[key] = asyncio.get_event_loop().run_in_executor(
+                variant_executor,
+                create_variant,
+                str(original),
+                str(path),
+                VARIANTS[variant],
+            )
+            # Not done in a finally, a cancelled request should not forget the running job
+            future.add_done_callback(partial(_forget_pending, key))
+        try:
+            extension = await asyncio.shield(future)
+        except OSError:
+            logger.exception(f"Could not create the {variant} variant of {file_hash}")
+            return original
+
+        if extension is None:
+            variant_path = path.with_name(path.name + USE_ORIGINAL)
+            variant_path.touch()
+        else:
+            variant_path = path.with_name(path.name + extension)
+
+    if variant_path.suffix == USE_ORIGINAL:
+        return original
+    return variant_path
+
+
+def shutdown_variant_workers() -> None:
+    variant_executor.shutdown()
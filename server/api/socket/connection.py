@@ -1,13 +1,17 @@
 from datetime import date
+from typing import Optional
 from urllib.parse import unquote
 
 from aiohttp_security import authorized_userid
 
 from api.socket.constants import GAME_NS
+from api.socket.location import forget_client
+from api.socket.shape.position import position_broadcaster
 from app import sio
 from models import PlayerRoom, Room, User
+from models.db import run_db, select_room, use_room
 from models.role import Role
-from state.game import game_state
+from state.game import game_state, get_campaign_room, get_campaign_user_room
 from utils import logger
 
 
@@ -23,31 +27,44 @@ async def connect(sid, environ):
         k.split("=")[0]: k.split("=")[1]
         for k in unquote(environ["QUERY_STRING"]).strip().split("&")
     }
-    try:
-        room = (
-            Room.select()
-            .join(User)
-            .where((Room.name == ref["room"]) & (User.name == ref["user"]))[0]
-        )
-    except IndexError:
-        return False
-    else:
-        for pr in room.players:
-            if pr.player == user:
-                if pr.role != Role.DM and room.is_locked:
-                    return False
-                break
+
+    def join() -> Optional[PlayerRoom]:
+        try:
+            room = (
+                Room.select()
+                .join(User)
+                .where((Room.name == ref["room"]) & (User.name == ref["user"]))[0]
+            )
+        except IndexError:
+            return None
         else:
-            return False
+            for room_player in room.players:
+                if room_player.player == user:
+                    if room_player.role != Role.DM and room.is_locked:
+                        return None
+                    break
+            else:
+                return None
+
+        with use_room(room.id):
+            pr: PlayerRoom = PlayerRoom.get(room=room, player=user)
+            pr.last_played = date.today()
+            pr.save()
+            return pr.load_references()
+
+    pr = await run_db(join)
+    if pr is None:
+        return False
+
+    select_room(pr.room_id)
 
-    pr: PlayerRoom = PlayerRoom.get(room=room, player=user)
-    pr.last_played = date.today()
-    pr.save()
     await game_state.add_sid(sid, pr)
 
     logger.info(f"User {user.name} connected with identifier {sid}")
 
-    sio.enter_room(sid, pr.active_location.get_path(), namespace=GAME_NS)
+    sio.enter_room(sid, get_campaign_room(pr.room), namespace=GAME_NS)
+    sio.enter_room(sid, get_campaign_user_room(pr.room, pr.player), namespace=GAME_NS)
+    game_state.enter_location(sid, pr.active_location)
 
 
 @sio.on("disconnect", namespace=GAME_NS)
@@ -55,7 +72,10 @@ async def disconnect(sid):
     if not game_state.has_sid(sid):
         return
 
+    select_room(game_state.get(sid).room_id)
     user = game_state.get_user(sid)
 
     logger.info(f"User {user.name} disconnected with identifier {sid}")
+    forget_client(sid)
+    await position_broadcaster.flush(sid)
     await game_state.remove_sid(sid)
@@ -1,13 +1,14 @@
-from typing import List
+from typing import Any, Dict, List, Tuple
 from typing_extensions import TypedDict
 
 import auth
 from api.socket.constants import GAME_NS
 from app import app, sio
 from models import Floor, PlayerRoom
-from models.db import db
+from models.db import db, run_db
 from models.role import Role
 from state.game import game_state
+from state.room import room_state
 from utils import logger
 
 # DATA CLASSES FOR TYPE CHECKING
@@ -30,16 +31,18 @@ async def create_floor(sid: str, data: str):
         logger.warning(f"{pr.player.name} attempted to create a new floor")
         return
 
-    floor: Floor = pr.active_location.create_floor(data)
+    def create() -> List[Tuple[str, Dict[str, Any]]]:
+        floor: Floor = pr.active_location.create_floor(data)
+        return [
+            (room, floor.as_dict(audience_pr.player, audience_pr.role == Role.DM))
+            for room, audience_pr in game_state.get_audiences(pr.active_location)
+        ]
 
-    for psid, player in game_state.get_users(active_location=pr.active_location):
+    for room, payload in await run_db(create):
         await sio.emit(
             "Floor.Create",
-            {
-                "floor": floor.as_dict(player, game_state.get(psid).role == Role.DM),
-                "creator": pr.player.name,
-            },
-            room=psid,
+            {"floor": payload, "creator": pr.player.name},
+            room=room,
             namespace=GAME_NS,
         )
 
@@ -53,8 +56,9 @@ async def remove_floor(sid: str, data: str):
         logger.warning(f"{pr.player.name} attempted to remove a floor")
         return
 
-    floor: Floor = Floor.get(location=pr.active_location, name=data)
-    floor.delete_instance(recursive=True)
+    floor: Floor = await run_db(Floor.get, location=pr.active_location, name=data)
+    await run_db(room_state.drop, pr.room)
+    await run_db(floor.delete_instance, recursive=True)
 
     await sio.emit(
         "Floor.Remove",
@@ -74,9 +78,12 @@ async def set_floor_visibility(sid: str, data: FloorVisibleData):
         logger.warning(f"{pr.player.name} attempted to toggle floor visibility")
         return
 
-    floor: Floor = Floor.get(location=pr.active_location, name=data["name"])
-    floor.player_visible = data["visible"]
-    floor.save()
+    def set_visibility():
+        floor: Floor = Floor.get(location=pr.active_location, name=data["name"])
+        floor.player_visible = data["visible"]
+        floor.save()
+
+    await run_db(set_visibility)
 
     await sio.emit(
         "Floor.Visible.Set",
@@ -95,9 +102,12 @@ async def rename_floor(sid: str, data: FloorRename):
         logger.warning(f"{pr.player.name} attempted to rename a floor")
         return
 
-    floor: Floor = Floor.get(location=pr.active_location, index=data["index"])
-    floor.name = data["name"]
-    floor.save()
+    def rename():
+        floor: Floor = Floor.get(location=pr.active_location, index=data["index"])
+        floor.name = data["name"]
+        floor.save()
+
+    await run_db(rename)
 
     await sio.emit(
         "Floor.Rename",
@@ -117,11 +127,14 @@ async def reorder_floors(sid: str, data: List[str]):
         logger.warning(f"{pr.player.name} attempted to reorder floors")
         return
 
-    with db.atomic():
-        for i, name in enumerate(data):
-            init = Floor.get(location=pr.active_location, name=name)
-            init.index = i
-            init.save()
+    def reorder():
+        with db.atomic():
+            for i, name in enumerate(data):
+                init = Floor.get(location=pr.active_location, name=name)
+                init.index = i
+                init.save()
+
+    await run_db(reorder)
 
     await sio.emit(
         "Floors.Reorder",
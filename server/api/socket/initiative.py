@@ -1,10 +1,11 @@
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 from typing_extensions import TypedDict
 
 from peewee import JOIN
 from playhouse.shortcuts import dict_to_model, update_model_from_dict
 
 import auth
+import cluster
 from api.socket.constants import GAME_NS
 from app import app, sio
 from models import (
@@ -17,11 +18,12 @@ from models import (
     ShapeOwner,
     User,
 )
-from models.db import db
+from models.db import db, run_db
 from models.role import Role
 from models.shape.access import has_ownership
 from models.utils import reduce_data_to_model
-from state.game import game_state
+from state.game import game_state, get_user_room
+from state.room import room_state
 from utils import logger
 
 
@@ -52,86 +54,99 @@ class ServerInitiativeEffectActor(TypedDict):
 async def update_initiative(sid: str, data: ServerInitiativeData):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = Shape.get_or_none(uuid=data["uuid"])
+    def update() -> bool:
+        shape = Shape.get_or_none(uuid=data["uuid"])
 
-    if not has_ownership(shape, pr):
-        logger.warning(
-            f"{pr.player.name} attempted to change initiative of an asset it does not own"
-        )
-        return
+        if not has_ownership(shape, pr):
+            logger.warning(
+                f"{pr.player.name} attempted to change initiative of an asset it does not own"
+            )
+            return False
 
-    location_data = InitiativeLocationData.get_or_none(location=pr.active_location)
-    if location_data is None:
-        location_data = InitiativeLocationData.create(
-            location=pr.active_location, turn=data["uuid"], round=1
+        location_data = room_state.get_or_none(
+            pr.room, InitiativeLocationData, location=pr.active_location
+        )
+        if location_data is None:
+            location_data = InitiativeLocationData.create(
+                location=pr.active_location, turn=data["uuid"], round=1
+            )
+        initiatives = Initiative.select().where(
+            Initiative.location_data == location_data
         )
-    initiatives = Initiative.select().where(Initiative.location_data == location_data)
 
-    initiative = Initiative.get_or_none(uuid=data["uuid"])
+        initiative = Initiative.get_or_none(uuid=data["uuid"])
 
-    # Create new initiative
-    if initiative is None:
-        with db.atomic():
-            # Update indices
-            try:
-                index = (
-                    initiatives.where(Initiative.initiative >= data["initiative"])
-                    .order_by(-Initiative.index)[0]
-                    .index
-                    + 1
-                )
-            except IndexError:
-                index = 0
-            else:
-                Initiative.update(index=Initiative.index + 1).where(
-                    (Initiative.location_data == location_data)
-                    & (Initiative.index >= index)
-                )
-            # Create model instance
-            initiative = dict_to_model(
-                Initiative, reduce_data_to_model(Initiative, data)
-            )
-            initiative.location_data = location_data
-            initiative.index = index
-            initiative.save(force_insert=True)
-    # Update initiative
-    else:
-        with db.atomic():
-            if data["initiative"] != initiative.initiative:
+        # Create new initiative
+        if initiative is None:
+            with db.atomic():
                 # Update indices
-                old_index = initiative.index
                 try:
-                    new_index = (
+                    index = (
                         initiatives.where(Initiative.initiative >= data["initiative"])
                         .order_by(-Initiative.index)[0]
                         .index
+                        + 1
                     )
                 except IndexError:
-                    new_index = 0
+                    index = 0
                 else:
-                    if new_index < old_index:
-                        new_index += 1
-                if old_index != new_index:
-                    # SIGN=1 IF old_index > new_index WHICH MEANS the initiative is increased
-                    # SIGN=-1 IF old_index < new_index WHICH MEANS the initiative is decreased
-                    sign = (old_index - new_index) // abs(old_index - new_index)
-                    indices = [0, old_index, new_index]
-                    update = Initiative.update(index=Initiative.index + sign).where(
+                    Initiative.update(index=Initiative.index + 1).where(
                         (Initiative.location_data == location_data)
-                        & (Initiative.index <= indices[sign])
-                        & (Initiative.index >= indices[-sign])
+                        & (Initiative.index >= index)
                     )
-                    update.execute()
-                data["index"] = new_index
-            elif data.get("index", None) is None:
-                data["index"] = 0
-            if initiative.location_data != location_data:
+                # Create model instance
+                initiative = dict_to_model(
+                    Initiative, reduce_data_to_model(Initiative, data)
+                )
                 initiative.location_data = location_data
-            # Update model instance
-            update_model_from_dict(initiative, reduce_data_to_model(Initiative, data))
-            initiative.save()
+                initiative.index = index
+                initiative.save(force_insert=True)
+        # Update initiative
+        else:
+            with db.atomic():
+                if data["initiative"] != initiative.initiative:
+                    # Update indices
+                    old_index = initiative.index
+                    try:
+                        new_index = (
+                            initiatives.where(
+                                Initiative.initiative >= data["initiative"]
+                            )
+                            .order_by(-Initiative.index)[0]
+                            .index
+                        )
+                    except IndexError:
+                        new_index = 0
+                    else:
+                        if new_index < old_index:
+                            new_index += 1
+                    if old_index != new_index:
+                        # SIGN=1 IF old_index > new_index WHICH MEANS the initiative is increased
+                        # SIGN=-1 IF old_index < new_index WHICH MEANS the initiative is decreased
+                        sign = (old_index - new_index) // abs(old_index - new_index)
+                        indices = [0, old_index, new_index]
+                        update = Initiative.update(index=Initiative.index + sign).where(
+                            (Initiative.location_data == location_data)
+                            & (Initiative.index <= indices[sign])
+                            & (Initiative.index >= indices[-sign])
+                        )
+                        update.execute()
+                    data["index"] = new_index
+                elif data.get("index", None) is None:
+                    data["index"] = 0
+                if initiative.location_data != location_data:
+                    initiative.location_data = location_data
+                # Update model instance
+                update_model_from_dict(
+                    initiative, reduce_data_to_model(Initiative, data)
+                )
+                initiative.save()
 
-    data["index"] = initiative.index
+        data["index"] = initiative.index
+        return True
+
+    if not await run_db(update):
+        return
 
     await send_client_initiatives(pr)
 
@@ -141,25 +156,32 @@ async def update_initiative(sid: str, data: ServerInitiativeData):
 async def remove_initiative(sid: str, data: str):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = Shape.get_or_none(uuid=data)
+    def remove() -> bool:
+        shape = Shape.get_or_none(uuid=data)
+
+        if shape is not None and not has_ownership(shape, pr):
+            logger.warning(
+                f"{pr.player.name} attempted to remove initiative of an asset it does not own"
+            )
+            return False
 
-    if shape is not None and not has_ownership(shape, pr):
-        logger.warning(
-            f"{pr.player.name} attempted to remove initiative of an asset it does not own"
+        initiative = Initiative.get_or_none(uuid=data)
+        location_data = room_state.get_or_none(
+            pr.room, InitiativeLocationData, location=pr.active_location
         )
-        return
 
-    initiative = Initiative.get_or_none(uuid=data)
-    location_data = InitiativeLocationData.get_or_none(location=pr.active_location)
+        if not initiative:
+            return False
 
-    if initiative:
         with db.atomic():
             Initiative.update(index=Initiative.index - 1).where(
                 (Initiative.location_data == location_data)
                 & (Initiative.index >= initiative.index)
             )
             initiative.delete_instance(True)
+        return True
 
+    if await run_db(remove):
         await send_client_initiatives(pr)
 
 
@@ -172,11 +194,14 @@ async def update_initiative_order(sid: str, data: List[str]):
         logger.warning(f"{pr.player.name} attempted to change the initiative order")
         return
 
-    with db.atomic():
-        for i, uuid in enumerate(data):
-            init = Initiative.get(uuid=uuid)
-            init.index = i
-            init.save()
+    def reorder():
+        with db.atomic():
+            for i, uuid in enumerate(data):
+                init = Initiative.get(uuid=uuid)
+                init.index = i
+                init.save()
+
+    await run_db(reorder)
 
     await send_client_initiatives(pr)
 
@@ -190,25 +215,32 @@ async def update_initiative_turn(sid: str, data: str):
         logger.warning(f"{pr.player.name} attempted to advance the initiative tracker")
         return
 
-    location_data = InitiativeLocationData.get(location=pr.active_location)
-    with db.atomic():
-        location_data.turn = data
-        location_data.save()
-
-        effects = (
-            InitiativeEffect.select().join(Initiative).where(Initiative.uuid == data)
+    def update_turn():
+        location_data = room_state.get(
+            pr.room, InitiativeLocationData, location=pr.active_location
         )
-        for effect in effects:
-            try:
-                turns = int(effect.turns)
-                if turns <= 0:
-                    effect.delete_instance()
-                else:
-                    effect.turns = str(turns - 1)
-            except ValueError:
-                # For non-number inputs do not update the effect
-                pass
-            effect.save()
+        with db.atomic():
+            location_data.turn = data
+            room_state.save(pr.room, location_data)
+
+            effects = (
+                InitiativeEffect.select()
+                .join(Initiative)
+                .where(Initiative.uuid == data)
+            )
+            for effect in effects:
+                try:
+                    turns = int(effect.turns)
+                    if turns <= 0:
+                        effect.delete_instance()
+                    else:
+                        effect.turns = str(turns - 1)
+                except ValueError:
+                    # For non-number inputs do not update the effect
+                    pass
+                effect.save()
+
+    await run_db(update_turn)
 
     await sio.emit(
         "Initiative.Turn.Update",
@@ -228,10 +260,15 @@ async def update_initiative_round(sid: str, data: int):
         logger.warning(f"{pr.player.name} attempted to advance the initiative tracker")
         return
 
-    location_data = InitiativeLocationData.get(location=pr.active_location)
-    with db.atomic():
-        location_data.round = data
-        location_data.save()
+    def update_round():
+        location_data = room_state.get(
+            pr.room, InitiativeLocationData, location=pr.active_location
+        )
+        with db.atomic():
+            location_data.round = data
+            room_state.save(pr.room, location_data)
+
+    await run_db(update_round)
 
     await sio.emit(
         "Initiative.Round.Update",
@@ -247,16 +284,23 @@ async def update_initiative_round(sid: str, data: int):
 async def new_initiative_effect(sid: str, data: ServerInitiativeEffectActor):
     pr: PlayerRoom = game_state.get(sid)
 
-    if not has_ownership(Shape.get_or_none(uuid=data["actor"]), pr):
-        logger.warning(f"{pr.player.name} attempted to create a new initiative effect")
-        return
+    def create() -> bool:
+        if not has_ownership(Shape.get_or_none(uuid=data["actor"]), pr):
+            logger.warning(
+                f"{pr.player.name} attempted to create a new initiative effect"
+            )
+            return False
 
-    InitiativeEffect.create(
-        initiative=data["actor"],
-        uuid=data["effect"]["uuid"],
-        name=data["effect"]["name"],
-        turns=data["effect"]["turns"],
-    )
+        InitiativeEffect.create(
+            initiative=data["actor"],
+            uuid=data["effect"]["uuid"],
+            name=data["effect"]["name"],
+            turns=data["effect"]["turns"],
+        )
+        return True
+
+    if not await run_db(create):
+        return
 
     await sio.emit(
         "Initiative.Effect.New",
@@ -272,16 +316,21 @@ async def new_initiative_effect(sid: str, data: ServerInitiativeEffectActor):
 async def update_initiative_effect(sid: str, data: ServerInitiativeEffectActor):
     pr: PlayerRoom = game_state.get(sid)
 
-    if not has_ownership(Shape.get_or_none(uuid=data["actor"]), pr):
-        logger.warning(f"{pr.player.name} attempted to update an initiative effect")
-        return
+    def update() -> bool:
+        if not has_ownership(Shape.get_or_none(uuid=data["actor"]), pr):
+            logger.warning(f"{pr.player.name} attempted to update an initiative effect")
+            return False
 
-    with db.atomic():
-        effect = InitiativeEffect.get(uuid=data["effect"]["uuid"])
-        update_model_from_dict(
-            effect, reduce_data_to_model(InitiativeEffect, data["effect"])
-        )
-        effect.save()
+        with db.atomic():
+            effect = InitiativeEffect.get(uuid=data["effect"]["uuid"])
+            update_model_from_dict(
+                effect, reduce_data_to_model(InitiativeEffect, data["effect"])
+            )
+            effect.save()
+        return True
+
+    if not await run_db(update):
+        return
 
     await sio.emit(
         "Initiative.Effect.Update",
@@ -297,13 +346,18 @@ async def update_initiative_effect(sid: str, data: ServerInitiativeEffectActor):
 async def remove_initiative_effect(sid: str, data: ServerInitiativeEffectActor):
     pr: PlayerRoom = game_state.get(sid)
 
-    if not has_ownership(Shape.get_or_none(uuid=data["actor"]), pr):
-        logger.warning(f"{pr.player.name} attempted to remove an initiative effect")
-        return
+    def remove() -> bool:
+        if not has_ownership(Shape.get_or_none(uuid=data["actor"]), pr):
+            logger.warning(f"{pr.player.name} attempted to remove an initiative effect")
+            return False
+
+        with db.atomic():
+            effect = InitiativeEffect.get(uuid=data["effect"]["uuid"])
+            effect.delete_instance()
+        return True
 
-    with db.atomic():
-        effect = InitiativeEffect.get(uuid=data["effect"]["uuid"])
-        effect.delete_instance()
+    if not await run_db(remove):
+        return
 
     await sio.emit(
         "Initiative.Effect.Remove",
@@ -315,7 +369,9 @@ async def remove_initiative_effect(sid: str, data: ServerInitiativeEffectActor):
 
 
 def get_client_initiatives(user: User, location: Location):
-    location_data = InitiativeLocationData.get_or_none(location=location)
+    location_data = room_state.get_or_none(
+        location.room_id, InitiativeLocationData, location=location
+    )
     if location_data is None:
         return []
     initiatives = Initiative.select().where(Initiative.location_data == location_data)
@@ -335,19 +391,48 @@ def get_client_initiatives(user: User, location: Location):
     return [i.as_dict() for i in initiatives.order_by(Initiative.index)]
 
 
+def _get_client_initiative_updates(
+    pr: PlayerRoom, target_user: Optional[User], skip_sid: Optional[str]
+) -> List[Tuple[str, List[Dict[str, Any]]]]:
+    updates = []
+    for room_player in pr.room.players:
+        if target_user is not None and target_user != room_player.player:
+            continue
+        if cluster.is_worker():
+            # The clients of this player might be connected to another worker
+            if room_player.active_location_id != pr.active_location_id:
+                continue
+        elif (
+            next(
+                game_state.get_sids(
+                    player=room_player.player,
+                    active_location=pr.active_location,
+                    skip_sid=skip_sid,
+                ),
+                None,
+            )
+            is None
+        ):
+            continue
+        updates.append(
+            (
+                get_user_room(pr.active_location, room_player.player),
+                get_client_initiatives(room_player.player, pr.active_location),
+            )
+        )
+    return updates
+
+
 async def send_client_initiatives(
     pr: PlayerRoom, target_user: User = None, skip_sid=None
 ) -> None:
-    for room_player in pr.room.players:
-        if target_user is None or target_user == room_player.player:
-            for psid in game_state.get_sids(
-                player=room_player.player, active_location=pr.active_location
-            ):
-                if psid == skip_sid:
-                    continue
-                await sio.emit(
-                    "Initiative.Set",
-                    get_client_initiatives(room_player.player, pr.active_location),
-                    room=psid,
-                    namespace=GAME_NS,
-                )
+    for room, initiatives in await run_db(
+        _get_client_initiative_updates, pr, target_user, skip_sid
+    ):
+        await sio.emit(
+            "Initiative.Set",
+            initiatives,
+            room=room,
+            skip_sid=skip_sid,
+            namespace=GAME_NS,
+        )
@@ -1,11 +1,12 @@
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional, Tuple
 from typing_extensions import TypedDict
 
 import auth
 from api.socket.constants import GAME_NS
 from app import app, sio
 from models import Label, LabelSelection, PlayerRoom, User
-from state.game import game_state
+from models.db import run_db
+from state.game import game_state, get_campaign_room, get_campaign_user_room
 from utils import logger
 
 
@@ -19,24 +20,37 @@ class LabelVisibilityMessage(TypedDict):
 async def add(sid: str, data: Dict[str, Any]):
     pr: PlayerRoom = game_state.get(sid)
 
-    label = Label.get_or_none(uuid=data)
+    def create() -> Optional[Label]:
+        label = Label.get_or_none(uuid=data)
 
-    if label is not None:
-        logger.warn(
-            f"{pr.player.name} tried to add a label with an id that already exists."
-        )
-        return
+        if label is not None:
+            logger.warn(
+                f"{pr.player.name} tried to add a label with an id that already exists."
+            )
+            return None
 
-    if data["user"] != pr.player.name:
-        logger.warn(f"{pr.player.name} tried to add a label for someone else.")
-        return
+        if data["user"] != pr.player.name:
+            logger.warn(f"{pr.player.name} tried to add a label for someone else.")
+            return None
 
-    data["user"] = User.by_name(data["user"])
-    label = Label.create(**data)
+        data["user"] = User.by_name(data["user"])
+        return Label.create(**data)
 
-    for psid in game_state.get_sids(skip_sid=sid, room=pr.room):
-        if game_state.get_user(psid) == pr.player or label.visible:
-            await sio.emit("Label.Add", label.as_dict(), room=psid, namespace=GAME_NS)
+    label = await run_db(create)
+    if label is None:
+        return
+
+    if label.visible:
+        room = get_campaign_room(pr.room)
+    else:
+        room = get_campaign_user_room(pr.room, pr.player)
+    await sio.emit(
+        "Label.Add",
+        await run_db(label.as_dict),
+        room=room,
+        skip_sid=sid,
+        namespace=GAME_NS,
+    )
 
 
 @sio.on("Label.Delete", namespace=GAME_NS)
@@ -44,17 +58,22 @@ async def add(sid: str, data: Dict[str, Any]):
 async def delete(sid: str, data: Dict[str, Any]):
     pr: PlayerRoom = game_state.get(sid)
 
-    label = Label.get_or_none(uuid=data)
+    def remove() -> bool:
+        label = Label.get_or_none(uuid=data)
 
-    if label is None:
-        logger.warn(f"{pr.player.name} tried to delete a non-existing label.")
-        return
+        if label is None:
+            logger.warn(f"{pr.player.name} tried to delete a non-existing label.")
+            return False
 
-    if label.user != pr.player:
-        logger.warn(f"{pr.player.name} tried to delete another user's label.")
-        return
+        if label.user_id != pr.player.id:
+            logger.warn(f"{pr.player.name} tried to delete another user's label.")
+            return False
 
-    label.delete_instance(True)
+        label.delete_instance(True)
+        return True
+
+    if not await run_db(remove):
+        return
 
     await sio.emit(
         "Label.Delete",
@@ -70,37 +89,51 @@ async def delete(sid: str, data: Dict[str, Any]):
 async def set_visibility(sid: str, data: LabelVisibilityMessage):
     pr: PlayerRoom = game_state.get(sid)
 
-    label = Label.get_or_none(uuid=data["uuid"])
+    def update() -> Optional[Tuple[Dict[str, Any], List[Tuple[str, bool]]]]:
+        label = Label.get_or_none(uuid=data["uuid"])
 
-    if label is None:
-        logger.warn(f"{pr.player.name} tried to change a non-existing label.")
-        return
+        if label is None:
+            logger.warn(f"{pr.player.name} tried to change a non-existing label.")
+            return None
 
-    if label.user != pr.player:
-        logger.warn(f"{pr.player.name} tried to change another user's label.")
-        return
+        if label.user_id != pr.player.id:
+            logger.warn(f"{pr.player.name} tried to change another user's label.")
+            return None
+
+        label.visible = data["visible"]
+        label.save()
 
-    label.visible = data["visible"]
-    label.save()
+        rooms = [
+            (
+                get_campaign_user_room(pr.room, room_player.player),
+                room_player.player_id == pr.player.id,
+            )
+            for room_player in pr.room.players.select(PlayerRoom, User).join(User)
+        ]
+        return label.as_dict(), rooms
+
+    updated = await run_db(update)
+    if updated is None:
+        return
+    label, rooms = updated
 
-    for psid in game_state.get_sids(skip_sid=sid, room=pr.room):
-        if game_state.get_user(psid) == pr.player:
+    for room, is_owner in rooms:
+        if is_owner:
             await sio.emit(
                 "Label.Visibility.Set",
-                {"user": label.pr.player.name, **data},
-                room=psid,
+                {"user": label["user"], **data},
+                room=room,
+                skip_sid=sid,
                 namespace=GAME_NS,
             )
         else:
             if data["visible"]:
-                await sio.emit(
-                    "Label.Add", label.as_dict(), room=psid, namespace=GAME_NS
-                )
+                await sio.emit("Label.Add", label, room=room, namespace=GAME_NS)
             else:
                 await sio.emit(
                     "Label.Delete",
-                    {"uuid": label.uuid, "user": label.user.name},
-                    room=psid,
+                    {"uuid": label["uuid"], "user": label["user"]},
+                    room=room,
                     namespace=GAME_NS,
                 )
 
@@ -110,13 +143,20 @@ async def set_visibility(sid: str, data: LabelVisibilityMessage):
 async def add_filter(sid: str, uuid: str):
     pr: PlayerRoom = game_state.get(sid)
 
-    label = Label.get_or_none(uuid=uuid)
+    def create():
+        label = Label.get_or_none(uuid=uuid)
 
-    LabelSelection.create(label=label, user=pr.player, room=pr.room)
+        LabelSelection.create(label=label, user=pr.player, room=pr.room)
 
-    for psid in game_state.get_sids(skip_sid=sid, room=pr.room):
-        if game_state.get_user(psid) == pr.player:
-            await sio.emit("Labels.Filter.Add", uuid, room=psid, namespace=GAME_NS)
+    await run_db(create)
+
+    await sio.emit(
+        "Labels.Filter.Add",
+        uuid,
+        room=get_campaign_user_room(pr.room, pr.player),
+        skip_sid=sid,
+        namespace=GAME_NS,
+    )
 
 
 @sio.on("Labels.Filter.Remove", namespace=GAME_NS)
@@ -124,13 +164,20 @@ async def add_filter(sid: str, uuid: str):
 async def remove_filter(sid: str, uuid: str):
     pr: PlayerRoom = game_state.get(sid)
 
-    label = Label.get_or_none(uuid=uuid)
+    def remove():
+        label = Label.get_or_none(uuid=uuid)
+
+        ls = LabelSelection.get_or_none(label=label, room=pr.room, user=pr.player)
 
-    ls = LabelSelection.get_or_none(label=label, room=pr.room, user=pr.player)
+        if ls:
+            ls.delete_instance(True)
 
-    if ls:
-        ls.delete_instance(True)
+    await run_db(remove)
 
-    for psid in game_state.get_sids(skip_sid=sid, room=pr.room):
-        if game_state.get_user(psid) == pr.player:
-            await sio.emit("Labels.Filter.Remove", uuid, room=psid, namespace=GAME_NS)
+    await sio.emit(
+        "Labels.Filter.Remove",
+        uuid,
+        room=get_campaign_user_room(pr.room, pr.player),
+        skip_sid=sid,
+        namespace=GAME_NS,
+    )
@@ -1,14 +1,17 @@
+import asyncio
 import json
-from typing import List, Union
+import math
+from functools import partial
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
 from playhouse.shortcuts import update_model_from_dict
 from typing_extensions import TypedDict
 
 import auth
+import cluster
 from api.socket.constants import GAME_NS
 from app import app, sio
 from models import (
-    Floor,
     InitiativeLocationData,
     Location,
     LocationOptions,
@@ -17,11 +20,18 @@ from models import (
     Note,
     PlayerRoom,
     Shape,
+    User,
 )
 from models.asset import Asset
+from models.campaign import LocationSnapshot
+from models.db import run_db, select_room
 from models.label import Label, LabelSelection
+from models.shape.bulk import get_location_shapes
+from models.shape.geometry import BoundingBox, ShapeDict
+from models.shape.journal import Scope, shape_journal
 from models.role import Role
-from state.game import game_state
+from state.game import game_state, get_campaign_room, get_campaign_user_room
+from state.room import room_state
 from utils import logger
 
 from .initiative import send_client_initiatives
@@ -65,97 +75,366 @@ class LocationRenameData(TypedDict):
     name: str
 
 
+class LocationSyncData(TypedDict):
+    journal: str
+    location: int
+    version: int
+
+
+RESYNC_INTERVAL = config.getfloat("Persistence", "resync_interval", fallback=5)
+
+PROGRESSIVE_THRESHOLD = config.getint("Loading", "progressive_threshold", fallback=1000)
+PROGRESSIVE_CHUNK_SIZE = config.getint(
+    "Loading", "progressive_chunk_size", fallback=250
+)
+VIEWPORT_WIDTH = config.getint("Loading", "viewport_width", fallback=1920)
+VIEWPORT_HEIGHT = config.getint("Loading", "viewport_height", fallback=1080)
+
+# Same as DEFAULT_GRID_SIZE in the client
+DEFAULT_GRID_SIZE = 50
+
+# Clients that are receiving a location, which are not synchronized to any version yet
+_loading_sids: Set[str] = set()
+# Clients that are receiving the remaining shapes of a progressively loaded location
+_streams: Dict[str, "asyncio.Future[None]"] = {}
+
+
 @sio.on("Location.Load", namespace=GAME_NS)
 @auth.login_required(app, sio)
-async def _load_location(sid: str):
+async def _load_location(sid: str, sync: Optional[LocationSyncData] = None):
     pr: PlayerRoom = game_state.get(sid)
 
+    # A reconnecting client that still has the location only needs the changes it missed
+    if (
+        sync is not None
+        and sync["journal"] == shape_journal.id
+        and sync["location"] == pr.active_location_id
+    ):
+        changes = shape_journal.get_changes(sync["version"], get_sync_scopes(pr))
+        if changes is not None:
+            await resync_location(sid, changes)
+            return
+
     await load_location(sid, pr.active_location, complete=True)
 
+
 @sio.on("Asset.List.Get", namespace=GAME_NS)
 @auth.login_required(app, sio)
-async def _load_location(sid: str):
+async def _get_asset_list(sid: str):
     pr: PlayerRoom = game_state.get(sid)
 
     await sio.emit(
         "Asset.List.Set",
-        Asset.get_user_structure(pr.player),
+        await run_db(Asset.get_user_structure, pr.player),
         room=sid,
         namespace=GAME_NS,
     )
 
+
+def get_location(location_id: int) -> Location:
+    """
+    Returns a location that can be used for the socket.io room names outside of the database thread.
+    """
+    location = Location.get_by_id(location_id)
+    location.room.creator
+    return location
+
+
+def load_snapshot(location: Location) -> "asyncio.Future[LocationSnapshot]":
+    """
+    Starts serializing a location on the database thread.
+
+    The returned future can be passed to `load_location` for every client that loads the location,
+    so the location is only serialized once.
+    """
+
+    def take_snapshot() -> LocationSnapshot:
+        # Make sure that all pending in-memory changes are part of the data we're about to send
+        room_state.flush(location.room_id)
+        return LocationSnapshot(location)
+
+    return asyncio.ensure_future(run_db(take_snapshot))
+
+
+def get_sync_scopes(pr: PlayerRoom) -> List[Scope]:
+    """
+    Returns the journal scopes of the changes that a client can only get by reloading its location.
+    """
+    return [
+        ("location", pr.active_location_id),
+        ("room", pr.room_id),
+        ("user", pr.player_id),
+    ]
+
+
+async def send_sync_version(sid: str, version: int) -> None:
+    """
+    Tells a client that it received all shape changes up to the given journal version of its location.
+    """
+    pr: PlayerRoom = game_state.get(sid)
+    await sio.emit(
+        "Location.Version.Set",
+        {
+            "journal": shape_journal.id,
+            "location": pr.active_location_id,
+            "version": version,
+        },
+        room=sid,
+        namespace=GAME_NS,
+    )
+
+
+async def send_sync_versions() -> None:
+    """
+    Periodically sends every client the journal version it is synchronized to.
+
+    Only versions of which all changes were emitted are sent (see ShapeJournal.acknowledged_version).
+    """
+    previous = shape_journal.acknowledged_version
+    while True:
+        await asyncio.sleep(RESYNC_INTERVAL)
+        # Changes made outside of the handlers (e.g. by the position broadcaster) are reported here
+        shape_journal.report()
+        version = shape_journal.acknowledged_version
+        if version == previous:
+            continue
+        for sid in game_state.get_sids():
+            if sid not in _loading_sids:
+                await send_sync_version(sid, version)
+        previous = version
+
+
+async def send_shape_changes(sid: str, changes: Set[str]) -> None:
+    """
+    Sends a client the current state of the given shapes on its location.
+
+    Shapes that no longer exist, are on another location or are no longer visible to the client are sent as removed.
+    """
+    pr: PlayerRoom = game_state.get(sid)
+    is_dm = pr.role == Role.DM
+
+    def get_visible_shapes() -> List[ShapeDict]:
+        room_state.flush(pr.room)
+        return [
+            shape.as_dict(pr.player, is_dm)
+            for shape in get_location_shapes(pr.active_location, changes)
+            if is_dm or shape.layer.player_visible
+        ]
+
+    visible = await run_db(get_visible_shapes)
+    visible_uuids = {shape["uuid"] for shape in visible}
+
+    await sio.emit(
+        "Location.Resync",
+        {"shapes": visible, "removed": list(changes - visible_uuids)},
+        room=sid,
+        namespace=GAME_NS,
+    )
+
+
+@auth.login_required(app, sio)
+async def resync_location(sid: str, changes: Set[str]):
+    """
+    Sends a reconnecting client the current state of the given shapes, instead of reloading the whole location.
+    """
+    pr: PlayerRoom = game_state.get(sid)
+    version = shape_journal.version
+
+    await send_shape_changes(sid, changes)
+
+    location_data = await run_db(
+        room_state.get_or_none,
+        pr.room,
+        InitiativeLocationData,
+        location=pr.active_location,
+    )
+    if location_data:
+        await send_client_initiatives(pr, pr.player)
+        await sio.emit(
+            "Initiative.Round.Update",
+            location_data.round,
+            room=sid,
+            namespace=GAME_NS,
+        )
+        await sio.emit(
+            "Initiative.Turn.Set", location_data.turn, room=sid, namespace=GAME_NS
+        )
+
+    await send_sync_version(sid, version)
+
+
+def get_viewport(client_options: Dict[str, Any]) -> BoundingBox:
+    """
+    Returns the area of the board around the client's last position on the location.
+
+    The screen size of the client is not known, so a screen of `viewport_width` by `viewport_height` pixels is assumed
+    and extended by half a screen on every side.
+    """
+    options = client_options["location_user_options"]
+    grid_size = client_options["default_user_options"]["grid_size"]
+    if client_options.get("room_user_options", {}).get("grid_size"):
+        grid_size = client_options["room_user_options"]["grid_size"]
+    # Same zoom curve as gameStore.zoomFactor in the client
+    zoom = (grid_size / DEFAULT_GRID_SIZE) / (
+        -5 / 3 + (28 / 15) * math.exp(1.83 * options["zoom_factor"])
+    )
+    width = VIEWPORT_WIDTH / zoom
+    height = VIEWPORT_HEIGHT / zoom
+    x = -options["pan_x"]
+    y = -options["pan_y"]
+    return (x - width / 2, y - height / 2, x + width * 1.5, y + height * 1.5)
+
+
+def forget_client(sid: str) -> None:
+    """
+    Stops loading a location for a client that disconnected.
+    """
+    stream = _streams.pop(sid, None)
+    if stream is not None:
+        stream.cancel()
+    _loading_sids.discard(sid)
+
+
+def _forget_stream(sid: str, stream: "asyncio.Future[None]") -> None:
+    if _streams.get(sid) is stream:
+        del _streams[sid]
+
+
+async def stream_shapes(
+    sid: str, shapes: List[Tuple[int, ShapeDict]], version: int
+) -> None:
+    """
+    Sends the shapes that were left out of the floors of a progressively loaded location in chunks.
+
+    Changes made in the meantime were ignored by the client for the shapes it did not have yet,
+    so all shapes that changed since the location was serialized are sent again at the end.
+    """
+    for i in range(0, len(shapes), PROGRESSIVE_CHUNK_SIZE):
+        chunk = shapes[i : i + PROGRESSIVE_CHUNK_SIZE]
+        await sio.emit(
+            "Board.Shapes.Stream",
+            {
+                "shapes": [shape for _, shape in chunk],
+                "indices": [index for index, _ in chunk],
+            },
+            room=sid,
+            namespace=GAME_NS,
+        )
+        # Let the other clients be served in between chunks
+        await asyncio.sleep(0)
+
+    if not game_state.has_sid(sid):
+        return
+
+    current_version = shape_journal.version
+    changes = shape_journal.get_changes(version, get_sync_scopes(game_state.get(sid)))
+    if changes is None:
+        # The client will have to reload the location if it reconnects
+        current_version = version
+    elif changes:
+        await send_shape_changes(sid, changes)
+
+    _loading_sids.discard(sid)
+    await send_sync_version(sid, current_version)
+
+
 @auth.login_required(app, sio)
-async def load_location(sid: str, location: Location, *, complete=False):
+async def load_location(
+    sid: str,
+    location: Location,
+    *,
+    complete=False,
+    snapshot: Optional["asyncio.Future[LocationSnapshot]"] = None,
+):
+    stream = _streams.pop(sid, None)
+    if stream is not None:
+        stream.cancel()
+    _loading_sids.add(sid)
     pr: PlayerRoom = game_state.get(sid)
-    if pr.active_location != location:
+    if pr.active_location_id != location.id:
         pr.active_location = location
-        pr.save()
+        await run_db(pr.save)
+        game_state.reindex_sid(sid)
+
+    if snapshot is None:
+        snapshot = load_snapshot(location)
 
     # 1. Load client options
 
-    client_options = pr.player.as_dict()
-    client_options["location_user_options"] = LocationUserOption.get(
-        user=pr.player, location=location
-    ).as_dict()
-    client_options["default_user_options"] = pr.player.default_options.as_dict()
+    def get_client_options() -> Dict[str, Any]:
+        client_options = pr.player.as_dict()
+        client_options["location_user_options"] = LocationUserOption.get(
+            user=pr.player, location=location
+        ).as_dict()
+        client_options["default_user_options"] = pr.player.default_options.as_dict()
 
-    if pr.user_options:
-        client_options["room_user_options"] = pr.user_options.as_dict()
+        if pr.user_options:
+            client_options["room_user_options"] = pr.user_options.as_dict()
+        return client_options
+
+    client_options = await run_db(get_client_options)
 
     await sio.emit("Client.Options.Set", client_options, room=sid, namespace=GAME_NS)
 
     # 2. Load room info
 
+    def get_room_info() -> Dict[str, Any]:
+        return {
+            "name": pr.room.name,
+            "creator": pr.room.creator.name,
+            "invitationCode": str(pr.room.invitation_code),
+            "isLocked": pr.room.is_locked,
+            "default_options": pr.room.default_options.as_dict(),
+            "players": [
+                {
+                    "id": rp.player.id,
+                    "name": rp.player.name,
+                    "location": rp.active_location_id,
+                    "role": rp.role,
+                }
+                for rp in pr.room.players.select(PlayerRoom, User).join(User)
+            ],
+            "publicName": config.get("General", "public_name", fallback=""),
+        }
+
     if complete:
         await sio.emit(
-            "Room.Info.Set",
-            {
-                "name": pr.room.name,
-                "creator": pr.room.creator.name,
-                "invitationCode": str(pr.room.invitation_code),
-                "isLocked": pr.room.is_locked,
-                "default_options": pr.room.default_options.as_dict(),
-                "players": [
-                    {
-                        "id": rp.player.id,
-                        "name": rp.player.name,
-                        "location": rp.active_location.id,
-                        "role": rp.role,
-                    }
-                    for rp in pr.room.players
-                ],
-                "publicName": config.get("General", "public_name", fallback=""),
-            },
-            room=sid,
-            namespace=GAME_NS,
+            "Room.Info.Set", await run_db(get_room_info), room=sid, namespace=GAME_NS
         )
 
     # 3. Load location
 
-    await sio.emit("Location.Set", location.as_dict(), room=sid, namespace=GAME_NS)
+    location_snapshot = await snapshot
+    await sio.emit(
+        "Location.Set", location_snapshot.location, room=sid, namespace=GAME_NS
+    )
 
     # 4. Load all location settings (DM)
 
+    def get_location_settings() -> Dict[int, Dict[str, Any]]:
+        return {
+            l.id: {} if l.options is None else l.options.as_dict()
+            for l in pr.room.locations
+        }
+
     if complete and pr.role == Role.DM:
         await sio.emit(
             "Locations.Settings.Set",
-            {
-                l.id: {} if l.options is None else l.options.as_dict()
-                for l in pr.room.locations
-            },
+            await run_db(get_location_settings),
             room=sid,
             namespace=GAME_NS,
         )
 
     # 5. Load Board
 
-    locations = [
-        {"id": l.id, "name": l.name, "archived": l.archived}
-        for l in pr.room.locations.order_by(Location.index)
-    ]
-    await sio.emit("Board.Locations.Set", locations, room=sid, namespace=GAME_NS)
+    await sio.emit(
+        "Board.Locations.Set",
+        location_snapshot.locations,
+        room=sid,
+        namespace=GAME_NS,
+    )
 
-    floors = [floor for floor in location.floors.order_by(Floor.index)]
+    floors = location_snapshot.floors
 
     if "active_floor" in client_options["location_user_options"]:
         index = next(
@@ -167,17 +446,33 @@ async def load_location(sid: str, location: Location, *, complete=False):
         higher_floors = floors[index + 1 :] if index < len(floors) else []
         floors = [floors[index], *lower_floors, *higher_floors]
 
+    # Big locations first send the shapes around the client's position and the other shapes in the background
+    progressive = 0 < PROGRESSIVE_THRESHOLD < location_snapshot.shape_count
+    if progressive:
+        viewport = get_viewport(client_options)
+    remaining: List[Tuple[int, ShapeDict]] = []
+
     for floor in floors:
-        await sio.emit(
-            "Board.Floor.Set",
-            floor.as_dict(pr.player, pr.role == Role.DM),
-            room=sid,
-            namespace=GAME_NS,
-        )
+        if progressive:
+            payload, floor_remaining = await run_db(
+                location_snapshot.get_progressive_floor,
+                floor,
+                pr.player,
+                pr.role == Role.DM,
+                viewport,
+            )
+            remaining.extend(floor_remaining)
+        else:
+            payload = await run_db(
+                location_snapshot.get_floor, floor, pr.player, pr.role == Role.DM
+            )
+        await sio.emit("Board.Floor.Set", payload, room=sid, namespace=GAME_NS)
 
     # 6. Load Initiative
 
-    location_data = InitiativeLocationData.get_or_none(location=location)
+    location_data = await run_db(
+        room_state.get_or_none, pr.room, InitiativeLocationData, location=location
+    )
     if location_data:
         await send_client_initiatives(pr, pr.player)
         await sio.emit(
@@ -192,52 +487,62 @@ async def load_location(sid: str, location: Location, *, complete=False):
 
     # 7. Load labels
 
-    if complete:
+    def get_labels() -> Tuple[List[Dict[str, Any]], List[str]]:
         labels = Label.select().where(
             (Label.user == pr.player) | (Label.visible == True)
         )
         label_filters = LabelSelection.select().where(
             (LabelSelection.user == pr.player) & (LabelSelection.room == pr.room)
         )
+        return [l.as_dict() for l in labels], [l.label_id for l in label_filters]
+
+    if complete:
+        labels, label_filters = await run_db(get_labels)
 
         await sio.emit(
             "Labels.Set",
-            [l.as_dict() for l in labels],
+            labels,
             room=sid,
             namespace=GAME_NS,
         )
         await sio.emit(
             "Labels.Filters.Set",
-            [l.label.uuid for l in label_filters],
+            label_filters,
             room=sid,
             namespace=GAME_NS,
         )
 
     # 8. Load Notes
 
+    def get_notes() -> List[Dict[str, Any]]:
+        return [
+            note.as_dict()
+            for note in Note.select().where(
+                (Note.user == pr.player) & (Note.room == pr.room)
+            )
+        ]
+
     if complete:
         await sio.emit(
             "Notes.Set",
-            [
-                note.as_dict()
-                for note in Note.select().where(
-                    (Note.user == pr.player) & (Note.room == pr.room)
-                )
-            ],
+            await run_db(get_notes),
             room=sid,
             namespace=GAME_NS,
         )
 
     # 9. Load Markers
 
-    await sio.emit(
-        "Markers.Set",
-        [
+    def get_markers() -> List[str]:
+        return [
             marker.as_string()
             for marker in Marker.select(Marker.shape_id).where(
                 (Marker.user == pr.player) & (Marker.location == location)
             )
-        ],
+        ]
+
+    await sio.emit(
+        "Markers.Set",
+        await run_db(get_markers),
         room=sid,
         namespace=GAME_NS,
     )
@@ -247,11 +552,77 @@ async def load_location(sid: str, location: Location, *, complete=False):
     if complete:
         await sio.emit(
             "Asset.List.Set",
-            Asset.get_user_structure(pr.player),
+            await run_db(Asset.get_user_structure, pr.player),
             room=sid,
             namespace=GAME_NS,
         )
 
+    # 11. Remaining shapes and synchronization version
+
+    if remaining:
+        stream = asyncio.ensure_future(
+            stream_shapes(sid, remaining, location_snapshot.version)
+        )
+        stream.add_done_callback(partial(_forget_stream, sid))
+        _streams[sid] = stream
+    else:
+        _loading_sids.discard(sid)
+        await send_sync_version(sid, location_snapshot.version)
+
+
+async def _move_client(
+    sid: str,
+    location: Location,
+    snapshot: "asyncio.Future[LocationSnapshot]",
+    position: Optional[PositionTuple],
+) -> None:
+    try:
+        game_state.leave_location(sid, game_state.get(sid).active_location)
+        game_state.enter_location(sid, location)
+    except KeyError:
+        await game_state.remove_sid(sid)
+        return
+    await load_location(sid, location, snapshot=snapshot)
+    # We could send this to all users in the new location, BUT
+    # loading times might vary and we don't want to snap people back when they already move around
+    # And it's possible that there are already users on the new location that don't want to be moved to this new position
+    if position is not None:
+        await sio.emit("Position.Set", data=position, room=sid, namespace=GAME_NS)
+
+
+@cluster.on("location.change")
+async def _move_players(
+    room_id: int,
+    player_ids: List[int],
+    location_id: int,
+    position: Optional[PositionTuple],
+    from_location_id: Optional[int] = None,
+):
+    """
+    Moves the clients of the given players that are connected to this worker to another location.
+
+    The location is serialized once for all of them and the clients are loaded concurrently.
+    """
+    options = {"room": room_id}
+    if from_location_id is not None:
+        options["active_location"] = from_location_id
+
+    sids = [
+        sid
+        for player_id in player_ids
+        for sid in game_state.get_sids(player=player_id, **options)
+    ]
+    if not sids:
+        return
+
+    select_room(room_id)
+    new_location = await run_db(get_location, location_id)
+    snapshot = load_snapshot(new_location)
+
+    await asyncio.gather(
+        *(_move_client(sid, new_location, snapshot, position) for sid in sids)
+    )
+
 
 @sio.on("Location.Change", namespace=GAME_NS)
 @auth.login_required(app, sio)
@@ -262,42 +633,37 @@ async def change_location(sid: str, data: LocationChangeData):
         logger.warning(f"{pr.player.name} attempted to change location")
         return
 
+    room_players: List[PlayerRoom] = await run_db(
+        list,
+        pr.room.players.select(PlayerRoom, User)
+        .join(User)
+        .where(User.name << data["users"]),
+    )
+
     # Send an anouncement to show loading state
-    for room_player in pr.room.players:
-        if not room_player.player.name in data["users"]:
-            continue
+    for room_player in room_players:
+        await sio.emit(
+            "Location.Change.Start",
+            room=get_campaign_user_room(pr.room, room_player.player),
+            namespace=GAME_NS,
+        )
 
-        for psid in game_state.get_sids(player=room_player.player, room=pr.room):
-            await sio.emit("Location.Change.Start", room=psid, namespace=GAME_NS)
+    new_location = await run_db(get_location, data["location"])
 
-    new_location = Location.get_by_id(data["location"])
+    await cluster.dispatch(
+        "location.change",
+        pr.room.id,
+        [room_player.player_id for room_player in room_players],
+        new_location.id,
+        data.get("position"),
+    )
 
-    for room_player in pr.room.players:
-        if not room_player.player.name in data["users"]:
-            continue
+    def save_locations():
+        for room_player in room_players:
+            room_player.active_location = new_location
+            room_player.save()
 
-        for psid in game_state.get_sids(player=room_player.player, room=pr.room):
-            try:
-                sio.leave_room(
-                    psid, room_player.active_location.get_path(), namespace=GAME_NS
-                )
-                sio.enter_room(psid, new_location.get_path(), namespace=GAME_NS)
-            except KeyError:
-                await game_state.remove_sid(psid)
-                continue
-            await load_location(psid, new_location)
-            # We could send this to all users in the new location, BUT
-            # loading times might vary and we don't want to snap people back when they already move around
-            # And it's possible that there are already users on the new location that don't want to be moved to this new position
-            if "position" in data:
-                await sio.emit(
-                    "Position.Set",
-                    data=data["position"],
-                    room=psid,
-                    namespace=GAME_NS,
-                )
-        room_player.active_location = new_location
-        room_player.save()
+    await run_db(save_locations)
 
 
 @sio.on("Location.Options.Set", namespace=GAME_NS)
@@ -309,32 +675,40 @@ async def set_location_options(sid: str, data: LocationOptionsData):
         logger.warning(f"{pr.player.name} attempted to set a room option")
         return
 
-    if data.get("location", None) is None:
-        options = pr.room.default_options
-    else:
-        loc = Location.get_by_id(data["location"])
-        if loc.options is None:
-            loc.options = LocationOptions.create(
-                unit_size=None,
-                unit_size_unit=None,
-                grid_type=None,
-                use_grid=None,
-                full_fow=None,
-                fow_opacity=None,
-                fow_los=None,
-                vision_mode=None,
-                vision_min_range=None,
-                vision_max_range=None,
-            )
-            loc.save()
-        options = loc.options
+    def update_options():
+        if data.get("location", None) is None:
+            options = pr.room.default_options
+        else:
+            loc = Location.get_by_id(data["location"])
+            if loc.options is None:
+                loc.options = LocationOptions.create(
+                    unit_size=None,
+                    unit_size_unit=None,
+                    grid_type=None,
+                    use_grid=None,
+                    full_fow=None,
+                    fow_opacity=None,
+                    fow_los=None,
+                    vision_mode=None,
+                    vision_min_range=None,
+                    vision_max_range=None,
+                )
+                loc.save()
+            options = loc.options
 
-    update_model_from_dict(options, data["options"])
-    options.save()
+        update_model_from_dict(options, data["options"])
+        options.save()
+
+    await run_db(update_options)
 
     if data.get("location", None) is None:
-        for sid in game_state.get_sids(skip_sid=sid, room=pr.room):
-            await sio.emit("Location.Options.Set", data, room=sid, namespace=GAME_NS)
+        await sio.emit(
+            "Location.Options.Set",
+            data,
+            room=get_campaign_room(pr.room),
+            skip_sid=sid,
+            namespace=GAME_NS,
+        )
     else:
         await sio.emit(
             "Location.Options.Set",
@@ -354,19 +728,25 @@ async def add_new_location(sid: str, location: str):
         logger.warning(f"{pr.player.name} attempted to add a new location")
         return
 
-    new_location = Location.create(
-        room=pr.room, name=location, index=pr.room.locations.count()
+    def create() -> Location:
+        new_location = Location.create(
+            room=pr.room, name=location, index=pr.room.locations.count()
+        )
+        new_location.create_floor()
+        return get_location(new_location.id)
+
+    new_location = await run_db(create)
+
+    await cluster.dispatch(
+        "location.change",
+        pr.room.id,
+        [pr.player.id],
+        new_location.id,
+        None,
+        pr.active_location.id,
     )
-    new_location.create_floor()
-
-    for psid in game_state.get_sids(
-        player=pr.player, active_location=pr.active_location
-    ):
-        sio.leave_room(psid, pr.active_location.get_path(), namespace=GAME_NS)
-        sio.enter_room(psid, new_location.get_path(), namespace=GAME_NS)
-        await load_location(psid, new_location)
     pr.active_location = new_location
-    pr.save()
+    await run_db(pr.save)
 
 
 @sio.on("Locations.Order.Set", namespace=GAME_NS)
@@ -378,18 +758,25 @@ async def set_locations_order(sid: str, locations: List[int]):
         logger.warning(f"{pr.player.name} attempted to reorder locations.")
         return
 
-    for i, idx in enumerate(locations):
-        l: Location = Location.get_by_id(idx)
-        l.index = i + 1
-        l.save()
+    def reorder() -> List[PlayerRoom]:
+        for i, idx in enumerate(locations):
+            l: Location = Location.get_by_id(idx)
+            l.index = i + 1
+            l.save()
+        return list(
+            pr.room.players.select(PlayerRoom, User)
+            .join(User)
+            .where(PlayerRoom.role == Role.DM)
+        )
 
-    for player_room in pr.room.players:
-        if player_room.role != Role.DM:
-            continue
-        for psid in game_state.get_sids(skip_sid=sid, player=player_room.player):
-            await sio.emit(
-                "Locations.Order.Set", locations, room=psid, namespace=GAME_NS
-            )
+    for player_room in await run_db(reorder):
+        await sio.emit(
+            "Locations.Order.Set",
+            locations,
+            room=get_campaign_user_room(pr.room, player_room.player),
+            skip_sid=sid,
+            namespace=GAME_NS,
+        )
 
 
 @sio.on("Location.Rename", namespace=GAME_NS)
@@ -401,13 +788,20 @@ async def rename_location(sid: str, data: LocationRenameData):
         logger.warning(f"{pr.player.name} attempted to rename a location.")
         return
 
-    location = Location.get_by_id(data["location"])
-    location.name = data["name"]
-    location.save()
+    def rename():
+        location = Location.get_by_id(data["location"])
+        location.name = data["name"]
+        location.save()
+
+    await run_db(rename)
 
-    for player_room in pr.room.players:
-        for psid in game_state.get_sids(skip_sid=sid, player=player_room.player):
-            await sio.emit("Location.Rename", data, room=psid, namespace=GAME_NS)
+    await sio.emit(
+        "Location.Rename",
+        data,
+        room=get_campaign_room(pr.room),
+        skip_sid=sid,
+        namespace=GAME_NS,
+    )
 
 
 @sio.on("Location.Delete", namespace=GAME_NS)
@@ -419,15 +813,19 @@ async def delete_location(sid: str, location_id: int):
         logger.warning(f"{pr.player.name} attempted to rename a location.")
         return
 
-    location = Location.get_by_id(location_id)
+    def delete():
+        location = Location.get_by_id(location_id)
 
-    if location.players.count() > 0:
-        logger.error(
-            "A location was attempted to be removed that still has players! This has been prevented"
-        )
-        return
+        if location.players.count() > 0:
+            logger.error(
+                "A location was attempted to be removed that still has players! This has been prevented"
+            )
+            return
+
+        room_state.drop(pr.room)
+        location.delete_instance(recursive=True)
 
-    location.delete_instance(recursive=True)
+    await run_db(delete)
 
 
 @sio.on("Location.Archive", namespace=GAME_NS)
@@ -439,15 +837,20 @@ async def archive_location(sid: str, location_id: int):
         logger.warning(f"{pr.player.name} attempted to archive a location.")
         return
 
-    location = Location.get_by_id(location_id)
-    location.archived = True
-    location.save()
+    def archive():
+        location = Location.get_by_id(location_id)
+        location.archived = True
+        location.save()
 
-    for player_room in pr.room.players:
-        for psid in game_state.get_sids(skip_sid=sid, player=player_room.player):
-            await sio.emit(
-                "Location.Archive", location_id, room=psid, namespace=GAME_NS
-            )
+    await run_db(archive)
+
+    await sio.emit(
+        "Location.Archive",
+        location_id,
+        room=get_campaign_room(pr.room),
+        skip_sid=sid,
+        namespace=GAME_NS,
+    )
 
 
 @sio.on("Location.Unarchive", namespace=GAME_NS)
@@ -459,15 +862,20 @@ async def unarchive_location(sid: str, location_id: int):
         logger.warning(f"{pr.player.name} attempted to unarchive a location.")
         return
 
-    location = Location.get_by_id(location_id)
-    location.archived = False
-    location.save()
+    def unarchive():
+        location = Location.get_by_id(location_id)
+        location.archived = False
+        location.save()
 
-    for player_room in pr.room.players:
-        for psid in game_state.get_sids(skip_sid=sid, player=player_room.player):
-            await sio.emit(
-                "Location.Unarchive", location_id, room=psid, namespace=GAME_NS
-            )
+    await run_db(unarchive)
+
+    await sio.emit(
+        "Location.Unarchive",
+        location_id,
+        room=get_campaign_room(pr.room),
+        skip_sid=sid,
+        namespace=GAME_NS,
+    )
 
 
 @sio.on("Location.Spawn.Info.Get", namespace=GAME_NS)
@@ -479,19 +887,25 @@ async def get_location_spawn_info(sid: str, location_id: int):
         logger.warning(f"{pr.player.name} attempted to retrieve spawn locations.")
         return
 
-    data = []
-
-    try:
-        location = Location.get_by_id(location_id)
-        if location.options is not None:
-            for spawn in json.loads(location.options.spawn_locations):
-                try:
-                    shape = Shape.get_by_id(spawn)
-                except Shape.DoesNotExist:
-                    pass
-                else:
-                    data.append(shape.as_dict(pr.player, True))
-    except:
-        logger.exception("Could not load spawn locations")
+    def get_spawn_info() -> List[ShapeDict]:
+        data = []
+
+        room_state.flush(pr.room)
+
+        try:
+            location = Location.get_by_id(location_id)
+            if location.options is not None:
+                for spawn in json.loads(location.options.spawn_locations):
+                    try:
+                        shape = Shape.get_by_id(spawn)
+                    except Shape.DoesNotExist:
+                        pass
+                    else:
+                        data.append(shape.as_dict(pr.player, True))
+        except:
+            logger.exception("Could not load spawn locations")
+        return data
+
+    data = await run_db(get_spawn_info)
 
     await sio.emit("Location.Spawn.Info", data=data, room=sid, namespace=GAME_NS)
@@ -2,6 +2,7 @@ import auth
 from api.socket.constants import GAME_NS
 from app import app, sio
 from models import Marker, PlayerRoom
+from models.db import run_db
 from state.game import game_state
 
 
@@ -10,12 +11,15 @@ from state.game import game_state
 async def new_marker(sid: str, data):
     pr: PlayerRoom = game_state.get(sid)
 
-    marker = Marker.get_or_none(shape=data, user=pr.player)
+    def create():
+        marker = Marker.get_or_none(shape=data, user=pr.player)
 
-    if marker is not None:
-        return
+        if marker is not None:
+            return
 
-    Marker.create(shape=data, user=pr.player, location=pr.active_location)
+        Marker.create(shape=data, user=pr.player, location=pr.active_location)
+
+    await run_db(create)
 
 
 @sio.on("Marker.Remove", namespace=GAME_NS)
@@ -23,8 +27,11 @@ async def new_marker(sid: str, data):
 async def delete_marker(sid: str, uuid: str):
     pr: PlayerRoom = game_state.get(sid)
 
-    marker = Marker.get_or_none(shape_id=uuid, user=pr.player)
-    if not marker:
-        return
+    def remove():
+        marker = Marker.get_or_none(shape_id=uuid, user=pr.player)
+        if not marker:
+            return
+
+        marker.delete_instance()
 
-    marker.delete_instance()
+    await run_db(remove)
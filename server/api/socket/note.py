@@ -4,7 +4,7 @@ import auth
 from api.socket.constants import GAME_NS
 from app import app, sio
 from models import Note, PlayerRoom
-from models.db import db
+from models.db import db, run_db
 from state.game import game_state
 from utils import logger
 
@@ -14,20 +14,23 @@ from utils import logger
 async def new_note(sid: str, data: Dict[str, Any]):
     pr: PlayerRoom = game_state.get(sid)
 
-    if Note.get_or_none(uuid=data["uuid"]):
-        logger.warning(
-            f"{pr.player.name} tried to overwrite existing note with id: '{data['uuid']}'"
+    def create():
+        if Note.get_or_none(uuid=data["uuid"]):
+            logger.warning(
+                f"{pr.player.name} tried to overwrite existing note with id: '{data['uuid']}'"
+            )
+            return
+
+        Note.create(
+            uuid=data["uuid"],
+            title=data["title"],
+            text=data["text"],
+            user=pr.player,
+            room=pr.room,
+            location=pr.active_location,
         )
-        return
 
-    Note.create(
-        uuid=data["uuid"],
-        title=data["title"],
-        text=data["text"],
-        user=pr.player,
-        room=pr.room,
-        location=pr.active_location,
-    )
+    await run_db(create)
 
 
 @sio.on("Note.Update", namespace=GAME_NS)
@@ -35,21 +38,26 @@ async def new_note(sid: str, data: Dict[str, Any]):
 async def update_note(sid: str, data: Dict[str, Any]):
     pr: PlayerRoom = game_state.get(sid)
 
-    note = Note.get_or_none(uuid=data["uuid"])
+    def update():
+        note = Note.get_or_none(uuid=data["uuid"])
 
-    if not note:
-        logger.warning(
-            f"{pr.player.name} tried to update non-existant note with id: '{data['uuid']}'"
-        )
-        return
+        if not note:
+            logger.warning(
+                f"{pr.player.name} tried to update non-existant note with id: '{data['uuid']}'"
+            )
+            return
+
+        if note.user_id != pr.player.id:
+            logger.warn(
+                f"{pr.player.name} tried to update note not belonging to him/her."
+            )
+        else:
+            with db.atomic():
+                note.title = data["title"]
+                note.text = data["text"]
+                note.save()
 
-    if note.user != pr.player:
-        logger.warn(f"{pr.player.name} tried to update note not belonging to him/her.")
-    else:
-        with db.atomic():
-            note.title = data["title"]
-            note.text = data["text"]
-            note.save()
+    await run_db(update)
 
 
 @sio.on("Note.Remove", namespace=GAME_NS)
@@ -57,12 +65,15 @@ async def update_note(sid: str, data: Dict[str, Any]):
 async def delete_note(sid, uuid):
     pr: PlayerRoom = game_state.get(sid)
 
-    note = Note.get_or_none(uuid=uuid)
+    def remove():
+        note = Note.get_or_none(uuid=uuid)
 
-    if not note:
-        logger.warning(
-            f"{pr.player.name} tried to remove non-existant note with id: '{uuid}'"
-        )
-        return
+        if not note:
+            logger.warning(
+                f"{pr.player.name} tried to remove non-existant note with id: '{uuid}'"
+            )
+            return
+
+        note.delete_instance()
 
-    note.delete_instance()
+    await run_db(remove)
@@ -1,11 +1,14 @@
+from typing import List, Tuple
+
 from typing_extensions import TypedDict
 
 import auth
 from api.socket.constants import GAME_NS
 from app import app, sio
-from models import PlayerRoom
+from models import PlayerRoom, User
+from models.db import run_db
 from models.role import Role
-from state.game import game_state
+from state.game import disconnect_players, game_state, get_campaign_user_room
 from utils import logger
 
 
@@ -50,13 +53,25 @@ async def set_player_role(sid: str, data: PlayerRoleChange):
 
     new_role = Role(data["role"])
 
-    player_pr: PlayerRoom = PlayerRoom.get(player=data["player"], room=pr.room)
-    player_pr.role = new_role
-    player_pr.save()
-
-    for sid in game_state.get_sids(player=player_pr.player, room=pr.room):
-        await sio.disconnect(sid, namespace=GAME_NS)
-
-    for psid in game_state.get_sids(room=pr.room):
-        if game_state.get(psid).role == Role.DM:
-            await sio.emit("Player.Role.Set", data, room=psid, namespace=GAME_NS)
+    def set_role() -> Tuple[User, List[User]]:
+        player_pr: PlayerRoom = PlayerRoom.get(player=data["player"], room=pr.room)
+        player_pr.role = new_role
+        player_pr.save()
+        dms = [
+            room_player.player
+            for room_player in pr.room.players
+            if room_player.role == Role.DM
+        ]
+        return player_pr.player, dms
+
+    player, dms = await run_db(set_role)
+
+    await disconnect_players(pr.room, player)
+
+    for dm in dms:
+        await sio.emit(
+            "Player.Role.Set",
+            data,
+            room=get_campaign_user_room(pr.room, dm),
+            namespace=GAME_NS,
+        )
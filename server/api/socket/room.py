@@ -3,9 +3,11 @@ import uuid
 import auth
 from api.socket.constants import GAME_NS
 from app import app, sio
-from models import PlayerRoom
+from models import PlayerRoom, User
+from models.db import run_db
 from models.role import Role
-from state.game import game_state
+from state.game import disconnect_players, game_state
+from state.room import room_state
 from utils import logger
 
 
@@ -19,7 +21,7 @@ async def refresh_invite_code(sid: str):
         return
 
     pr.room.invitation_code = uuid.uuid4()
-    pr.room.save()
+    await run_db(pr.room.save)
 
     await sio.emit(
         "Room.Info.InvitationCode.Set",
@@ -28,6 +30,7 @@ async def refresh_invite_code(sid: str):
         namespace=GAME_NS,
     )
 
+
 @sio.on("Room.Info.Players.Kick", namespace=GAME_NS)
 @auth.login_required(app, sio)
 async def kick_player(sid: str, player_id: int):
@@ -37,11 +40,15 @@ async def kick_player(sid: str, player_id: int):
         logger.warning(f"{pr.player.name} attempted to refresh the invitation code.")
         return
 
-    pr = PlayerRoom.get_or_none(player=player_id, room=pr.room)
-    if pr:
-        for psid in game_state.get_sids(player=pr.player, room=pr.room):
-            await sio.disconnect(psid, namespace=GAME_NS)
-        pr.delete_instance(True)
+    kicked_pr = await run_db(
+        PlayerRoom.select(PlayerRoom, User)
+        .join(User)
+        .where((PlayerRoom.player == player_id) & (PlayerRoom.room == pr.room))
+        .first
+    )
+    if kicked_pr:
+        await disconnect_players(pr.room, kicked_pr.player)
+        await run_db(kicked_pr.delete_instance, True)
 
 
 @sio.on("Room.Delete", namespace=GAME_NS)
@@ -53,7 +60,8 @@ async def delete_session(sid: str):
         logger.warning(f"{pr.player.name} attempted to REMOVE A SESSION.")
         return
 
-    pr.room.delete_instance(True)
+    await run_db(room_state.drop, pr.room)
+    await run_db(pr.room.delete_instance, True)
 
 
 @sio.on("Room.Info.Set.Locked", namespace=GAME_NS)
@@ -66,7 +74,5 @@ async def set_locked_game_state(sid: str, is_locked: bool):
         return
 
     pr.room.is_locked = is_locked
-    pr.room.save()
-    for psid in game_state.get_sids(room=pr.room):
-        if game_state.get(psid).role != Role.DM:
-            await sio.disconnect(psid, namespace=GAME_NS)
+    await run_db(pr.room.save)
+    await disconnect_players(pr.room)
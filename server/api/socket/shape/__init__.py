@@ -1,6 +1,4 @@
-from typing import Any, Dict, List, Tuple, Union
-
-from peewee import Case
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import auth
 from api.socket.constants import GAME_NS
@@ -23,14 +21,18 @@ from models import (
     User,
 )
 from models.campaign import Location
-from models.db import db
+from models.db import db, run_db
 from models.role import Role
 from models.shape.access import has_ownership
+from models.shape.bulk import delete_shapes, move_shapes_to_floor
+from models.shape.order import get_next_index, set_order_position
 from models.utils import get_table, reduce_data_to_model
-from state.game import game_state
+from state.game import game_state, get_role_room
+from state.room import room_state
 from utils import logger
 
 from . import access, options, toggle_composite
+from .position import position_broadcaster
 
 
 @sio.on("Shape.Add", namespace=GAME_NS)
@@ -41,23 +43,28 @@ async def add_shape(sid: str, data: ShapeAdd):
     if "temporary" not in data:
         data["temporary"] = False
 
-    try:
-        floor = pr.active_location.floors.select().where(
-            Floor.name == data["shape"]["floor"]
-        )[0]
-        layer = floor.layers.where(Layer.name == data["shape"]["layer"])[0]
-    except IndexError:
-        return
+    def create_shape() -> Optional[Tuple[Layer, Optional[Shape]]]:
+        try:
+            floor = pr.active_location.floors.select().where(
+                Floor.name == data["shape"]["floor"]
+            )[0]
+        except IndexError:
+            return None
+        layer = room_state.get_or_none(
+            pr.room, Layer, floor=floor, name=data["shape"]["layer"]
+        )
+        if layer is None:
+            return None
+
+        if pr.role != Role.DM and not layer.player_editable:
+            logger.warning(f"{pr.player.name} attempted to add a shape to a dm layer")
+            return None
+        if data["temporary"]:
+            return layer, None
 
-    if pr.role != Role.DM and not layer.player_editable:
-        logger.warning(f"{pr.player.name} attempted to add a shape to a dm layer")
-        return
-    if data["temporary"]:
-        game_state.add_temp(sid, data["shape"]["uuid"])
-    else:
         with db.atomic():
             data["shape"]["layer"] = layer
-            data["shape"]["index"] = layer.shapes.count()
+            data["shape"]["index"] = get_next_index(layer)
             # Shape itself
             shape = Shape.create(**reduce_data_to_model(Shape, data["shape"]))
             # Subshape
@@ -88,19 +95,31 @@ async def add_shape(sid: str, data: ShapeAdd):
             # Auras
             for aura in data["shape"]["auras"]:
                 Aura.create(**reduce_data_to_model(Aura, aura))
+        return layer, shape
+
+    created = await run_db(create_shape)
+    if created is None:
+        return
+    layer, shape = created
+    if shape is None:
+        game_state.add_temp(sid, data["shape"]["uuid"])
 
-    for room_player in pr.room.players:
-        is_dm = room_player.role == Role.DM
-        for psid in game_state.get_sids(
-            player=room_player.player, active_location=pr.active_location
+    def get_payloads() -> List[Tuple[str, Any]]:
+        payloads = []
+        for room, audience_pr in game_state.get_audiences(
+            pr.active_location, skip_sid=sid
         ):
-            if psid == sid:
-                continue
+            is_dm = audience_pr.role == Role.DM
             if not is_dm and not layer.player_visible:
                 continue
-            if not data["temporary"]:
-                data["shape"] = shape.as_dict(room_player.player, is_dm)
-            await sio.emit("Shape.Add", data["shape"], room=psid, namespace=GAME_NS)
+            if shape is None:
+                payloads.append((room, data["shape"]))
+            else:
+                payloads.append((room, shape.as_dict(audience_pr.player, is_dm)))
+        return payloads
+
+    for room, payload in await run_db(get_payloads):
+        await sio.emit("Shape.Add", payload, room=room, skip_sid=sid, namespace=GAME_NS)
 
 
 @sio.on("Shapes.Position.Update", namespace=GAME_NS)
@@ -108,38 +127,20 @@ async def add_shape(sid: str, data: ShapeAdd):
 async def update_shape_positions(sid: str, data: PositionUpdateList):
     pr: PlayerRoom = game_state.get(sid)
 
-    shapes: List[Tuple[Shape, PositionUpdate]] = []
+    def check_ownership() -> bool:
+        for sh in data["shapes"]:
+            shape = room_state.get_or_none(pr.room, Shape, uuid=sh["uuid"])
+            if shape is not None and not has_ownership(shape, pr, movement=True):
+                logger.warning(
+                    f"User {pr.player.name} attempted to move a shape it does not own."
+                )
+                return False
+        return True
 
-    for sh in data["shapes"]:
-        shape = Shape.get_or_none(Shape.uuid == sh["uuid"])
-        if shape is not None and not has_ownership(shape, pr, movement=True):
-            logger.warning(
-                f"User {pr.player.name} attempted to move a shape it does not own."
-            )
-            return
-        shapes.append((shape, sh))
+    if not await run_db(check_ownership):
+        return
 
-    if not data["temporary"]:
-        with db.atomic():
-            for db_shape, data_shape in shapes:
-                points = data_shape["position"]["points"]
-                db_shape.x = points[0][0]
-                db_shape.y = points[0][1]
-                db_shape.angle = data_shape["position"]["angle"]
-                db_shape.save()
-
-                if len(points) > 1:
-                    # Subshape
-                    type_instance = db_shape.subtype
-                    type_instance.set_location(points[1:])
-
-    await sio.emit(
-        "Shapes.Position.Update",
-        data["shapes"],
-        room=pr.active_location.get_path(),
-        skip_sid=sid,
-        namespace=GAME_NS,
-    )
+    position_broadcaster.add(sid, pr, data["shapes"], data["temporary"])
 
 
 @sio.on("Shapes.Remove", namespace=GAME_NS)
@@ -152,37 +153,41 @@ async def remove_shapes(sid: str, data: TemporaryShapesList):
         for shape in data["uuids"]:
             game_state.remove_temp(sid, shape)
     else:
-        # Use the server version of the shapes.
-        try:
-            shapes: List[Shape] = [
-                s for s in Shape.select().where(Shape.uuid << data["uuids"])
-            ]
-        except Shape.DoesNotExist:
-            logger.warning(f"Attempt to update unknown shape by {pr.player.name}")
-            return
 
-        layer = shapes[0].layer
+        def remove() -> bool:
+            room_state.forget(pr.room, data["uuids"])
+            # Use the server version of the shapes.
+            try:
+                shapes: List[Shape] = [
+                    s for s in Shape.select().where(Shape.uuid << data["uuids"])
+                ]
+            except Shape.DoesNotExist:
+                logger.warning(f"Attempt to update unknown shape by {pr.player.name}")
+                return False
+
+            group_ids = set()
+
+            for shape in shapes:
+                if not has_ownership(shape, pr):
+                    logger.warning(
+                        f"User {pr.player.name} tried to update a shape it does not own."
+                    )
+                    return False
 
-        group_ids = set()
+                if shape.group_id:
+                    group_ids.add(shape.group_id)
 
-        for shape in shapes:
-            if not has_ownership(shape, pr):
-                logger.warning(
-                    f"User {pr.player.name} tried to update a shape it does not own."
-                )
-                return
+            delete_shapes([shape.uuid for shape in shapes])
 
-            if shape.group:
-                group_ids.add(shape.group)
+            for group_id in group_ids:
+                remove_group_if_empty(group_id)
+            return True
 
-            old_index = shape.index
-            shape.delete_instance(True)
-            Shape.update(index=Shape.index - 1).where(
-                (Shape.layer == layer) & (Shape.index >= old_index)
-            ).execute()
+        if not await run_db(remove):
+            return
 
-        for group_id in group_ids:
-            await remove_group_if_empty(group_id)
+    # Coalesced positions of the shapes should not reach the clients after their removal
+    position_broadcaster.discard_shapes(data["uuids"])
 
     await sio.emit(
         "Shapes.Remove",
@@ -202,20 +207,21 @@ async def change_shape_floor(sid: str, data: ShapeFloorChange):
         logger.warning(f"{pr.player.name} attempted to move the floor of a shape")
         return
 
-    floor: Floor = Floor.get(location=pr.active_location, name=data["floor"])
-    shapes: List[Shape] = [s for s in Shape.select().where(Shape.uuid << data["uuids"])]
-    layer: Layer = Layer.get(floor=floor, name=shapes[0].layer.name)
-    old_layer = shapes[0].layer
+    def change_floor():
+        room_state.forget(pr.room, data["uuids"])
+        floor: Floor = Floor.get(location=pr.active_location, name=data["floor"])
+        shapes: List[Shape] = [
+            s for s in Shape.select().where(Shape.uuid << data["uuids"])
+        ]
+        layer = room_state.get(pr.room, Layer, floor=floor, name=shapes[0].layer.name)
 
-    for shape in shapes:
-        old_index = shape.index
-        shape.layer = layer
-        shape.index = layer.shapes.count()
-        shape.save()
+        for shape in shapes:
+            shape.layer = layer
+            shape.index = get_next_index(layer)
+            shape.save()
 
-        Shape.update(index=Shape.index - 1).where(
-            (Shape.layer == old_layer) & (Shape.index >= old_index)
-        ).execute()
+    await position_broadcaster.flush_shapes(data["uuids"])
+    await run_db(change_floor)
 
     await sio.emit(
         "Shapes.Floor.Change",
@@ -235,38 +241,48 @@ async def change_shape_layer(sid: str, data: Dict[str, Any]):
         logger.warning(f"{pr.player.name} attempted to move the layer of a shape")
         return
 
-    floor = Floor.get(location=pr.active_location, name=data["floor"])
-    shapes: List[Shape] = [s for s in Shape.select().where(Shape.uuid << data["uuids"])]
-    layer = Layer.get(floor=floor, name=data["layer"])
-    old_layer = shapes[0].layer
+    def change_layer() -> Tuple[bool, bool, List[Tuple[str, bool, List[Any]]]]:
+        room_state.forget(pr.room, data["uuids"])
+        floor = Floor.get(location=pr.active_location, name=data["floor"])
+        shapes: List[Shape] = [
+            s for s in Shape.select().where(Shape.uuid << data["uuids"])
+        ]
+        layer = room_state.get(pr.room, Layer, floor=floor, name=data["layer"])
+        old_layer = shapes[0].layer
 
-    if old_layer.player_visible and not layer.player_visible:
-        for room_player in pr.room.players:
-            if room_player.role == Role.DM:
-                continue
-            for psid in game_state.get_sids(
-                player=room_player.player,
-                active_location=pr.active_location,
-                skip_sid=sid,
+        for shape in shapes:
+            shape.layer = layer
+            shape.index = get_next_index(layer)
+            shape.save()
+
+        audiences = []
+        if not (old_layer.player_visible and layer.player_visible):
+            for room, audience_pr in game_state.get_audiences(
+                pr.active_location, skip_sid=sid
             ):
-                await sio.emit(
-                    "Shapes.Remove",
-                    data["uuids"],
-                    room=psid,
-                    namespace=GAME_NS,
-                )
-
-    for shape in shapes:
-        old_index = shape.index
-
-        shape.layer = layer
-        shape.index = layer.shapes.count()
-        shape.save()
-        Shape.update(index=Shape.index - 1).where(
-            (Shape.layer == old_layer) & (Shape.index >= old_index)
-        ).execute()
+                is_dm = audience_pr.role == Role.DM
+                payload = []
+                if not is_dm and layer.player_visible:
+                    payload = [
+                        shape.as_dict(audience_pr.player, False) for shape in shapes
+                    ]
+                audiences.append((room, is_dm, payload))
+        return old_layer.player_visible, layer.player_visible, audiences
+
+    await position_broadcaster.flush_shapes(data["uuids"])
+    was_visible, is_visible, audiences = await run_db(change_layer)
+
+    if was_visible and not is_visible:
+        for role in (Role.PLAYER, Role.SPECTATOR):
+            await sio.emit(
+                "Shapes.Remove",
+                data["uuids"],
+                room=get_role_room(pr.active_location, role),
+                skip_sid=sid,
+                namespace=GAME_NS,
+            )
 
-    if old_layer.player_visible and layer.player_visible:
+    if was_visible and is_visible:
         await sio.emit(
             "Shapes.Layer.Change",
             data,
@@ -275,28 +291,23 @@ async def change_shape_layer(sid: str, data: Dict[str, Any]):
             namespace=GAME_NS,
         )
     else:
-        for room_player in pr.room.players:
-            is_dm = room_player.role == Role.DM
-            for psid in game_state.get_sids(
-                player=room_player.player,
-                active_location=pr.active_location,
-                skip_sid=sid,
-            ):
-                if is_dm:
-                    await sio.emit(
-                        "Shapes.Layer.Change",
-                        data,
-                        room=psid,
-                        skip_sid=sid,
-                        namespace=GAME_NS,
-                    )
-                elif layer.player_visible:
-                    await sio.emit(
-                        "Shapes.Add",
-                        [shape.as_dict(room_player.player, False) for shape in shapes],
-                        room=psid,
-                        namespace=GAME_NS,
-                    )
+        for room, is_dm, payload in audiences:
+            if is_dm:
+                await sio.emit(
+                    "Shapes.Layer.Change",
+                    data,
+                    room=room,
+                    skip_sid=sid,
+                    namespace=GAME_NS,
+                )
+            elif is_visible:
+                await sio.emit(
+                    "Shapes.Add",
+                    payload,
+                    room=room,
+                    skip_sid=sid,
+                    namespace=GAME_NS,
+                )
 
 
 @sio.on("Shape.Order.Set", namespace=GAME_NS)
@@ -304,7 +315,7 @@ async def change_shape_layer(sid: str, data: Dict[str, Any]):
 async def move_shape_order(sid: str, data: ShapeOrder):
     pr: PlayerRoom = game_state.get(sid)
 
-    if not data["temporary"]:
+    def set_order() -> bool:
         shape = Shape.get(uuid=data["uuid"])
         layer = shape.layer
 
@@ -312,22 +323,13 @@ async def move_shape_order(sid: str, data: ShapeOrder):
             logger.warning(
                 f"{pr.player.name} attempted to move a shape order on a dm layer"
             )
-            return
+            return False
 
-        target = data["index"]
-        sign = 1 if target < shape.index else -1
-        case = Case(
-            None,
-            (
-                (Shape.index == shape.index, target),
-                (
-                    (sign * Shape.index) < (sign * shape.index),
-                    (Shape.index + (sign * 1)),
-                ),
-            ),
-            Shape.index,
-        )
-        Shape.update(index=case).where(Shape.layer == layer).execute()
+        set_order_position(shape, data["index"])
+        return True
+
+    if not data["temporary"] and not await run_db(set_order):
+        return
 
     await sio.emit(
         "Shape.Order.Set",
@@ -347,30 +349,46 @@ async def move_shapes(sid: str, data: ServerShapeLocationMove):
         logger.warning(f"{pr.player.name} attempted to move shape locations")
         return
 
-    location = Location.get_by_id(data["target"]["location"])
-    floor = location.floors.select().where(Floor.name == data["target"]["floor"])[0]
-    x = data["target"]["x"]
-    y = data["target"]["y"]
+    await position_broadcaster.flush_shapes(data["shapes"])
+    await position_broadcaster.persist(pr.room_id)
+
+    def move() -> Tuple[List[str], List[Tuple[str, List[Any]]]]:
+        location = Location.get_by_id(data["target"]["location"])
+        floor = location.floors.select().where(Floor.name == data["target"]["floor"])[0]
+        x = data["target"]["x"]
+        y = data["target"]["y"]
+
+        room_state.forget(pr.room, data["shapes"])
+        shapes = move_shapes_to_floor(data["shapes"], floor, x, y)
+
+        return (
+            [sh.uuid for sh in shapes],
+            [
+                (
+                    room,
+                    [
+                        sh.as_dict(audience_pr.player, audience_pr.role == Role.DM)
+                        for sh in shapes
+                    ],
+                )
+                for room, audience_pr in game_state.get_audiences(location)
+            ],
+        )
 
-    shapes = [Shape.get_by_id(sh) for sh in data["shapes"]]
+    uuids, payloads = await run_db(move)
 
     await sio.emit(
         "Shapes.Remove",
-        [sh.uuid for sh in shapes],
+        uuids,
         room=pr.active_location.get_path(),
         namespace=GAME_NS,
     )
 
-    for shape in shapes:
-        shape.layer = floor.layers.where(Layer.name == shape.layer.name)[0]
-        shape.center_at(x, y)
-        shape.save()
-
-    for psid, player in game_state.get_users(active_location=location):
+    for room, payload in payloads:
         await sio.emit(
             "Shapes.Add",
-            [sh.as_dict(player, game_state.get(psid).role == Role.DM) for sh in shapes],
-            room=psid,
+            payload,
+            room=room,
             namespace=GAME_NS,
         )
 
@@ -380,10 +398,13 @@ async def move_shapes(sid: str, data: ServerShapeLocationMove):
 async def set_text_value(sid: str, data: TextUpdateData):
     pr: PlayerRoom = game_state.get(sid)
 
-    if not data["temporary"]:
-        shape: Text = Text.get_by_id(data["uuid"])
+    def set_text():
+        shape: Text = room_state.get(pr.room, Text, shape=data["uuid"])
         shape.text = data["text"]
-        shape.save()
+        room_state.save(pr.room, shape)
+
+    if not data["temporary"]:
+        await run_db(set_text)
 
     await sio.emit(
         "Shape.Text.Value.Set",
@@ -399,15 +420,18 @@ async def set_text_value(sid: str, data: TextUpdateData):
 async def update_rect_size(sid: str, data: RectSizeData):
     pr: PlayerRoom = game_state.get(sid)
 
-    if not data["temporary"]:
+    def set_size():
         shape: Union[AssetRect, Rect]
         try:
-            shape = AssetRect.get_by_id(data["uuid"])
+            shape = room_state.get(pr.room, AssetRect, shape=data["uuid"])
         except AssetRect.DoesNotExist:
-            shape = Rect.get_by_id(data["uuid"])
+            shape = room_state.get(pr.room, Rect, shape=data["uuid"])
         shape.width = data["w"]
         shape.height = data["h"]
-        shape.save()
+        room_state.save(pr.room, shape)
+
+    if not data["temporary"]:
+        await run_db(set_size)
 
     await sio.emit(
         "Shape.Rect.Size.Update",
@@ -423,14 +447,17 @@ async def update_rect_size(sid: str, data: RectSizeData):
 async def update_circle_size(sid: str, data: CircleSizeData):
     pr: PlayerRoom = game_state.get(sid)
 
-    if not data["temporary"]:
+    def set_size():
         shape: Union[Circle, CircularToken]
         try:
-            shape = CircularToken.get_by_id(data["uuid"])
+            shape = room_state.get(pr.room, CircularToken, shape=data["uuid"])
         except CircularToken.DoesNotExist:
-            shape = Circle.get_by_id(data["uuid"])
+            shape = room_state.get(pr.room, Circle, shape=data["uuid"])
         shape.radius = data["r"]
-        shape.save()
+        room_state.save(pr.room, shape)
+
+    if not data["temporary"]:
+        await run_db(set_size)
 
     await sio.emit(
         "Shape.Circle.Size.Update",
@@ -446,11 +473,14 @@ async def update_circle_size(sid: str, data: CircleSizeData):
 async def update_text_size(sid: str, data: TextSizeData):
     pr: PlayerRoom = game_state.get(sid)
 
-    if not data["temporary"]:
-        shape = Text.get_by_id(data["uuid"])
+    def set_size():
+        shape = room_state.get(pr.room, Text, shape=data["uuid"])
 
         shape.font_size = data["font_size"]
-        shape.save()
+        room_state.save(pr.room, shape)
+
+    if not data["temporary"]:
+        await run_db(set_size)
 
     await sio.emit(
         "Shape.Text.Size.Update",
@@ -466,22 +496,30 @@ async def update_text_size(sid: str, data: TextSizeData):
 async def update_shape_options(sid: str, data: OptionUpdateList):
     pr: PlayerRoom = game_state.get(sid)
 
-    shapes: List[Tuple[Shape, OptionUpdate]] = []
+    def update_options() -> bool:
+        shapes: List[Tuple[Shape, OptionUpdate]] = []
 
-    for sh in data["options"]:
-        shape = Shape.get_or_none(Shape.uuid == sh["uuid"])
-        if shape is not None and not has_ownership(shape, pr, movement=True):
-            logger.warning(
-                f"User {pr.player.name} attempted to change options for a shape it does not own."
-            )
-            return
-        shapes.append((shape, sh))
+        for sh in data["options"]:
+            shape = room_state.get_or_none(pr.room, Shape, uuid=sh["uuid"])
+            if shape is None:
+                # Temporary shapes are not stored
+                continue
+            if not has_ownership(shape, pr, movement=True):
+                logger.warning(
+                    f"User {pr.player.name} attempted to change options for a shape it does not own."
+                )
+                return False
+            shapes.append((shape, sh))
 
-    if not data["temporary"]:
-        with db.atomic():
-            for db_shape, data_shape in shapes:
-                db_shape.options = data_shape["option"]
-                db_shape.save()
+        if not data["temporary"]:
+            with db.atomic():
+                for db_shape, data_shape in shapes:
+                    db_shape.options = data_shape["option"]
+                    room_state.save(pr.room, db_shape)
+        return True
+
+    if not await run_db(update_options):
+        return
 
     await sio.emit(
         "Shapes.Options.Update",
@@ -1,12 +1,17 @@
+from typing import Any, Dict, List, Optional, Tuple
+
 import auth
 from api.socket.constants import GAME_NS
 from api.socket.initiative import send_client_initiatives
 from api.socket.shape.data_models import ServerShapeDefaultOwner, ServerShapeOwner
 from app import app, sio
 from models import PlayerRoom, Shape, ShapeOwner, User
+from models.db import run_db
 from models.role import Role
-from models.shape.access import has_ownership
-from state.game import game_state
+from models.shape.access import has_ownership, permission_index
+from models.shape.cache import shape_payloads
+from state.game import game_state, get_user_room
+from state.room import room_state
 from utils import logger
 
 
@@ -15,39 +20,47 @@ from utils import logger
 async def add_shape_owner(sid: str, data: ServerShapeOwner):
     pr: PlayerRoom = game_state.get(sid)
 
-    try:
-        shape = Shape.get(uuid=data["shape"])
-    except Shape.DoesNotExist as exc:
-        logger.warning(
-            f"Attempt to add owner to unknown shape by {pr.player.name} [{data['shape']}]"
-        )
-        raise exc
+    def add_owner() -> Optional[Tuple[Shape, User]]:
+        try:
+            shape = room_state.get(pr.room, Shape, uuid=data["shape"])
+        except Shape.DoesNotExist as exc:
+            logger.warning(
+                f"Attempt to add owner to unknown shape by {pr.player.name} [{data['shape']}]"
+            )
+            raise exc
 
-    if not has_ownership(shape, pr):
-        logger.warning(
-            f"{pr.player.name} attempted to change asset ownership of a shape it does not own"
-        )
-        return
+        if not has_ownership(shape, pr):
+            logger.warning(
+                f"{pr.player.name} attempted to change asset ownership of a shape it does not own"
+            )
+            return None
 
-    target_user = User.by_name(data["user"])
-    if target_user is None:
-        logger.warning(
-            f"Attempt to add unknown user as owner to shape by {pr.player.name} [{data['user']}]"
-        )
-        return
+        target_user = User.by_name(data["user"])
+        if target_user is None:
+            logger.warning(
+                f"Attempt to add unknown user as owner to shape by {pr.player.name} [{data['user']}]"
+            )
+            return None
+
+        # Adding the DM as user is redundant and can only lead to confusion
+        if PlayerRoom.get(room=pr.room, player=target_user).role == Role.DM:
+            return None
+
+        if not ShapeOwner.get_or_none(shape=shape, user=target_user):
+            ShapeOwner.create(
+                shape=shape,
+                user=target_user,
+                edit_access=data["edit_access"],
+                movement_access=data["movement_access"],
+                vision_access=data["vision_access"],
+            )
+        return shape, target_user
 
-    # Adding the DM as user is redundant and can only lead to confusion
-    if PlayerRoom.get(room=pr.room, player=target_user).role == Role.DM:
+    result = await run_db(add_owner)
+    if result is None:
         return
+    shape, target_user = result
 
-    if not ShapeOwner.get_or_none(shape=shape, user=target_user):
-        ShapeOwner.create(
-            shape=shape,
-            user=target_user,
-            edit_access=data["edit_access"],
-            movement_access=data["movement_access"],
-            vision_access=data["vision_access"],
-        )
     await send_client_initiatives(pr, target_user)
     await sio.emit(
         "Shape.Owner.Add",
@@ -57,15 +70,12 @@ async def add_shape_owner(sid: str, data: ServerShapeOwner):
         namespace=GAME_NS,
     )
     if not (shape.default_vision_access or shape.default_edit_access):
-        for sid in game_state.get_sids(
-            player=target_user, active_location=pr.active_location
-        ):
-            await sio.emit(
-                "Shape.Set",
-                shape.as_dict(target_user, False),
-                room=sid,
-                namespace=GAME_NS,
-            )
+        await sio.emit(
+            "Shape.Set",
+            await run_db(shape.as_dict, target_user, False),
+            room=get_user_room(pr.active_location, target_user),
+            namespace=GAME_NS,
+        )
 
 
 @sio.on("Shape.Owner.Update", namespace=GAME_NS)
@@ -73,41 +83,46 @@ async def add_shape_owner(sid: str, data: ServerShapeOwner):
 async def update_shape_owner(sid: str, data: ServerShapeOwner):
     pr: PlayerRoom = game_state.get(sid)
 
-    try:
-        shape = Shape.get(uuid=data["shape"])
-    except Shape.DoesNotExist as exc:
-        logger.warning(
-            f"Attempt to update owner of unknown shape by {pr.player.name} [{data['shape']}]"
-        )
-        raise exc
+    def update_owner() -> bool:
+        try:
+            shape = room_state.get(pr.room, Shape, uuid=data["shape"])
+        except Shape.DoesNotExist as exc:
+            logger.warning(
+                f"Attempt to update owner of unknown shape by {pr.player.name} [{data['shape']}]"
+            )
+            raise exc
 
-    if not has_ownership(shape, pr):
-        logger.warning(
-            f"{pr.player.name} attempted to change asset ownership of a shape it does not own"
-        )
-        return
+        if not has_ownership(shape, pr):
+            logger.warning(
+                f"{pr.player.name} attempted to change asset ownership of a shape it does not own"
+            )
+            return False
 
-    target_user = User.by_name(data["user"])
-    if target_user is None:
-        logger.warning(
-            f"Attempt to update unknown user as owner to shape by {pr.player.name} [{data['user']}]"
-        )
-        return
+        target_user = User.by_name(data["user"])
+        if target_user is None:
+            logger.warning(
+                f"Attempt to update unknown user as owner to shape by {pr.player.name} [{data['user']}]"
+            )
+            return False
 
-    try:
-        so = ShapeOwner.get(shape=shape, user=target_user)
-    except ShapeOwner.DoesNotExist as exc:
-        logger.warning(
-            f"Attempt to update unknown shape-owner relation by {pr.player.name}"
-        )
-        return
+        try:
+            so = ShapeOwner.get(shape=shape, user=target_user)
+        except ShapeOwner.DoesNotExist as exc:
+            logger.warning(
+                f"Attempt to update unknown shape-owner relation by {pr.player.name}"
+            )
+            return False
+
+        so.shape = shape
+        so.user = target_user
+        so.edit_access = data["edit_access"]
+        so.movement_access = data["movement_access"]
+        so.vision_access = data["vision_access"]
+        so.save()
+        return True
 
-    so.shape = shape
-    so.user = target_user
-    so.edit_access = data["edit_access"]
-    so.movement_access = data["movement_access"]
-    so.vision_access = data["vision_access"]
-    so.save()
+    if not await run_db(update_owner):
+        return
 
     await sio.emit(
         "Shape.Owner.Update",
@@ -123,34 +138,41 @@ async def update_shape_owner(sid: str, data: ServerShapeOwner):
 async def delete_shape_owner(sid: str, data: ServerShapeOwner):
     pr: PlayerRoom = game_state.get(sid)
 
-    try:
-        shape = Shape.get(uuid=data["shape"])
-    except Shape.DoesNotExist as exc:
-        logger.warning(
-            f"Attempt to delete owner of unknown shape by {pr.player.name} [{data['shape']}]"
-        )
-        raise exc
+    def delete_owner() -> bool:
+        try:
+            shape = room_state.get(pr.room, Shape, uuid=data["shape"])
+        except Shape.DoesNotExist as exc:
+            logger.warning(
+                f"Attempt to delete owner of unknown shape by {pr.player.name} [{data['shape']}]"
+            )
+            raise exc
 
-    if not has_ownership(shape, pr):
-        logger.warning(
-            f"{pr.player.name} attempted to change asset ownership of a shape it does not own"
-        )
-        return
+        if not has_ownership(shape, pr):
+            logger.warning(
+                f"{pr.player.name} attempted to change asset ownership of a shape it does not own"
+            )
+            return False
 
-    target_user = User.by_name(data["user"])
-    if target_user is None:
-        logger.warning(
-            f"Attempt to delete unknown user as owner to shape by {pr.player.name} [{data['user']}]"
-        )
+        target_user = User.by_name(data["user"])
+        if target_user is None:
+            logger.warning(
+                f"Attempt to delete unknown user as owner to shape by {pr.player.name} [{data['user']}]"
+            )
+            return False
+
+        try:
+            ShapeOwner.delete().where(
+                (ShapeOwner.shape == shape) & (ShapeOwner.user == target_user)
+            ).execute()
+            shape_payloads.invalidate([shape.uuid])
+            permission_index.remove_owner(shape.uuid, target_user.id)
+        except Exception:
+            logger.warning(f"Could not delete shape-owner relation by {pr.player.name}")
+        return True
+
+    if not await run_db(delete_owner):
         return
 
-    try:
-        ShapeOwner.delete().where(
-            (ShapeOwner.shape == shape) & (ShapeOwner.user == target_user)
-        ).execute()
-    except Exception:
-        logger.warning(f"Could not delete shape-owner relation by {pr.player.name}")
-
     await sio.emit(
         "Shape.Owner.Delete",
         data,
@@ -165,40 +187,53 @@ async def delete_shape_owner(sid: str, data: ServerShapeOwner):
 async def update_default_shape_owner(sid: str, data: ServerShapeDefaultOwner):
     pr: PlayerRoom = game_state.get(sid)
 
-    try:
-        shape: Shape = Shape.get(uuid=data["shape"])
-    except Shape.DoesNotExist as exc:
-        logger.warning(
-            f"Attempt to update owner of unknown shape by {pr.player.name} [{data['shape']}]"
-        )
-        raise exc
+    def update_default_owner() -> Optional[Shape]:
+        try:
+            shape: Shape = room_state.get(pr.room, Shape, uuid=data["shape"])
+        except Shape.DoesNotExist as exc:
+            logger.warning(
+                f"Attempt to update owner of unknown shape by {pr.player.name} [{data['shape']}]"
+            )
+            raise exc
 
-    if not has_ownership(shape, pr):
-        logger.warning(
-            f"{pr.player.name} attempted to change asset ownership of a shape it does not own"
-        )
-        return
+        if not has_ownership(shape, pr):
+            logger.warning(
+                f"{pr.player.name} attempted to change asset ownership of a shape it does not own"
+            )
+            return None
+
+        if "edit_access" in data:
+            shape.default_edit_access = data["edit_access"]
 
-    if "edit_access" in data:
-        shape.default_edit_access = data["edit_access"]
+        if "vision_access" in data:
+            shape.default_vision_access = data["vision_access"]
 
-    if "vision_access" in data:
-        shape.default_vision_access = data["vision_access"]
+        if "movement_access" in data:
+            shape.default_movement_access = data["movement_access"]
 
-    if "movement_access" in data:
-        shape.default_movement_access = data["movement_access"]
+        room_state.save(pr.room, shape)
+        return shape
 
-    shape.save()
+    shape = await run_db(update_default_owner)
+    if shape is None:
+        return
 
     # We need to send each player their new view of the shape which includes the default access fields,
     # so there is no use in sending those separately
-    for sid, player in game_state.get_users(
-        active_location=pr.active_location, skip_sid=sid
-    ):
+    def get_payloads() -> List[Tuple[str, Dict[str, Any]]]:
+        return [
+            (room, shape.as_dict(audience_pr.player, audience_pr.role == Role.DM))
+            for room, audience_pr in game_state.get_audiences(
+                pr.active_location, skip_sid=sid
+            )
+        ]
+
+    for room, payload in await run_db(get_payloads):
         await sio.emit(
             "Shape.Set",
-            shape.as_dict(player, game_state.get(sid).role == Role.DM),
-            room=sid,
+            payload,
+            room=room,
+            skip_sid=sid,
             namespace=GAME_NS,
         )
-        await send_client_initiatives(pr, player)
+    await send_client_initiatives(pr, skip_sid=sid)
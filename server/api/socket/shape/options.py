@@ -1,14 +1,23 @@
+from typing import Any, Dict, List, Optional, Tuple
+
 from typing_extensions import TypedDict
 
 from playhouse.shortcuts import update_model_from_dict
 
 import auth
 from api.socket.constants import GAME_NS
-from api.socket.shape.utils import get_owner_sids, get_shape_or_none
+from api.socket.shape.utils import (
+    get_shape_audiences,
+    get_shape_or_none,
+    update_shape,
+)
 from app import app, sio
 from models import Aura, PlayerRoom, ShapeLabel, Tracker
+from models.db import run_db
+from models.shape.cache import shape_payloads
 from models.utils import reduce_data_to_model
 from state.game import game_state
+from state.room import room_state
 
 
 class ShapeSetBooleanValue(TypedDict):
@@ -70,13 +79,12 @@ class AuraDelta(AuraData, total=False):
 async def set_invisible(sid: str, data: ShapeSetBooleanValue):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "Invisible.Set")
+    shape = await run_db(
+        update_shape, pr, data["shape"], "Invisible.Set", is_invisible=data["value"]
+    )
     if shape is None:
         return
 
-    shape.is_invisible = data["value"]
-    shape.save()
-
     await sio.emit(
         "Shape.Options.Invisible.Set",
         data,
@@ -85,18 +93,18 @@ async def set_invisible(sid: str, data: ShapeSetBooleanValue):
         namespace=GAME_NS,
     )
 
+
 @sio.on("Shape.Options.Defeated.Set", namespace=GAME_NS)
 @auth.login_required(app, sio)
 async def set_defeated(sid: str, data: ShapeSetBooleanValue):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "Defeated.Set")
+    shape = await run_db(
+        update_shape, pr, data["shape"], "Defeated.Set", is_defeated=data["value"]
+    )
     if shape is None:
         return
 
-    shape.is_defeated = data["value"]
-    shape.save()
-
     await sio.emit(
         "Shape.Options.Defeated.Set",
         data,
@@ -111,13 +119,12 @@ async def set_defeated(sid: str, data: ShapeSetBooleanValue):
 async def set_locked(sid: str, data: ShapeSetBooleanValue):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "Locked.Set")
+    shape = await run_db(
+        update_shape, pr, data["shape"], "Locked.Set", is_locked=data["value"]
+    )
     if shape is None:
         return
 
-    shape.is_locked = data["value"]
-    shape.save()
-
     await sio.emit(
         "Shape.Options.Locked.Set",
         data,
@@ -132,13 +139,12 @@ async def set_locked(sid: str, data: ShapeSetBooleanValue):
 async def set_token(sid: str, data: ShapeSetBooleanValue):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "Token.Set")
+    shape = await run_db(
+        update_shape, pr, data["shape"], "Token.Set", is_token=data["value"]
+    )
     if shape is None:
         return
 
-    shape.is_token = data["value"]
-    shape.save()
-
     await sio.emit(
         "Shape.Options.Token.Set",
         data,
@@ -153,13 +159,16 @@ async def set_token(sid: str, data: ShapeSetBooleanValue):
 async def set_movement_block(sid: str, data: ShapeSetBooleanValue):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "MovementBlock.Set")
+    shape = await run_db(
+        update_shape,
+        pr,
+        data["shape"],
+        "MovementBlock.Set",
+        movement_obstruction=data["value"],
+    )
     if shape is None:
         return
 
-    shape.movement_obstruction = data["value"]
-    shape.save()
-
     await sio.emit(
         "Shape.Options.MovementBlock.Set",
         data,
@@ -174,13 +183,16 @@ async def set_movement_block(sid: str, data: ShapeSetBooleanValue):
 async def set_vision_block(sid: str, data: ShapeSetBooleanValue):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "VisionBlock.Set")
+    shape = await run_db(
+        update_shape,
+        pr,
+        data["shape"],
+        "VisionBlock.Set",
+        vision_obstruction=data["value"],
+    )
     if shape is None:
         return
 
-    shape.vision_obstruction = data["value"]
-    shape.save()
-
     await sio.emit(
         "Shape.Options.VisionBlock.Set",
         data,
@@ -195,13 +207,12 @@ async def set_vision_block(sid: str, data: ShapeSetBooleanValue):
 async def set_annotation(sid: str, data: ShapeSetStringValue):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "Annotation.Set")
+    shape = await run_db(
+        update_shape, pr, data["shape"], "Annotation.Set", annotation=data["value"]
+    )
     if shape is None:
         return
 
-    shape.annotation = data["value"]
-    shape.save()
-
     if shape.annotation_visible:
         await sio.emit(
             "Shape.Options.Annotation.Set",
@@ -211,13 +222,15 @@ async def set_annotation(sid: str, data: ShapeSetStringValue):
             namespace=GAME_NS,
         )
     else:
-        for sid in get_owner_sids(pr, shape, skip_sid=sid):
-            await sio.emit(
-                "Shape.Options.Annotation.Set",
-                data,
-                room=sid,
-                namespace=GAME_NS,
-            )
+        for room, owner in await run_db(get_shape_audiences, pr, shape, sid):
+            if owner:
+                await sio.emit(
+                    "Shape.Options.Annotation.Set",
+                    data,
+                    room=room,
+                    skip_sid=sid,
+                    namespace=GAME_NS,
+                )
 
 
 @sio.on("Shape.Options.AnnotationVisible.Set", namespace=GAME_NS)
@@ -225,15 +238,16 @@ async def set_annotation(sid: str, data: ShapeSetStringValue):
 async def set_annotation_visible(sid: str, data: ShapeSetBooleanValue):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "AnnotationVisible.Set")
+    shape = await run_db(
+        update_shape,
+        pr,
+        data["shape"],
+        "AnnotationVisible.Set",
+        annotation_visible=data["value"],
+    )
     if shape is None:
         return
 
-    shape.annotation_visible = data["value"]
-    shape.save()
-
-    owners = [*get_owner_sids(pr, shape, skip_sid=sid)]
-
     await sio.emit(
         "Shape.Options.AnnotationVisible.Set",
         data,
@@ -242,13 +256,14 @@ async def set_annotation_visible(sid: str, data: ShapeSetBooleanValue):
         namespace=GAME_NS,
     )
 
-    for psid in game_state.get_sids(active_location=pr.active_location, skip_sid=sid):
-        if psid in owners:
+    for room, owner in await run_db(get_shape_audiences, pr, shape, sid):
+        if owner:
             continue
         await sio.emit(
             "Shape.Options.Annotation.Set",
             {"shape": shape.uuid, "value": shape.annotation if data["value"] else ""},
-            room=psid,
+            room=room,
+            skip_sid=sid,
             namespace=GAME_NS,
         )
 
@@ -258,12 +273,18 @@ async def set_annotation_visible(sid: str, data: ShapeSetBooleanValue):
 async def remove_tracker(sid: str, data: ShapeSetStringValue):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "Tracker.Remove")
-    if shape is None:
-        return
+    def remove() -> bool:
+        shape = get_shape_or_none(pr, data["shape"], "Tracker.Remove")
+        if shape is None:
+            return False
 
-    tracker: Tracker = Tracker.get_by_id(data["value"])
-    tracker.delete_instance(True)
+        tracker = room_state.get(pr.room, Tracker, uuid=data["value"])
+        room_state.forget(pr.room, [tracker.uuid])
+        tracker.delete_instance(True)
+        return True
+
+    if not await run_db(remove):
+        return
 
     await sio.emit(
         "Shape.Options.Tracker.Remove",
@@ -279,12 +300,18 @@ async def remove_tracker(sid: str, data: ShapeSetStringValue):
 async def remove_aura(sid: str, data: ShapeSetStringValue):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "Aura.Remove")
-    if shape is None:
-        return
+    def remove() -> bool:
+        shape = get_shape_or_none(pr, data["shape"], "Aura.Remove")
+        if shape is None:
+            return False
 
-    aura = Aura.get_by_id(data["value"])
-    aura.delete_instance(True)
+        aura = room_state.get(pr.room, Aura, uuid=data["value"])
+        room_state.forget(pr.room, [aura.uuid])
+        aura.delete_instance(True)
+        return True
+
+    if not await run_db(remove):
+        return
 
     await sio.emit(
         "Shape.Options.Aura.Remove",
@@ -300,11 +327,16 @@ async def remove_aura(sid: str, data: ShapeSetStringValue):
 async def add_label(sid: str, data: ShapeSetStringValue):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "Label.Add")
-    if shape is None:
-        return
+    def add() -> bool:
+        shape = get_shape_or_none(pr, data["shape"], "Label.Add")
+        if shape is None:
+            return False
 
-    ShapeLabel.create(shape=shape, label=data["value"])
+        ShapeLabel.create(shape=shape, label=data["value"])
+        return True
+
+    if not await run_db(add):
+        return
 
     await sio.emit(
         "Shape.Options.Label.Add",
@@ -320,8 +352,8 @@ async def add_label(sid: str, data: ShapeSetStringValue):
 async def remove_label(sid: str, data: ShapeSetStringValue):
     pr: PlayerRoom = game_state.get(sid)
 
-    label = ShapeLabel.get(shape=data["shape"], label=data["value"])
-    label.delete_instance(True)
+    label = await run_db(ShapeLabel.get, shape=data["shape"], label=data["value"])
+    await run_db(label.delete_instance, True)
 
     await sio.emit(
         "Shape.Options.Label.Remove",
@@ -337,13 +369,12 @@ async def remove_label(sid: str, data: ShapeSetStringValue):
 async def set_name(sid: str, data: ShapeSetStringValue):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "Name.Set")
+    shape = await run_db(
+        update_shape, pr, data["shape"], "Name.Set", name=data["value"]
+    )
     if shape is None:
         return
 
-    shape.name = data["value"]
-    shape.save()
-
     if shape.name_visible:
         await sio.emit(
             "Shape.Options.Name.Set",
@@ -353,13 +384,15 @@ async def set_name(sid: str, data: ShapeSetStringValue):
             namespace=GAME_NS,
         )
     else:
-        for sid in get_owner_sids(pr, shape, skip_sid=sid):
-            await sio.emit(
-                "Shape.Options.Name.Set",
-                data,
-                room=sid,
-                namespace=GAME_NS,
-            )
+        for room, owner in await run_db(get_shape_audiences, pr, shape, sid):
+            if owner:
+                await sio.emit(
+                    "Shape.Options.Name.Set",
+                    data,
+                    room=room,
+                    skip_sid=sid,
+                    namespace=GAME_NS,
+                )
 
 
 @sio.on("Shape.Options.NameVisible.Set", namespace=GAME_NS)
@@ -367,15 +400,12 @@ async def set_name(sid: str, data: ShapeSetStringValue):
 async def set_name_visible(sid: str, data: ShapeSetBooleanValue):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "NameVisible.Set")
+    shape = await run_db(
+        update_shape, pr, data["shape"], "NameVisible.Set", name_visible=data["value"]
+    )
     if shape is None:
         return
 
-    shape.name_visible = data["value"]
-    shape.save()
-
-    owners = [*get_owner_sids(pr, shape, skip_sid=sid)]
-
     await sio.emit(
         "Shape.Options.NameVisible.Set",
         data,
@@ -384,13 +414,14 @@ async def set_name_visible(sid: str, data: ShapeSetBooleanValue):
         namespace=GAME_NS,
     )
 
-    for psid in game_state.get_sids(active_location=pr.active_location, skip_sid=sid):
-        if psid in owners:
+    for room, owner in await run_db(get_shape_audiences, pr, shape, sid):
+        if owner:
             continue
         await sio.emit(
             "Shape.Options.Name.Set",
             {"shape": shape.uuid, "value": shape.name if data["value"] else "?"},
-            room=psid,
+            room=room,
+            skip_sid=sid,
             namespace=GAME_NS,
         )
 
@@ -400,13 +431,12 @@ async def set_name_visible(sid: str, data: ShapeSetBooleanValue):
 async def set_show_badge(sid: str, data: ShapeSetBooleanValue):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "ShowBadge.Set")
+    shape = await run_db(
+        update_shape, pr, data["shape"], "ShowBadge.Set", show_badge=data["value"]
+    )
     if shape is None:
         return
 
-    shape.show_badge = data["value"]
-    shape.save()
-
     await sio.emit(
         "Shape.Options.ShowBadge.Set",
         data,
@@ -421,13 +451,12 @@ async def set_show_badge(sid: str, data: ShapeSetBooleanValue):
 async def set_stroke_colour(sid: str, data: ShapeSetStringValue):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "StrokeColour.Set")
+    shape = await run_db(
+        update_shape, pr, data["shape"], "StrokeColour.Set", stroke_colour=data["value"]
+    )
     if shape is None:
         return
 
-    shape.stroke_colour = data["value"]
-    shape.save()
-
     await sio.emit(
         "Shape.Options.StrokeColour.Set",
         data,
@@ -442,13 +471,12 @@ async def set_stroke_colour(sid: str, data: ShapeSetStringValue):
 async def set_fill_colour(sid: str, data: ShapeSetStringValue):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "FillColour.Set")
+    shape = await run_db(
+        update_shape, pr, data["shape"], "FillColour.Set", fill_colour=data["value"]
+    )
     if shape is None:
         return
 
-    shape.fill_colour = data["value"]
-    shape.save()
-
     await sio.emit(
         "Shape.Options.FillColour.Set",
         data,
@@ -463,32 +491,28 @@ async def set_fill_colour(sid: str, data: ShapeSetStringValue):
 async def create_tracker(sid: str, data: TrackerDelta):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "Tracker.Create")
-    if shape is None:
-        return
+    def create() -> Optional[Tuple[Tracker, List[Tuple[str, bool]]]]:
+        shape = get_shape_or_none(pr, data["shape"], "Tracker.Create")
+        if shape is None:
+            return None
 
-    model = reduce_data_to_model(Tracker, data)
-    tracker = Tracker.create(**model)
-    tracker.save()
+        model = reduce_data_to_model(Tracker, data)
+        tracker = Tracker.create(**model)
+        tracker.save()
+        return tracker, get_shape_audiences(pr, shape, skip_sid=sid)
 
-    owners = [*get_owner_sids(pr, shape, skip_sid=sid)]
-    for psid in owners:
-        await sio.emit(
-            "Shape.Options.Tracker.Create",
-            data,
-            room=psid,
-            namespace=GAME_NS,
-        )
-    if tracker.visible:
-        for psid in game_state.get_sids(
-            active_location=pr.active_location, skip_sid=sid
-        ):
-            if psid in owners:
-                continue
+    result = await run_db(create)
+    if result is None:
+        return
+    tracker, audiences = result
+
+    for room, owner in audiences:
+        if owner or tracker.visible:
             await sio.emit(
                 "Shape.Options.Tracker.Create",
                 data,
-                room=psid,
+                room=room,
+                skip_sid=sid,
                 namespace=GAME_NS,
             )
 
@@ -498,46 +522,49 @@ async def create_tracker(sid: str, data: TrackerDelta):
 async def update_tracker(sid: str, data: TrackerDelta):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "Tracker.Update")
-    if shape is None:
-        return
+    def update() -> Optional[Tuple[Dict[str, Any], bool, List[Tuple[str, bool]]]]:
+        shape = get_shape_or_none(pr, data["shape"], "Tracker.Update")
+        if shape is None:
+            return None
+
+        tracker = room_state.get(pr.room, Tracker, uuid=data["uuid"])
+        changed_visible = tracker.visible != data.get("visible", tracker.visible)
+        update_model_from_dict(tracker, data)
+        room_state.save(pr.room, tracker)
+        return (
+            tracker.as_dict(),
+            changed_visible,
+            get_shape_audiences(pr, shape, skip_sid=sid),
+        )
 
-    tracker = Tracker.get_by_id(data["uuid"])
-    changed_visible = tracker.visible != data.get("visible", tracker.visible)
-    update_model_from_dict(tracker, data)
-    tracker.save()
+    result = await run_db(update)
+    if result is None:
+        return
+    tracker_data, changed_visible, audiences = result
 
-    owners = [*get_owner_sids(pr, shape, skip_sid=sid)]
-    for psid in owners:
-        await sio.emit(
-            "Shape.Options.Tracker.Update",
-            data,
-            room=psid,
-            namespace=GAME_NS,
-        )
-    for psid in game_state.get_sids(active_location=pr.active_location, skip_sid=sid):
-        if psid in owners:
-            continue
-        if changed_visible:
-            if tracker.visible:
-                await sio.emit(
-                    "Shape.Options.Tracker.Create",
-                    {"shape": shape.uuid, **tracker.as_dict()},
-                    room=psid,
-                    namespace=GAME_NS,
-                )
-            else:
-                await sio.emit(
-                    "Shape.Options.Tracker.Remove",
-                    {"shape": shape.uuid, "value": tracker.uuid},
-                    room=psid,
-                    namespace=GAME_NS,
-                )
-        else:
+    for room, owner in audiences:
+        if owner or not changed_visible:
             await sio.emit(
                 "Shape.Options.Tracker.Update",
                 data,
-                room=psid,
+                room=room,
+                skip_sid=sid,
+                namespace=GAME_NS,
+            )
+        elif tracker_data["visible"]:
+            await sio.emit(
+                "Shape.Options.Tracker.Create",
+                {"shape": data["shape"], **tracker_data},
+                room=room,
+                skip_sid=sid,
+                namespace=GAME_NS,
+            )
+        else:
+            await sio.emit(
+                "Shape.Options.Tracker.Remove",
+                {"shape": data["shape"], "value": tracker_data["uuid"]},
+                room=room,
+                skip_sid=sid,
                 namespace=GAME_NS,
             )
 
@@ -547,13 +574,22 @@ async def update_tracker(sid: str, data: TrackerDelta):
 async def move_tracker(sid: str, data: TrackerMove):
     pr: PlayerRoom = game_state.get(sid)
 
-    new_shape = get_shape_or_none(pr, data["new_shape"], "Tracker.Options.Tracker.Move")
-    if new_shape is None:
-        return
+    def move() -> bool:
+        new_shape = get_shape_or_none(
+            pr, data["new_shape"], "Tracker.Options.Tracker.Move"
+        )
+        if new_shape is None:
+            return False
 
-    tracker = Tracker.get_by_id(data["tracker"])
-    tracker.shape = new_shape
-    tracker.save()
+        tracker = room_state.get(pr.room, Tracker, uuid=data["tracker"])
+        # Saving only drops the cached payload of the new shape
+        shape_payloads.invalidate([tracker.shape_id])
+        tracker.shape = new_shape
+        room_state.save(pr.room, tracker)
+        return True
+
+    if not await run_db(move):
+        return
 
     await sio.emit(
         "Shape.Options.Tracker.Move",
@@ -569,32 +605,28 @@ async def move_tracker(sid: str, data: TrackerMove):
 async def create_aura(sid: str, data: AuraDelta):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "Aura.Create")
-    if shape is None:
-        return
+    def create() -> Optional[Tuple[Aura, List[Tuple[str, bool]]]]:
+        shape = get_shape_or_none(pr, data["shape"], "Aura.Create")
+        if shape is None:
+            return None
 
-    model = reduce_data_to_model(Aura, data)
-    aura = Aura.create(**model)
-    aura.save()
+        model = reduce_data_to_model(Aura, data)
+        aura = Aura.create(**model)
+        aura.save()
+        return aura, get_shape_audiences(pr, shape, skip_sid=sid)
 
-    owners = [*get_owner_sids(pr, shape, skip_sid=sid)]
-    for psid in owners:
-        await sio.emit(
-            "Shape.Options.Aura.Create",
-            data,
-            room=psid,
-            namespace=GAME_NS,
-        )
-    if aura.visible:
-        for psid in game_state.get_sids(
-            active_location=pr.active_location, skip_sid=sid
-        ):
-            if psid in owners:
-                continue
+    result = await run_db(create)
+    if result is None:
+        return
+    aura, audiences = result
+
+    for room, owner in audiences:
+        if owner or aura.visible:
             await sio.emit(
                 "Shape.Options.Aura.Create",
                 data,
-                room=psid,
+                room=room,
+                skip_sid=sid,
                 namespace=GAME_NS,
             )
 
@@ -604,46 +636,49 @@ async def create_aura(sid: str, data: AuraDelta):
 async def update_aura(sid: str, data: AuraDelta):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "Aura.Update")
-    if shape is None:
-        return
+    def update() -> Optional[Tuple[Dict[str, Any], bool, List[Tuple[str, bool]]]]:
+        shape = get_shape_or_none(pr, data["shape"], "Aura.Update")
+        if shape is None:
+            return None
+
+        aura = room_state.get(pr.room, Aura, uuid=data["uuid"])
+        changed_visible = aura.visible != data.get("visible", aura.visible)
+        update_model_from_dict(aura, data)
+        room_state.save(pr.room, aura)
+        return (
+            aura.as_dict(),
+            changed_visible,
+            get_shape_audiences(pr, shape, skip_sid=sid),
+        )
 
-    aura = Aura.get_by_id(data["uuid"])
-    changed_visible = aura.visible != data.get("visible", aura.visible)
-    update_model_from_dict(aura, data)
-    aura.save()
+    result = await run_db(update)
+    if result is None:
+        return
+    aura_data, changed_visible, audiences = result
 
-    owners = [*get_owner_sids(pr, shape, skip_sid=sid)]
-    for psid in owners:
-        await sio.emit(
-            "Shape.Options.Aura.Update",
-            data,
-            room=psid,
-            namespace=GAME_NS,
-        )
-    for psid in game_state.get_sids(active_location=pr.active_location, skip_sid=sid):
-        if psid in owners:
-            continue
-        if changed_visible:
-            if aura.visible:
-                await sio.emit(
-                    "Shape.Options.Aura.Create",
-                    {"shape": shape.uuid, **aura.as_dict()},
-                    room=psid,
-                    namespace=GAME_NS,
-                )
-            else:
-                await sio.emit(
-                    "Shape.Options.Aura.Remove",
-                    {"shape": shape.uuid, "value": aura.uuid},
-                    room=psid,
-                    namespace=GAME_NS,
-                )
-        else:
+    for room, owner in audiences:
+        if owner or not changed_visible:
             await sio.emit(
                 "Shape.Options.Aura.Update",
                 data,
-                room=psid,
+                room=room,
+                skip_sid=sid,
+                namespace=GAME_NS,
+            )
+        elif aura_data["visible"]:
+            await sio.emit(
+                "Shape.Options.Aura.Create",
+                {"shape": data["shape"], **aura_data},
+                room=room,
+                skip_sid=sid,
+                namespace=GAME_NS,
+            )
+        else:
+            await sio.emit(
+                "Shape.Options.Aura.Remove",
+                {"shape": data["shape"], "value": aura_data["uuid"]},
+                room=room,
+                skip_sid=sid,
                 namespace=GAME_NS,
             )
 
@@ -653,13 +688,22 @@ async def update_aura(sid: str, data: AuraDelta):
 async def move_aura(sid: str, data: AuraMove):
     pr: PlayerRoom = game_state.get(sid)
 
-    new_shape = get_shape_or_none(pr, data["new_shape"], "Aura.Options.Tracker.Move")
-    if new_shape is None:
-        return
+    def move() -> bool:
+        new_shape = get_shape_or_none(
+            pr, data["new_shape"], "Aura.Options.Tracker.Move"
+        )
+        if new_shape is None:
+            return False
 
-    aura = Aura.get_by_id(data["aura"])
-    aura.shape = new_shape
-    aura.save()
+        aura = room_state.get(pr.room, Aura, uuid=data["aura"])
+        # Saving only drops the cached payload of the new shape
+        shape_payloads.invalidate([aura.shape_id])
+        aura.shape = new_shape
+        room_state.save(pr.room, aura)
+        return True
+
+    if not await run_db(move):
+        return
 
     await sio.emit(
         "Shape.Options.Aura.Move",
@@ -0,0 +1,172 @@
+"""
+Coalescing of shape position updates.
+
+While dragging or rotating, clients send a position update for every mouse move.
+Instead of relaying and storing each of them separately, the updates of a sender are gathered during a short tick,
+after which the latest position of every shape is broadcast in one message
+and only the latest non-temporary position of every shape is written to the database.
+"""
+
+import asyncio
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from api.socket.constants import GAME_NS
+from api.socket.shape.data_models import PositionUpdate
+from app import sio
+from models import PlayerRoom, Shape
+from models.db import db, run_db, use_room
+from models.utils import get_table
+from state.room import room_state
+from utils import logger
+
+# Roughly one update per frame at 30fps
+TICK = 0.033
+# Delay before positions that could not be saved are tried again
+RETRY_DELAY = 1.0
+
+# (sid, location path)
+PendingKey = Tuple[str, str]
+
+
+class PendingPositions:
+    def __init__(self, room_id: int) -> None:
+        self.room_id = room_id
+        # Latest position per shape that still has to be sent to the other players
+        self.updates: Dict[str, PositionUpdate] = {}
+        # Latest non-temporary position per shape that still has to be saved
+        self.persist: Dict[str, PositionUpdate] = {}
+
+
+class PositionBroadcaster:
+    def __init__(self) -> None:
+        self._pending: Dict[PendingKey, PendingPositions] = {}
+
+    def add(
+        self, sid: str, pr: PlayerRoom, shapes: List[PositionUpdate], temporary: bool
+    ) -> None:
+        """
+        Queues position updates sent by `sid`, they are broadcast and saved at the end of the current tick.
+        """
+        key = (sid, pr.active_location.get_path())
+        pending = self._get_pending(key, pr.room_id, TICK)
+        for shape in shapes:
+            pending.updates[shape["uuid"]] = shape
+            if not temporary:
+                pending.persist[shape["uuid"]] = shape
+
+    async def flush(self, sid: str) -> None:
+        """
+        Immediately broadcasts and saves all pending updates of a sender.
+        """
+        for key in [key for key in self._pending if key[0] == sid]:
+            await self._flush(key)
+
+    async def flush_shapes(self, uuids: Iterable[str]) -> None:
+        """
+        Immediately broadcasts and saves the pending updates that contain any of the given shapes.
+
+        Use this before broadcasting a layer or floor change of the shapes,
+        so that their coalesced positions cannot reach the clients after the change.
+        """
+        uuids = set(uuids)
+        for key in [
+            key
+            for key, pending in self._pending.items()
+            if not uuids.isdisjoint(pending.updates)
+        ]:
+            await self._flush(key)
+
+    def discard_shapes(self, uuids: Iterable[str]) -> None:
+        """
+        Drops the pending updates of the given shapes, use this before broadcasting their removal.
+        """
+        for pending in self._pending.values():
+            for uuid in uuids:
+                pending.updates.pop(uuid, None)
+                pending.persist.pop(uuid, None)
+
+    async def persist(self, room_id: Optional[int] = None) -> None:
+        """
+        Saves the pending non-temporary positions, optionally limited to a single room.
+
+        Use this before shapes are modified through other means than the position updates (e.g. moved to another location).
+        """
+        for pending in list(self._pending.values()):
+            if room_id is None or pending.room_id == room_id:
+                await self._persist(pending)
+
+    def _get_pending(
+        self, key: PendingKey, room_id: int, delay: float
+    ) -> PendingPositions:
+        """
+        Returns the pending updates of the key, a new entry is flushed after `delay` seconds.
+        """
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = PendingPositions(room_id)
+            asyncio.ensure_future(self._flush_later(key, delay))
+        return pending
+
+    async def _flush_later(self, key: PendingKey, delay: float) -> None:
+        await asyncio.sleep(delay)
+        await self._flush(key)
+
+    async def _flush(self, key: PendingKey) -> None:
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+
+        # The broadcast is handed to socket.io before anything else can run,
+        # so it always reaches the clients before any later change of the same shapes
+        if pending.updates:
+            await sio.emit(
+                "Shapes.Position.Update",
+                list(pending.updates.values()),
+                room=key[1],
+                skip_sid=key[0],
+                namespace=GAME_NS,
+            )
+
+        try:
+            await self._persist(pending)
+        except Exception:
+            logger.exception("Could not save shape positions")
+            # Queue the positions again, newer positions of the same shapes take precedence
+            retry = self._get_pending(key, pending.room_id, RETRY_DELAY)
+            retry.persist = {**pending.persist, **retry.persist}
+
+    async def _persist(self, pending: PendingPositions) -> None:
+        if not pending.persist:
+            return
+
+        updates = pending.persist
+        pending.persist = {}
+        try:
+            await run_db(self._save, pending.room_id, updates)
+        except Exception:
+            pending.persist = {**updates, **pending.persist}
+            raise
+
+    def _save(self, room_id: int, updates: Dict[str, PositionUpdate]) -> None:
+        with use_room(room_id), db.atomic():
+            for uuid, data in updates.items():
+                shape = room_state.get_or_none(room_id, Shape, uuid=uuid)
+                if shape is None:
+                    continue
+
+                points = data["position"]["points"]
+                shape.x = points[0][0]
+                shape.y = points[0][1]
+                shape.angle = data["position"]["angle"]
+                room_state.save(room_id, shape)
+
+                if len(points) > 1:
+                    # Subshape
+                    type_instance = room_state.get(
+                        room_id, get_table(shape.type_), shape=shape.uuid
+                    )
+                    type_instance.set_location(points[1:])
+                    room_state.save(room_id, type_instance)
+
+
+position_broadcaster = PositionBroadcaster()
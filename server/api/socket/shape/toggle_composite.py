@@ -5,6 +5,7 @@ from api.socket.constants import GAME_NS
 from api.socket.shape.utils import get_shape_or_none
 from app import app, sio
 from models import PlayerRoom
+from models.db import run_db
 from models.shape import CompositeShapeAssociation, ToggleComposite
 from state.game import game_state
 
@@ -23,14 +24,21 @@ class NewVariantMessage(VariantMessage):
 async def set_toggle_composite_active_variant(sid: str, data: VariantMessage):
     pr: PlayerRoom = game_state.get(sid)
 
-    shape = get_shape_or_none(pr, data["shape"], "ToggleComposite.Variants.Active.Set")
-    if shape is None:
-        return
+    def set_active_variant() -> bool:
+        shape = get_shape_or_none(
+            pr, data["shape"], "ToggleComposite.Variants.Active.Set"
+        )
+        if shape is None:
+            return False
+
+        composite: ToggleComposite = shape.subtype
 
-    composite: ToggleComposite = shape.subtype
+        composite.active_variant = data["variant"]
+        composite.save()
+        return True
 
-    composite.active_variant = data["variant"]
-    composite.save()
+    if not await run_db(set_active_variant):
+        return
 
     await sio.emit(
         "ToggleComposite.Variants.Active.Set",
@@ -46,12 +54,19 @@ async def set_toggle_composite_active_variant(sid: str, data: VariantMessage):
 async def add_toggle_composite_variant(sid: str, data: NewVariantMessage):
     pr: PlayerRoom = game_state.get(sid)
 
-    parent = get_shape_or_none(pr, data["shape"], "ToggleComposite.Variants.Add")
-    variant = get_shape_or_none(pr, data["variant"], "ToggleComposite.Variants.Add")
-    if parent is None or variant is None:
-        return
+    def add_variant() -> bool:
+        parent = get_shape_or_none(pr, data["shape"], "ToggleComposite.Variants.Add")
+        variant = get_shape_or_none(pr, data["variant"], "ToggleComposite.Variants.Add")
+        if parent is None or variant is None:
+            return False
+
+        CompositeShapeAssociation.create(
+            parent=parent, variant=variant, name=data["name"]
+        )
+        return True
 
-    CompositeShapeAssociation.create(parent=parent, variant=variant, name=data["name"])
+    if not await run_db(add_variant):
+        return
 
     await sio.emit(
         "ToggleComposite.Variants.Add",
@@ -67,11 +82,14 @@ async def add_toggle_composite_variant(sid: str, data: NewVariantMessage):
 async def rename_toggle_composite_variant(sid: str, data: NewVariantMessage):
     pr: PlayerRoom = game_state.get(sid)
 
-    composite = CompositeShapeAssociation.get(
-        parent=data["shape"], variant=data["variant"]
-    )
-    composite.name = data["name"]
-    composite.save()
+    def rename_variant():
+        composite = CompositeShapeAssociation.get(
+            parent=data["shape"], variant=data["variant"]
+        )
+        composite.name = data["name"]
+        composite.save()
+
+    await run_db(rename_variant)
 
     await sio.emit(
         "ToggleComposite.Variants.Rename",
@@ -87,10 +105,13 @@ async def rename_toggle_composite_variant(sid: str, data: NewVariantMessage):
 async def remove_toggle_composite_variant(sid: str, data: VariantMessage):
     pr: PlayerRoom = game_state.get(sid)
 
-    composite = CompositeShapeAssociation.get(
-        parent=data["shape"], variant=data["variant"]
-    )
-    composite.delete_instance(True)
+    def remove_variant():
+        composite = CompositeShapeAssociation.get(
+            parent=data["shape"], variant=data["variant"]
+        )
+        composite.delete_instance(True)
+
+    await run_db(remove_variant)
 
     await sio.emit(
         "ToggleComposite.Variants.Remove",
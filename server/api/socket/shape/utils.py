@@ -1,14 +1,18 @@
-from typing import Generator, Union
+from typing import Any, List, Tuple, Union
 
 from models import PlayerRoom, Shape
 from models.shape.access import has_ownership
 from state.game import game_state
+from state.room import room_state
 from utils import logger
 
+# The functions in this module query the database,
+# so they should run on the database thread (see models.db.run_db).
+
 
 def get_shape_or_none(pr: PlayerRoom, shape_id: str, action: str) -> Union[Shape, None]:
     try:
-        shape: Shape = Shape.get(uuid=shape_id)
+        shape: Shape = room_state.get(pr.room, Shape, uuid=shape_id)
     except Shape.DoesNotExist as exc:
         logger.warning(
             f"Attempt by {pr.player.name} on unknown shape. {{method: {action}, shape id: {shape_id}}}"
@@ -24,11 +28,32 @@ def get_shape_or_none(pr: PlayerRoom, shape_id: str, action: str) -> Union[Shape
     return shape
 
 
-def get_owner_sids(
+def update_shape(
+    pr: PlayerRoom, shape_id: str, action: str, **values: Any
+) -> Union[Shape, None]:
+    """
+    Sets the given fields of a shape that `pr` has access to.
+    """
+    shape = get_shape_or_none(pr, shape_id, action)
+    if shape is None:
+        return None
+
+    for field, value in values.items():
+        setattr(shape, field, value)
+    room_state.save(pr.room, shape)
+    return shape
+
+
+def get_shape_audiences(
     pr: PlayerRoom, shape: Shape, skip_sid=None
-) -> Generator[str, None, None]:
-    for psid in game_state.get_sids(
-        active_location=pr.active_location, skip_sid=skip_sid
-    ):
-        if has_ownership(shape, game_state.get(psid)):
-            yield psid
+) -> List[Tuple[str, bool]]:
+    """
+    Returns the socket.io room of every audience on the active location of `pr`
+    and whether that audience has ownership of the shape.
+    """
+    return [
+        (room, has_ownership(shape, audience_pr))
+        for room, audience_pr in game_state.get_audiences(
+            pr.active_location, skip_sid=skip_sid
+        )
+    ]
@@ -11,6 +11,7 @@ from aiohttp_security import SessionIdentityPolicy
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
 
 import auth
+import cluster
 from config import config
 
 runners: List[web.AppRunner] = []
@@ -38,6 +39,7 @@ sio = socketio.AsyncServer(
     async_mode="aiohttp",
     engineio_logger=False,
     cors_allowed_origins=config.get("Webserver", "cors_allowed_origins", fallback=None),
+    client_manager=cluster.create_client_manager(),
 )
 app = setup_app()
 aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader("templates"))
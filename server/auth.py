@@ -5,6 +5,8 @@ from aiohttp import web
 from aiohttp_security.abc import AbstractAuthorizationPolicy
 
 from models import Constants, User
+from models.db import run_db, select_room
+from models.shape.journal import shape_journal
 
 logger = logging.getLogger("PlanarAllyServer")
 
@@ -15,7 +17,7 @@ class AuthPolicy(AbstractAuthorizationPolicy):
         Return the user_id of the user identified by the identity
         or 'None' if no user exists related to the identity.
         """
-        user = User.by_name(identity)
+        user = await run_db(User.by_name, identity)
         if user:
             return user
 
@@ -25,7 +27,7 @@ class AuthPolicy(AbstractAuthorizationPolicy):
         current context, else return False.
         """
         # pylint: disable=unused-argument
-        user = User.by_name(identity)
+        user = await run_db(User.by_name, identity)
         if not user:
             return False
         return permission in user.permissions
@@ -45,7 +47,15 @@ def login_required(app, sio):
             ].has_sid(sid):
                 await sio.emit("redirect", "/")
                 return
-            return await fn(*args, **kwargs)
+            if app["state"]["game"].has_sid(sid):
+                # The database functions of the handler run in the client's room
+                select_room(app["state"]["game"].get(sid).room_id)
+            # The journal versions of the changes made by the handler are acknowledged once it emitted them
+            operation = shape_journal.begin()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                shape_journal.end(operation)
 
         return wrapped
 
@@ -67,7 +77,7 @@ async def token_middleware(request: web.Request, handler):
     except KeyError:
         raise web.HTTPUnauthorized(reason="Missing authorization header")
 
-    if authorization != f"Bearer {get_api_token()}":
+    if authorization != f"Bearer {await run_db(get_api_token)}":
         raise web.HTTPForbidden(reason="Invalid authorization header.")
 
     return await handler(request)
@@ -0,0 +1,287 @@
+"""
+Support for running the webserver in multiple worker processes.
+
+When `workers` in the [Webserver] section of server_config.cfg is larger than 1,
+the started process becomes a supervisor that opens the listening socket, runs a small message broker
+and starts the worker processes, which all accept connections on the inherited socket.
+
+The workers exchange messages through the broker:
+- socket.io emits, so that an emit to a room reaches the clients of that room on every worker
+- commands, that let every worker act on its own clients (e.g. moving them to another location)
+- cache invalidations, so that the in-memory caches of the other workers do not serve stale data
+
+Every client is handled by a single worker, so the game state of a worker only contains its own clients.
+Code that needs to act on all clients of a room should emit to a socket.io room or dispatch a command.
+"""
+
+import asyncio
+import os
+import pickle
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+from typing import Any, Callable, Dict, List, Optional
+
+import socketio
+from socketio.asyncio_pubsub_manager import AsyncPubSubManager
+
+from config import config
+from utils import logger
+
+WORKERS = max(config.getint("Webserver", "workers", fallback=1), 1)
+if WORKERS > 1 and sys.platform.startswith("win"):
+    logger.warning(
+        "Multiple workers are not supported on Windows, using a single process"
+    )
+    WORKERS = 1
+
+BROKER_ENV = "PA_BROKER"
+LISTEN_FD_ENV = "PA_LISTEN_FD"
+WORKER_ENV = "PA_WORKER"
+
+BROKER_PATH = os.environ.get(BROKER_ENV)
+WORKER_ID = int(os.environ.get(WORKER_ENV, "0"))
+
+_HEADER = struct.Struct("!I")
+
+_handlers: Dict[str, Callable[..., Any]] = {}
+_manager: Optional["BrokerManager"] = None
+
+
+def is_supervisor() -> bool:
+    """
+    Whether this process should start the workers instead of serving clients itself.
+    """
+    return WORKERS > 1 and BROKER_PATH is None
+
+
+def is_worker() -> bool:
+    return BROKER_PATH is not None
+
+
+def is_primary() -> bool:
+    """
+    Whether this process runs the tasks that should only run once per server (maintenance, cleanup, API server).
+    """
+    return WORKER_ID == 0
+
+
+def on(name: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """
+    Registers the handler of a command or cache invalidation.
+
+    Handlers can be regular functions or coroutine functions and receive the arguments given to `dispatch`/`publish`.
+    """
+
+    def decorator(handler: Callable[..., Any]) -> Callable[..., Any]:
+        _handlers[name] = handler
+        return handler
+
+    return decorator
+
+
+async def _run_handler(name: str, args: List[Any]) -> None:
+    handler = _handlers.get(name)
+    if handler is None:
+        logger.error(f"No handler for cluster message {name}")
+        return
+    try:
+        result = handler(*args)
+        if asyncio.iscoroutine(result):
+            await result
+    except Exception:
+        logger.exception(f"Cluster message {name} failed")
+
+
+async def dispatch(name: str, *args: Any) -> None:
+    """
+    Runs the handler registered for `name` on every worker, including this one.
+    """
+    if _manager is None:
+        await _run_handler(name, list(args))
+    else:
+        await _manager.publish_command(name, list(args), include_self=True)
+
+
+def publish(name: str, *args: Any) -> None:
+    """
+    Runs the handler registered for `name` on every other worker, without waiting for it.
+
+    This can be called from any thread, which makes it usable from the model signals.
+    """
+    if _manager is not None:
+        _manager.publish_command_threadsafe(name, list(args))
+
+
+def _encode(message: Any) -> bytes:
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    return _HEADER.pack(len(data)) + data
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> bytes:
+    header = await reader.readexactly(_HEADER.size)
+    return await reader.readexactly(_HEADER.unpack(header)[0])
+
+
+class BrokerManager(AsyncPubSubManager):
+    """
+    Socket.io client manager that shares emits and cluster messages with the other workers through the broker.
+    """
+
+    name = "planarally-broker"
+
+    def __init__(self, path: str) -> None:
+        super().__init__(channel="planarally")
+        self.path = path
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connect_lock = asyncio.Lock()
+        self._loop = asyncio.get_event_loop()
+
+    async def _connect(self) -> asyncio.StreamWriter:
+        async with self._connect_lock:
+            if self._writer is None:
+                self._reader, self._writer = await asyncio.open_unix_connection(
+                    self.path
+                )
+        return self._writer
+
+    async def _publish(self, data: Any) -> None:
+        writer = await self._connect()
+        writer.write(_encode(data))
+        await writer.drain()
+
+    async def _listen(self) -> Any:
+        await self._connect()
+        while True:
+            message = pickle.loads(await _read_frame(self._reader))  # type: ignore
+            if message.get("method") != "cluster":
+                return message
+            if message["host_id"] == self.host_id and not message["include_self"]:
+                continue
+            # Commands can take a while (e.g. loading a location), which should not hold up the emits
+            asyncio.ensure_future(_run_handler(message["name"], message["args"]))
+
+    async def publish_command(
+        self, name: str, args: List[Any], include_self: bool
+    ) -> None:
+        await self._publish(
+            {
+                "method": "cluster",
+                "name": name,
+                "args": args,
+                "include_self": include_self,
+                "host_id": self.host_id,
+            }
+        )
+
+    def publish_command_threadsafe(self, name: str, args: List[Any]) -> None:
+        self._loop.call_soon_threadsafe(
+            lambda: asyncio.ensure_future(
+                self.publish_command(name, args, include_self=False)
+            )
+        )
+
+
+def create_client_manager() -> Optional[socketio.AsyncManager]:
+    """
+    Returns the socket.io client manager to use, None for the default in-process manager.
+    """
+    global _manager
+    if BROKER_PATH is not None:
+        _manager = BrokerManager(BROKER_PATH)
+    return _manager
+
+
+def get_listen_socket() -> socket.socket:
+    """
+    Returns the listening socket that the supervisor handed to this worker.
+    """
+    return socket.socket(fileno=int(os.environ[LISTEN_FD_ENV]))
+
+
+async def start_broker(path: str) -> asyncio.AbstractServer:
+    """
+    Starts the broker, which forwards every message it receives to all connected workers (including the sender).
+    """
+    clients: List[asyncio.StreamWriter] = []
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        clients.append(writer)
+        try:
+            while True:
+                data = await _read_frame(reader)
+                frame = _HEADER.pack(len(data)) + data
+                for client in list(clients):
+                    client.write(frame)
+                for client in list(clients):
+                    await client.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            clients.remove(writer)
+            writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    return await asyncio.start_unix_server(handle, path=path)
+
+
+def _get_worker_command() -> List[str]:
+    if getattr(sys, "frozen", False):
+        return [sys.executable, *sys.argv[1:]]
+    return [sys.executable, *sys.argv]
+
+
+def _start_worker(worker_id: int, broker_path: str, sock: socket.socket):
+    env = {
+        **os.environ,
+        BROKER_ENV: broker_path,
+        LISTEN_FD_ENV: str(sock.fileno()),
+        WORKER_ENV: str(worker_id),
+    }
+    return subprocess.Popen(_get_worker_command(), env=env, pass_fds=(sock.fileno(),))
+
+
+async def supervise(sock: socket.socket) -> None:
+    """
+    Runs the broker and WORKERS worker processes that serve clients on the given listening socket.
+
+    Workers that exit unexpectedly are restarted, all workers are stopped when this process is stopped.
+    """
+    loop = asyncio.get_event_loop()
+    tmp_dir = tempfile.mkdtemp(prefix="planarally-")
+    broker_path = os.path.join(tmp_dir, "broker.sock")
+    broker = await start_broker(broker_path)
+
+    stop_signals: List[int] = []
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_signals.append, sig)
+
+    workers = [_start_worker(i, broker_path, sock) for i in range(WORKERS)]
+    try:
+        while not stop_signals:
+            await asyncio.sleep(1)
+            for i, worker in enumerate(workers):
+                if worker.poll() is not None and not stop_signals:
+                    logger.error(
+                        f"Worker {i} exited with code {worker.returncode}, restarting it"
+                    )
+                    workers[i] = _start_worker(i, broker_path, sock)
+    finally:
+        # The workers shut down gracefully on both signals
+        for worker in workers:
+            if worker.poll() is None:
+                worker.send_signal(stop_signals[0] if stop_signals else signal.SIGTERM)
+        for worker in workers:
+            try:
+                await loop.run_in_executor(None, worker.wait, 10)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+        broker.close()
+        await broker.wait_closed()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,48 @@
+"""
+Creation of downscaled variants of image assets.
+
+The functions in this module are run in worker processes (see api.socket.asset_manager.variants),
+so they only depend on the standard library and Pillow.
+"""
+
+import os
+from typing import Optional
+
+from PIL import Image, UnidentifiedImageError
+
+# Moved to Image.Resampling in Pillow 9.1
+LANCZOS = getattr(Image, "Resampling", Image).LANCZOS
+# Images without transparency are stored as jpeg, which is a lot smaller for typical map images
+OPAQUE_FORMAT = ("JPEG", ".jpg")
+TRANSPARENT_FORMAT = ("PNG", ".png")
+
+
+def create_variant(src: str, dst: str, size: int) -> Optional[str]:
+    """
+    Writes a version of the image at `src` that fits in a `size` x `size` square to `dst` + extension.
+
+    Returns the extension of the written file,
+    or None if the image is not larger than `size` or can not be read as an image.
+    Other errors (e.g. the file can not be read or written) are raised.
+    """
+    try:
+        with Image.open(src) as image:
+            if max(image.size) <= size:
+                return None
+            # Lets the jpeg decoder skip most of the work for large reductions
+            image.draft("RGB", (size, size))
+            transparent = image.mode in ("RGBA", "LA", "PA") or (
+                image.mode == "P" and "transparency" in image.info
+            )
+            resized = image.convert("RGBA" if transparent else "RGB")
+            resized.thumbnail((size, size), LANCZOS)
+
+            image_format, extension = (
+                TRANSPARENT_FORMAT if transparent else OPAQUE_FORMAT
+            )
+            tmp = f"{dst}.tmp"
+            resized.save(tmp, image_format, quality=85, optimize=True)
+            os.replace(tmp, dst + extension)
+            return extension
+    except (UnidentifiedImageError, ValueError, Image.DecompressionBombError):
+        return None
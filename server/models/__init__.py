@@ -1,6 +1,6 @@
 from utils import all_subclasses
 from .asset import *
-from .base import BaseModel as _BaseModel
+from .base import BaseModel as _BaseModel, RoomModel as _RoomModel, get_room_models
 from .campaign import *
 from .general import *
 from .groups import Group
@@ -12,4 +12,5 @@ from .signals import *
 from .user import *
 from .marker import *
 
-ALL_MODELS = [model for model in all_subclasses(_BaseModel)]
+ALL_MODELS = [model for model in all_subclasses(_BaseModel) if model is not _RoomModel]
+ROOM_MODELS = get_room_models()
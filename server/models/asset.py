@@ -1,9 +1,12 @@
 import json
-from typing import Any, Dict
+from collections import defaultdict
+from threading import Lock
+from typing import Any, Dict, List, Optional
 
 from peewee import ForeignKeyField, TextField
 from playhouse.shortcuts import model_to_dict
 
+import cluster
 from .base import BaseModel
 from .user import User
 
@@ -17,6 +20,9 @@ class Asset(BaseModel):
     file_hash = TextField(null=True)
     options = TextField(null=True)
 
+    class Meta:
+        indexes = ((("file_hash",), False),)
+
     def __repr__(self):
         return f"<Asset {self.owner.name} - {self.name}>"
 
@@ -29,11 +35,10 @@ class Asset(BaseModel):
     def as_dict(self, children=False, recursive=False):
         asset = model_to_dict(self, exclude=[Asset.owner, Asset.parent])
         if children:
+            tree = asset_trees.get(self.owner_id)
             asset["children"] = [
                 child.as_dict(children=children and recursive, recursive=recursive)
-                for child in Asset.select().where(
-                    (Asset.owner == self.owner) & (Asset.parent == self)
-                )
+                for child in tree.get_children(self.id)
             ]
         return asset
 
@@ -54,15 +59,74 @@ class Asset(BaseModel):
     def get_user_structure(cls, user, parent=None):
         if parent is None:
             parent = cls.get_root_folder(user)
-        # ideally we change this to a single query to get all assets and process them as such
-        data = {"__files": []}
-        for asset in Asset.select().where(
-            (Asset.owner == user) & (Asset.parent == parent)
-        ):
+        tree = asset_trees.get(user.id)
+        return tree.get_structure(parent.id)
+
+
+class AssetTree:
+    """
+    All assets of a single user, loaded with one query and indexed by parent.
+    """
+
+    def __init__(self, assets: List[Asset]) -> None:
+        self._children: Dict[Optional[int], List[Asset]] = defaultdict(list)
+        for asset in assets:
+            self._children[asset.parent_id].append(asset)
+
+    def get_children(self, parent: Optional[int]) -> List[Asset]:
+        return self._children.get(parent, [])
+
+    def get_structure(self, parent: int) -> Dict[str, Any]:
+        data: Dict[str, Any] = {"__files": []}
+        for asset in self.get_children(parent):
             if asset.file_hash:
                 data["__files"].append(
                     {"id": asset.id, "name": asset.name, "hash": asset.file_hash}
                 )
             else:
-                data[asset.name] = cls.get_user_structure(user, asset)
+                data[asset.name] = self.get_structure(asset.id)
         return data
+
+
+class AssetTreeCache:
+    """
+    Per user cache of the asset tree.
+
+    A user's tree is dropped whenever one of their assets is created, moved, renamed or removed (see models.signals),
+    on every worker when running with multiple worker processes.
+    """
+
+    def __init__(self) -> None:
+        self._trees: Dict[int, AssetTree] = {}
+        # Bumped on every invalidation, so that a tree that was being loaded concurrently is not stored
+        self._version = 0
+        self._lock = Lock()
+
+    def get(self, user_id: int) -> AssetTree:
+        tree = self._trees.get(user_id)
+        if tree is None:
+            version = self._version
+            tree = AssetTree(
+                list(Asset.select().where(Asset.owner == user_id).order_by(Asset.id))
+            )
+            with self._lock:
+                if version == self._version:
+                    self._trees[user_id] = tree
+        return tree
+
+    def invalidate(self, user_id: int) -> None:
+        self._invalidate(user_id)
+        cluster.publish("cache.assets", user_id)
+
+    def _invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._version += 1
+            self._trees.pop(user_id, None)
+
+
+asset_trees = AssetTreeCache()
+
+
+@cluster.on("cache.assets")
+def _invalidate_remote(user_id: int) -> None:
+    asset_trees._invalidate(user_id)
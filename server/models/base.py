@@ -1,9 +1,131 @@
-from playhouse.signals import Model
+from typing import Callable, List, Optional, Tuple, Type
 
-from .db import db
+from peewee import (
+    AutoField,
+    EnclosedNodeList,
+    Expression,
+    ForeignKeyField,
+    NodeList,
+    SQL,
+)
+from playhouse.signals import Model, post_delete, pre_delete
+
+from utils import all_subclasses
+from .db import ROOM_ID_SHIFT, db, get_room_scopes, room_databases, room_db, use_room
+
+Dependency = Tuple[Expression, ForeignKeyField]
+
+
+def _delete_dependencies(dependencies: List[Dependency], delete_nullable: bool) -> None:
+    # Same as the recursive part of peewee's `Model.delete_instance`
+    for query, fk in reversed(dependencies):
+        model = fk.model
+        if fk.null and not delete_nullable:
+            model.update(**{fk.name: None}).where(query).execute()
+        else:
+            model.delete().where(query).execute()
 
 
 class BaseModel(Model):
     class Meta:
         database = db
         legacy_table_names = False
+
+    def get_dependent_rooms(self) -> List[Optional[int]]:
+        """
+        Returns the rooms whose data can refer to this instance.
+        """
+        return get_room_scopes()
+
+    def delete_instance(self, recursive=False, delete_nullable=False):
+        if not recursive or not room_databases.enabled or isinstance(self, RoomModel):
+            return super().delete_instance(recursive, delete_nullable)
+
+        # The room data that refers to this instance is in the room databases,
+        # where neither the database cascade nor peewee's recursive delete reach it.
+        pre_delete.send(self)
+        room_dependencies: List[Dependency] = []
+        dependencies: List[Dependency] = []
+        for query, fk in self.dependencies(delete_nullable):
+            if issubclass(fk.model, RoomModel):
+                room_dependencies.append((query, fk))
+            else:
+                dependencies.append((query, fk))
+        if room_dependencies:
+            for room_id in self.get_dependent_rooms():
+                with use_room(room_id), db.atomic():
+                    _delete_dependencies(room_dependencies, delete_nullable)
+        _delete_dependencies(dependencies, delete_nullable)
+        rows = type(self).delete().where(self._pk_expr()).execute()
+        if room_dependencies:
+            # Rooms can be removed along with this instance (e.g. those created by a user)
+            room_databases.remove_unused(
+                row[0] for row in db.execute_sql("SELECT id FROM room")
+            )
+        post_delete.send(self)
+        return rows
+
+
+class RoomModel(BaseModel):
+    """
+    Base of the models whose rows belong to a single room.
+
+    When rooms are stored in their own database file, queries on these models use the database of the selected room
+    (see models.db.use_room). Foreign keys from these models to the global models are not enforced in that case.
+    """
+
+    class Meta:
+        database = room_db
+
+
+def get_room_models() -> List[Type[RoomModel]]:
+    return sorted(all_subclasses(RoomModel), key=lambda model: model._meta.table_name)
+
+
+def create_table(
+    model: Type[Model],
+    foreign_key: Callable[[ForeignKeyField], bool],
+    autoincrement: bool = False,
+) -> None:
+    """
+    Creates the table and indexes of a model like peewee does,
+    but only with the foreign key constraints that `foreign_key` returns True for.
+
+    With `autoincrement`, sqlite never reuses the id of a deleted row and tracks the last id in sqlite_sequence.
+    """
+    database = model._meta.database
+    ctx = model._schema._create_context()
+    ctx.literal("CREATE TABLE IF NOT EXISTS ").sql(model).literal(" ")
+    columns = []
+    constraints = []
+    for field in model._meta.sorted_fields:
+        column = field.ddl(ctx)
+        if autoincrement and field.primary_key and isinstance(field, AutoField):
+            column = NodeList((column, SQL("AUTOINCREMENT")))
+        columns.append(column)
+        if isinstance(field, ForeignKeyField) and foreign_key(field):
+            constraints.append(field.foreign_key_constraint())
+    ctx.sql(EnclosedNodeList(columns + constraints))
+    database.execute(ctx)
+    model._schema.create_indexes()
+
+
+def create_room_tables(room_id: int) -> None:
+    """
+    Creates the tables of the room data in the database of the selected room.
+
+    Foreign keys to the global tables are left out, sqlite can not enforce them across database files.
+    New rows get ids from the range of the room, so that they don't collide with the rows of other rooms.
+    """
+    with room_db.atomic():
+        for model in get_room_models():
+            create_table(
+                model,
+                lambda fk: issubclass(fk.rel_model, RoomModel),
+                autoincrement=True,
+            )
+            if isinstance(model._meta.primary_key, AutoField):
+                room_db.execute_sql(
+                    "INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)",
+                    (model._meta.table_name, room_id << ROOM_ID_SHIFT),
+                )
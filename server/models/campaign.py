@@ -1,4 +1,6 @@
 import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
 from peewee import (
     DateField,
     fn,
@@ -9,11 +11,10 @@ from peewee import (
     TextField,
 )
 from playhouse.shortcuts import model_to_dict
-from typing import Set
 
 from .asset import Asset
-from .base import BaseModel
-from .groups import Group
+from .base import BaseModel, RoomModel
+from .db import room_databases
 from .user import User, UserOptions
 
 __all__ = [
@@ -21,6 +22,7 @@ __all__ = [
     "Layer",
     "Location",
     "LocationOptions",
+    "LocationSnapshot",
     "LocationUserOption",
     "Note",
     "PlayerRoom",
@@ -67,6 +69,16 @@ class Room(BaseModel):
     def get_path(self):
         return f"{self.creator.name}/{self.name}"
 
+    def get_dependent_rooms(self) -> List[Optional[int]]:
+        # The database of the room is removed as a whole
+        return []
+
+    def delete_instance(self, *args, **kwargs):
+        rows = super().delete_instance(*args, **kwargs)
+        if room_databases.enabled:
+            room_databases.remove(self.id)
+        return rows
+
     def as_dashboard_dict(self):
         logo = None
         if self.logo_id is not None:
@@ -82,7 +94,7 @@ class Room(BaseModel):
         indexes = ((("name", "creator"), True),)
 
 
-class Location(BaseModel):
+class Location(RoomModel):
     room = ForeignKeyField(Room, backref="locations", on_delete="CASCADE")
     name = TextField()
     options = ForeignKeyField(LocationOptions, on_delete="CASCADE", null=True)
@@ -186,8 +198,18 @@ class PlayerRoom(BaseModel):
     def __repr__(self):
         return f"<PlayerRoom {self.room.get_path()} - {self.player.name}>"
 
+    def load_references(self) -> "PlayerRoom":
+        """
+        Loads the related rows that are used while handling the player's events (e.g. for the socket.io room names),
+        so that they can be used outside of the database thread.
+        """
+        self.player
+        self.room.creator
+        self.active_location.room.creator
+        return self
 
-class Note(BaseModel):
+
+class Note(RoomModel):
     uuid = TextField(primary_key=True)
     room = ForeignKeyField(Room, backref="notes", on_delete="CASCADE")
     location = ForeignKeyField(
@@ -206,7 +228,7 @@ class Note(BaseModel):
         )
 
 
-class Floor(BaseModel):
+class Floor(RoomModel):
     location = ForeignKeyField(Location, backref="floors", on_delete="CASCADE")
     index = IntegerField()
     name = TextField()
@@ -216,20 +238,19 @@ class Floor(BaseModel):
         return f"<Floor {self.name} {[self.index]}>"
 
     def as_dict(self, user: User, dm: bool):
+        from .shape.bulk import get_layers_shape_data
+
         data = model_to_dict(self, recurse=False, exclude=[Floor.id, Floor.location])
-        if dm:
-            data["layers"] = [
-                l.as_dict(user, True) for l in self.layers.order_by(Layer.index)
-            ]
-        else:
-            data["layers"] = [
-                l.as_dict(user, False)
-                for l in self.layers.order_by(Layer.index).where(Layer.player_visible)
-            ]
+        layers = self.layers.order_by(Layer.index)
+        if not dm:
+            layers = layers.where(Layer.player_visible)
+        layers = list(layers)
+        shape_data = get_layers_shape_data(layers, self.name)
+        data["layers"] = [l.as_dict(user, dm, shape_data[l.id]) for l in layers]
         return data
 
 
-class Layer(BaseModel):
+class Layer(RoomModel):
     floor = ForeignKeyField(Floor, backref="layers", on_delete="CASCADE")
     name = TextField()
     type_ = TextField()
@@ -245,8 +266,9 @@ class Layer(BaseModel):
     def get_path(self):
         return f"{self.floor.location.get_path()}/{self.name}"
 
-    def as_dict(self, user: User, dm: bool):
-        from .shape import Shape
+    def as_dict(self, user: User, dm: bool, shape_data=None):
+        from .shape import get_shape_view
+        from .shape.bulk import get_layers_shape_data
 
         data = model_to_dict(
             self,
@@ -254,20 +276,18 @@ class Layer(BaseModel):
             backrefs=False,
             exclude=[Layer.id, Layer.player_visible],
         )
-        groups_added: Set[Group] = set()
-        data["groups"] = []
-        data["shapes"] = []
-        for shape in self.shapes.order_by(Shape.index):
-            data["shapes"].append(shape.as_dict(user, dm))
-            if shape.group and not shape.group.uuid in groups_added:
-                data["groups"].append(model_to_dict(shape.group))
+        if shape_data is None:
+            shape_data = get_layers_shape_data([self], self.floor.name)[self.id]
+        shapes, groups = shape_data
+        data["shapes"] = [get_shape_view(shape, user, dm) for shape in shapes]
+        data["groups"] = groups
         return data
 
     class Meta:
         indexes = ((("floor", "name"), True), (("floor", "index"), True))
 
 
-class LocationUserOption(BaseModel):
+class LocationUserOption(RoomModel):
     location = ForeignKeyField(Location, backref="user_options", on_delete="CASCADE")
     user = ForeignKeyField(User, backref="location_options", on_delete="CASCADE")
     pan_x = IntegerField(default=0)
@@ -295,3 +315,107 @@ class LocationUserOption(BaseModel):
 
     class Meta:
         indexes = ((("location", "user"), True),)
+
+
+class LocationSnapshot:
+    """
+    Serialized state of a location, shared by all clients that load the location together.
+
+    The database is only queried when the snapshot is created.
+    The floor payloads of every audience (all DMs, every other user) are assembled from it in memory,
+    at most once per audience.
+    """
+
+    def __init__(self, location: Location) -> None:
+        from .shape.bulk import get_layers_shape_data
+        from .shape.journal import shape_journal
+        from .shape.spatial import spatial_index
+
+        # Changes made while the snapshot is created might be missing, so clients resynchronize from before them
+        self.version = shape_journal.version
+        spatial_version = spatial_index.version
+        self.location = location.as_dict()
+        self.locations = [
+            {"id": l.id, "name": l.name, "archived": l.archived}
+            for l in location.room.locations.order_by(Location.index)
+        ]
+        self.floors: List[Floor] = list(location.floors.order_by(Floor.index))
+
+        self._floor_data: Dict[int, Dict[str, Any]] = {}
+        self._layers: Dict[int, List[Layer]] = {}
+        self._shape_data: Dict[int, Any] = {}
+        for floor in self.floors:
+            self._floor_data[floor.id] = model_to_dict(
+                floor, recurse=False, exclude=[Floor.id, Floor.location]
+            )
+            layers = list(floor.layers.order_by(Layer.index))
+            self._layers[floor.id] = layers
+            floor_data = get_layers_shape_data(layers, floor.name)
+            self._shape_data.update(floor_data)
+            spatial_index.load_floor(
+                floor.id,
+                location.id,
+                floor_data.keys(),
+                (shape for shapes, _ in floor_data.values() for shape in shapes),
+                spatial_version,
+            )
+        self.shape_count = sum(len(shapes) for shapes, _ in self._shape_data.values())
+
+        # (floor id, user id or None for the DMs) -> floor payload
+        self._payloads: Dict[Tuple[int, Optional[int]], Dict[str, Any]] = {}
+
+    def get_floor(self, floor: Floor, user: User, dm: bool) -> Dict[str, Any]:
+        """
+        Returns the same data as `floor.as_dict(user, dm)`.
+
+        The returned dict is shared, it should not be modified.
+        """
+        key = (floor.id, None if dm else user.id)
+        payload = self._payloads.get(key)
+        if payload is None:
+            payload = self._payloads[key] = {
+                **self._floor_data[floor.id],
+                "layers": [
+                    layer.as_dict(user, dm, self._shape_data[layer.id])
+                    for layer in self._layers[floor.id]
+                    if dm or layer.player_visible
+                ],
+            }
+        return payload
+
+    def get_progressive_floor(
+        self,
+        floor: Floor,
+        user: User,
+        dm: bool,
+        viewport: Tuple[float, float, float, float],
+    ) -> Tuple[Dict[str, Any], List[Tuple[int, Dict[str, Any]]]]:
+        """
+        Splits the data of `get_floor` in the shapes that intersect the viewport and all other shapes.
+
+        The returned floor payload only contains the shapes in the viewport,
+        every layer lists the `indices` of those shapes in the complete layer.
+        The other shapes are returned together with their index, so that the client can insert them in the right order.
+        Composite shapes are always left for last, as their variants have to be loaded first.
+        """
+        from .shape.spatial import spatial_index
+
+        payload = self.get_floor(floor, user, dm)
+        in_viewport = spatial_index.query_box(floor.id, viewport)
+        layers = []
+        remaining: List[Tuple[int, Dict[str, Any]]] = []
+        composites: List[Tuple[int, Dict[str, Any]]] = []
+        for layer in payload["layers"]:
+            shapes = []
+            indices = []
+            for index, shape in enumerate(layer["shapes"]):
+                if shape["type_"] == "togglecomposite":
+                    composites.append((index, shape))
+                    continue
+                if shape["uuid"] in in_viewport:
+                    shapes.append(shape)
+                    indices.append(index)
+                else:
+                    remaining.append((index, shape))
+            layers.append({**layer, "shapes": shapes, "indices": indices})
+        return {**payload, "layers": layers}, remaining + composites
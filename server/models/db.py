@@ -1,14 +1,430 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, TypeVar
+from weakref import WeakKeyDictionary
+
+from peewee import DatabaseProxy, Proxy
 from playhouse.sqlite_ext import SqliteExtDatabase
 
-from config import SAVE_FILE
+from config import SAVE_FILE, config
+from utils import logger
+
+try:
+    from asyncio import current_task
+except ImportError:  # Python 3.6
+    current_task = asyncio.Task.current_task  # type: ignore
+
+T = TypeVar("T")
 
-db = SqliteExtDatabase(
-    SAVE_FILE,
-    pragmas={
-        # "journal_mode": "wal",
-        # "cache_size": -1 * 6400,
-        "foreign_keys": 1,
-        # "ignore_check_constraints": 0,
-        # "synchronous": 0,
+# The available database profiles trade durability for write throughput.
+#   safe: every commit is fsynced, a power loss never loses a committed change
+#   balanced: only checkpoints are fsynced, a power loss can lose the last few commits but never corrupts the save
+#   fast: nothing is fsynced, an OS crash or power loss during play can corrupt the save file
+DB_PROFILES: Dict[str, Dict[str, Any]] = {
+    "safe": {
+        "journal_mode": "wal",
+        "synchronous": 2,  # FULL
+        "cache_size": -1 * 8_000,  # 8MB
+        "mmap_size": 0,
+        "temp_store": 0,  # DEFAULT
+    },
+    "balanced": {
+        "journal_mode": "wal",
+        "synchronous": 1,  # NORMAL
+        "cache_size": -1 * 64_000,  # 64MB
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": 2,  # MEMORY
+    },
+    "fast": {
+        "journal_mode": "wal",
+        "synchronous": 0,  # OFF
+        "cache_size": -1 * 256_000,  # 256MB
+        "mmap_size": 1024 * 1024 * 1024,
+        "temp_store": 2,  # MEMORY
     },
-)
+}
+
+DB_PROFILE = config.get("Database", "profile", fallback="balanced").strip().lower()
+if DB_PROFILE not in DB_PROFILES:
+    logger.warning(f"Unknown database profile '{DB_PROFILE}', using 'balanced'")
+    DB_PROFILE = "balanced"
+
+DB_PRAGMAS = {
+    **DB_PROFILES[DB_PROFILE],
+    "foreign_keys": 1,
+    # "ignore_check_constraints": 0,
+}
+
+DB_THREAD_PREFIX = "db"
+
+# Where the locations, shapes and initiative of the rooms are stored, one of:
+#   shared: in the save file, together with the users, rooms and assets
+#   per_room: in a separate database file per room
+ROOM_STORAGE = config.get("Database", "room_storage", fallback="shared").strip().lower()
+if ROOM_STORAGE not in ("shared", "per_room"):
+    logger.warning(f"Unknown room storage '{ROOM_STORAGE}', using 'shared'")
+    ROOM_STORAGE = "shared"
+
+ROOM_FOLDER = Path(config.get("Database", "room_folder", fallback="rooms"))
+if not ROOM_FOLDER.is_absolute():
+    ROOM_FOLDER = Path(SAVE_FILE).parent / ROOM_FOLDER
+
+# Name under which the save file is attached to the connections of the room databases
+GLOBAL_SCHEMA = "global"
+# Rows of different rooms get their ids from separate ranges,
+# as the caches and socket.io room names that are keyed by these ids are shared by all rooms.
+ROOM_ID_SHIFT = 32
+
+
+class Database(SqliteExtDatabase):
+    # Set by `claim_connection` once the server starts
+    claimed = False
+
+    def _connect(self):
+        if self.claimed and not threading.current_thread().name.startswith(
+            DB_THREAD_PREFIX
+        ):
+            logger.warning(
+                "Database connection opened outside of the database thread",
+                stack_info=True,
+            )
+        return super()._connect()
+
+
+save_db = Database(SAVE_FILE, pragmas=DB_PRAGMAS)
+
+
+class RoomDatabases:
+    """
+    The databases of the rooms when every room is stored in its own file.
+
+    A room's database is opened when its room is first selected (see `use_room`) and closed again once it is idle.
+    Its connection has the save file attached, so queries can still join the global tables (users, rooms, assets, ...).
+    """
+
+    def __init__(self, folder: Path) -> None:
+        self.enabled = ROOM_STORAGE == "per_room"
+        self.folder = folder
+        self._databases: Dict[int, Database] = {}
+        self._last_used: Dict[int, float] = {}
+
+    def get_path(self, room_id: int) -> Path:
+        return self.folder / f"{room_id}.sqlite"
+
+    def get_stored_rooms(self) -> List[int]:
+        """
+        Returns the ids of the rooms that have a database file.
+        """
+        if not self.folder.is_dir():
+            return []
+        return sorted(
+            int(path.stem)
+            for path in self.folder.glob("*.sqlite")
+            if path.stem.isdigit()
+        )
+
+    def get(self, room_id: int) -> Database:
+        database = self._databases.get(room_id)
+        if database is not None:
+            return database
+
+        self.folder.mkdir(parents=True, exist_ok=True)
+        database = Database(
+            str(self.get_path(room_id)),
+            pragmas={
+                **DB_PRAGMAS,
+                # Writes to the global tables made through this connection are as durable as the other writes
+                f"{GLOBAL_SCHEMA}.synchronous": DB_PRAGMAS["synchronous"],
+            },
+        )
+        database.attach(save_db.database, GLOBAL_SCHEMA)
+        # Registered first, the tables of a new room are created through the room's own selection
+        self._databases[room_id] = database
+        self._last_used[room_id] = time.monotonic()
+        try:
+            self._prepare(room_id, database)
+        except Exception:
+            self.close(room_id)
+            raise
+        return database
+
+    def _prepare(self, room_id: int, database: Database) -> None:
+        from .base import create_room_tables
+
+        save_version = database.execute_sql(
+            f'SELECT save_version FROM "{GLOBAL_SCHEMA}".constants'
+        ).fetchone()[0]
+        room_version = database.execute_sql("PRAGMA user_version").fetchone()[0]
+        if room_version == 0:
+            with use_room(room_id):
+                create_room_tables(room_id)
+            database.execute_sql(f"PRAGMA user_version = {int(save_version)}")
+        elif room_version != save_version:
+            raise RuntimeError(
+                f"The database of room {room_id} has save format {room_version} instead of {save_version}"
+            )
+
+    def mark_used(self, room_id: int) -> None:
+        if room_id in self._last_used:
+            self._last_used[room_id] = time.monotonic()
+
+    def close(self, room_id: int) -> None:
+        """
+        Closes the connection of the current thread to a room database.
+        """
+        database = self._databases.pop(room_id, None)
+        self._last_used.pop(room_id, None)
+        if database is not None:
+            database.close()
+
+    def close_all(self) -> None:
+        for room_id in list(self._databases):
+            self.close(room_id)
+
+    def close_idle(self, max_idle: float) -> None:
+        """
+        Closes the room databases that have not been used for `max_idle` seconds.
+        """
+        now = time.monotonic()
+        for room_id, last_used in list(self._last_used.items()):
+            if now - last_used < max_idle:
+                continue
+            database = self._databases[room_id]
+            if database.in_transaction():
+                continue
+            try:
+                if not database.is_closed():
+                    database.execute_sql("PRAGMA optimize")
+            finally:
+                self.close(room_id)
+
+    def remove(self, room_id: int) -> None:
+        """
+        Closes and deletes the database of a room.
+        """
+        self.close(room_id)
+        path = self.get_path(room_id)
+        for suffix in ("-wal", "-shm", ""):
+            file = path.with_name(path.name + suffix)
+            if file.exists():
+                file.unlink()
+
+    def remove_unused(self, room_ids: Iterable[int]) -> None:
+        """
+        Deletes the databases of the rooms that are no longer in the given room ids.
+        """
+        for room_id in set(self.get_stored_rooms()) - set(room_ids):
+            self.remove(room_id)
+
+
+room_databases = RoomDatabases(ROOM_FOLDER)
+
+# The room whose database is used by the queries of the current thread
+_selection = threading.local()
+
+
+@contextmanager
+def use_room(room_id: Optional[int]) -> Iterator[None]:
+    """
+    Runs the queries on room data made by the current thread in the given room until the block ends.
+
+    With the shared room storage, all rooms are in the save file and this has no effect.
+    """
+    previous = getattr(_selection, "room_id", None)
+    _selection.room_id = room_id
+    try:
+        yield
+    finally:
+        _selection.room_id = previous
+        if room_id is not None:
+            room_databases.mark_used(room_id)
+
+
+@contextmanager
+def use_save_file() -> Iterator[None]:
+    """
+    Runs the queries on room data made by the current thread in the save file until the block ends,
+    e.g. to create or migrate its (unused) room tables.
+    """
+    previous = getattr(_selection, "save_file", False)
+    _selection.save_file = True
+    try:
+        with use_room(None):
+            yield
+    finally:
+        _selection.save_file = previous
+
+
+def get_room_scopes() -> List[Optional[int]]:
+    """
+    Returns the rooms to select (see `use_room`) in turn to reach the data of every room.
+    """
+    if room_databases.enabled:
+        return [*room_databases.get_stored_rooms()]
+    return [None]
+
+
+class RoomDatabaseProxy(DatabaseProxy):
+    """
+    Runs the queries of its models on the database of the room that is selected on the current thread (see `use_room`).
+
+    The save file is used when rooms share it, when no room is selected and `room_only` is not set, or within `use_save_file`.
+    """
+
+    def __init__(self, room_only: bool) -> None:
+        super().__init__()
+        object.__setattr__(self, "room_only", room_only)
+
+    def get_database(self) -> Database:
+        if room_databases.enabled:
+            room_id = getattr(_selection, "room_id", None)
+            if room_id is not None:
+                return room_databases.get(room_id)
+            if self.room_only and not getattr(_selection, "save_file", False):
+                raise RuntimeError(
+                    "Room data can only be queried after selecting its room (see models.db.use_room)"
+                )
+        return save_db
+
+    def attach_callback(self, callback):
+        # The fields that are bound to the proxy pick the binary type of the database they will use
+        callback(save_db)
+        return super().attach_callback(callback)
+
+    def __getattr__(self, attr):
+        return getattr(self.get_database(), attr)
+
+    def __setattr__(self, attr, value):
+        if attr in Proxy.__slots__:
+            super().__setattr__(attr, value)
+        else:
+            setattr(self.get_database(), attr, value)
+
+
+# Used by the global models (users, rooms, assets, ...), within a room they are reached through its connection
+db = RoomDatabaseProxy(room_only=False)
+# Used by the models of the room data (locations, shapes, initiative, ...)
+room_db = RoomDatabaseProxy(room_only=True)
+
+# Peewee keeps a separate connection per thread,
+# once the server runs this executor's single thread is the only owner of a connection.
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=DB_THREAD_PREFIX)
+
+# The room selected by a task for the database functions it runs,
+# Python 3.6 has no context variables, so new tasks inherit it through `inherit_room` instead.
+_task_rooms: "WeakKeyDictionary[asyncio.Task, int]" = WeakKeyDictionary()
+
+
+def _get_task() -> "Optional[asyncio.Task]":
+    try:
+        return current_task()
+    except RuntimeError:  # No running event loop
+        return None
+
+
+def select_room(room_id: Optional[int]) -> None:
+    """
+    Makes `run_db` use the given room for the database functions of the current task and of the tasks it starts.
+    """
+    task = _get_task()
+    if task is None:
+        return
+    if room_id is None:
+        _task_rooms.pop(task, None)
+    else:
+        _task_rooms[task] = room_id
+
+
+def get_selected_room() -> Optional[int]:
+    task = _get_task()
+    return None if task is None else _task_rooms.get(task)
+
+
+def inherit_room(loop: asyncio.AbstractEventLoop, coro, **kwargs) -> asyncio.Task:
+    """
+    Task factory that lets new tasks use the room selected by the task that started them.
+    """
+    room_id = get_selected_room()
+    task = asyncio.Task(coro, loop=loop, **kwargs)
+    if room_id is not None:
+        _task_rooms[task] = room_id
+    return task
+
+
+def claim_connection() -> None:
+    """
+    Closes the connection of the current thread, all later database access should go through `run_db`.
+
+    Connections that are opened on other threads afterwards are logged.
+    """
+    save_db.close()
+    room_databases.close_all()
+    Database.claimed = True
+
+
+def _run_in_room(room_id: Optional[int], fn: Callable[[], T]) -> T:
+    with use_room(room_id):
+        return fn()
+
+
+async def run_db(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Runs a (blocking) database function on the database thread.
+
+    All database access of the handlers goes through here,
+    so that the event loop never waits on a query or on sqlite's write lock.
+    The function runs in the room selected by the calling task (see `select_room`).
+    Functions should only return loaded data, lazily loaded foreign keys would query the database on the calling thread.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        db_executor,
+        partial(_run_in_room, get_selected_room(), partial(fn, *args, **kwargs)),
+    )
+
+
+def close_db() -> None:
+    """
+    Closes the connections of the current thread to the save file and the room databases.
+    """
+    room_databases.close_all()
+    save_db.close()
+
+
+def optimize_db() -> None:
+    """
+    Moves the WAL content back into the save file and lets sqlite refresh the statistics used by its query planner.
+    """
+    save_db.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    save_db.execute_sql("PRAGMA optimize")
+
+
+async def maintain_db() -> None:
+    """
+    Periodically runs `optimize_db` on the database thread.
+    """
+    interval = config.getfloat("Database", "maintenance_interval", fallback=300)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_db(optimize_db)
+        except Exception:
+            logger.exception("Database maintenance failed")
+
+
+async def close_idle_rooms() -> None:
+    """
+    Periodically closes the room databases that are no longer used.
+    """
+    max_idle = config.getfloat("Database", "room_idle_timeout", fallback=300)
+    while True:
+        await asyncio.sleep(min(max_idle, 60))
+        try:
+            await run_db(room_databases.close_idle, max_idle)
+        except Exception:
+            logger.exception("Could not close the idle room databases")
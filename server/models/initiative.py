@@ -2,13 +2,13 @@ from peewee import BooleanField, ForeignKeyField, IntegerField, TextField
 from playhouse.shortcuts import model_to_dict
 
 from . import Location
-from .base import BaseModel
+from .base import RoomModel
 
 
 __all__ = ["Initiative", "InitiativeEffect", "InitiativeLocationData"]
 
 
-class InitiativeLocationData(BaseModel):
+class InitiativeLocationData(RoomModel):
     location = ForeignKeyField(Location, backref="initiative", on_delete="CASCADE")
     # instead of pointing to a numeric index, we point to the uuid
     # this guarantees that the correct actor is always highlighted
@@ -16,7 +16,7 @@ class InitiativeLocationData(BaseModel):
     round = IntegerField()
 
 
-class Initiative(BaseModel):
+class Initiative(RoomModel):
     uuid = TextField(primary_key=True)
     initiative = IntegerField(null=True)
     visible = BooleanField(default=False)
@@ -35,7 +35,7 @@ class Initiative(BaseModel):
         return init
 
 
-class InitiativeEffect(BaseModel):
+class InitiativeEffect(RoomModel):
     uuid = TextField(primary_key=True)
     initiative = ForeignKeyField(Initiative, backref="effects", on_delete="CASCADE")
     name = TextField()
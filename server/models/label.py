@@ -1,7 +1,7 @@
 from peewee import BooleanField, ForeignKeyField, TextField
 from playhouse.shortcuts import model_to_dict
 
-from .base import BaseModel
+from .base import BaseModel, RoomModel
 from .campaign import Room
 from .user import User
 
@@ -22,7 +22,7 @@ class Label(BaseModel):
         return d
 
 
-class LabelSelection(BaseModel):
+class LabelSelection(RoomModel):
     label = ForeignKeyField(Label, on_delete="CASCADE")
     user = ForeignKeyField(User, on_delete="CASCADE")
     room = ForeignKeyField(Room, on_delete="CASCADE")
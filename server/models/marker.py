@@ -1,13 +1,13 @@
 from peewee import ForeignKeyField
 
-from .base import BaseModel
+from .base import RoomModel
 from .campaign import Location
 from .user import User
 
 __all__ = ["Marker"]
 
 
-class Marker(BaseModel):
+class Marker(RoomModel):
     from .shape import Shape
 
     shape = ForeignKeyField(Shape, backref="markers", on_delete="CASCADE")
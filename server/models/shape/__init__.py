@@ -1,16 +1,33 @@
 import json
 
-from peewee import BooleanField, FloatField, ForeignKeyField, IntegerField, TextField
+from peewee import (
+    BlobField,
+    BooleanField,
+    FloatField,
+    ForeignKeyField,
+    IntegerField,
+    TextField,
+)
 from playhouse.shortcuts import model_to_dict, update_model_from_dict
-from typing import Any, Dict, List, Tuple
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    overload,
+)
 
 from utils import logger
 from ..asset import Asset
-from ..base import BaseModel
+from ..base import BaseModel, RoomModel
 from ..campaign import Layer
 from ..groups import Group
 from ..label import Label
 from ..user import User
+from .geometry import pack_points, unpack_points
 
 
 __all__ = [
@@ -29,7 +46,7 @@ __all__ = [
 ]
 
 
-class Shape(BaseModel):
+class Shape(RoomModel):
     uuid = TextField(primary_key=True)
     layer = ForeignKeyField(Layer, backref="shapes", on_delete="CASCADE")
     type_ = TextField()
@@ -61,6 +78,9 @@ class Shape(BaseModel):
     annotation_visible = BooleanField(default=False)
     ignore_zoom_size = BooleanField(default=False)
 
+    class Meta:
+        indexes = ((("layer", "index"), False),)
+
     def __repr__(self):
         return f"<Shape {self.get_path()}>"
 
@@ -78,6 +98,16 @@ class Shape(BaseModel):
 
     # todo: Change this API to accept a PlayerRoom instead
     def as_dict(self, user: User, dm: bool):
+        from .cache import shape_payloads
+
+        return shape_payloads.get(self, user, dm)
+
+    def serialize(self) -> Dict[str, Any]:
+        """
+        Returns the full serialization of the shape, as seen by the DM.
+
+        Use `as_dict` to get the (cached) version for a specific user.
+        """
         data = model_to_dict(self, recurse=False, exclude=[Shape.layer, Shape.index])
         # Owner query > list of usernames
         data["owners"] = [owner.as_dict() for owner in self.owners]
@@ -85,26 +115,9 @@ class Shape(BaseModel):
         data["layer"] = self.layer.name
         data["floor"] = self.layer.floor.name
         # Aura and Tracker queries > json
-        owned = (
-            dm
-            or self.default_edit_access
-            or self.default_vision_access
-            or any(user.name == o["user"] for o in data["owners"])
-        )
-        tracker_query = self.trackers
-        aura_query = self.auras
-        label_query = self.labels.join(Label)
-        if not owned:
-            if not self.annotation_visible:
-                data["annotation"] = ""
-            tracker_query = tracker_query.where(Tracker.visible)
-            aura_query = aura_query.where(Aura.visible)
-            label_query = label_query.where(Label.visible)
-            if not self.name_visible:
-                data["name"] = "?"
-        data["trackers"] = [t.as_dict() for t in tracker_query]
-        data["auras"] = [a.as_dict() for a in aura_query]
-        data["labels"] = [l.as_dict() for l in label_query]
+        data["trackers"] = [t.as_dict() for t in self.trackers]
+        data["auras"] = [a.as_dict() for a in self.auras]
+        data["labels"] = [sl.label.as_dict() for sl in self.labels]
         # Subtype
         data.update(**self.subtype.as_dict(exclude=[self.subtype.__class__.shape]))
         return data
@@ -119,7 +132,36 @@ class Shape(BaseModel):
         return getattr(self, f"{self.type_}_set").get()
 
 
-class ShapeLabel(BaseModel):
+def get_shape_view(data: Dict[str, Any], user: User, dm: bool) -> Dict[str, Any]:
+    """
+    Returns the version of a fully serialized shape that the given user is allowed to see.
+
+    Non-owners only get the visible trackers, auras and labels
+    and have the name/annotation hidden if these are not public.
+    """
+    owned = (
+        dm
+        or data["default_edit_access"]
+        or data["default_vision_access"]
+        or any(user.name == o["user"] for o in data["owners"])
+    )
+    if owned:
+        return data
+
+    view = {
+        **data,
+        "trackers": [t for t in data["trackers"] if t["visible"]],
+        "auras": [a for a in data["auras"] if a["visible"]],
+        "labels": [l for l in data["labels"] if l["visible"]],
+    }
+    if not data["annotation_visible"]:
+        view["annotation"] = ""
+    if not data["name_visible"]:
+        view["name"] = "?"
+    return view
+
+
+class ShapeLabel(RoomModel):
     shape = ForeignKeyField(Shape, backref="labels", on_delete="CASCADE")
     label = ForeignKeyField(Label, backref="shapes", on_delete="CASCADE")
 
@@ -127,7 +169,7 @@ class ShapeLabel(BaseModel):
         return self.label.as_dict()
 
 
-class Tracker(BaseModel):
+class Tracker(RoomModel):
     uuid = TextField(primary_key=True)
     shape = ForeignKeyField(Shape, backref="trackers", on_delete="CASCADE")
     visible = BooleanField()
@@ -142,7 +184,7 @@ class Tracker(BaseModel):
         return model_to_dict(self, recurse=False, exclude=[Tracker.shape])
 
 
-class Aura(BaseModel):
+class Aura(RoomModel):
     uuid = TextField(primary_key=True)
     shape = ForeignKeyField(Shape, backref="auras", on_delete="CASCADE")
     vision_source = BooleanField()
@@ -163,7 +205,7 @@ class Aura(BaseModel):
         return model_to_dict(self, recurse=False, exclude=[Aura.shape])
 
 
-class ShapeOwner(BaseModel):
+class ShapeOwner(RoomModel):
     shape = ForeignKeyField(Shape, backref="owners", on_delete="CASCADE")
     user = ForeignKeyField(User, backref="shapes", on_delete="CASCADE")
     edit_access = BooleanField()
@@ -183,7 +225,7 @@ class ShapeOwner(BaseModel):
         }
 
 
-class ShapeType(BaseModel):
+class ShapeType(RoomModel):
     shape = ForeignKeyField(Shape, primary_key=True, on_delete="CASCADE")
 
     @staticmethod
@@ -241,28 +283,50 @@ class Line(ShapeType):
         return (self.x2 - self.x) / 2, (self.y2 - self.y) / 2
 
 
-class Polygon(ShapeType):
-    vertices = TextField()
-    line_width = IntegerField()
-    open_polygon = BooleanField()
+class PointsField(BlobField):
+    """
+    List of [x, y] points, stored as packed float64 values (see models.shape.geometry.pack_points).
+    """
 
-    @staticmethod
-    def pre_create(**kwargs):
-        kwargs["vertices"] = json.dumps(kwargs["vertices"])
-        return kwargs
+    if TYPE_CHECKING:
+        # peewee replaces the field with an accessor on the model, this only describes the values it holds
 
-    def as_dict(self, *args, **kwargs):
-        model = model_to_dict(self, *args, **kwargs)
-        model["vertices"] = json.loads(model["vertices"])
-        return model
+        @overload
+        def __get__(self, instance: None, owner: Any) -> "PointsField":
+            ...
 
-    def update_from_dict(self, data, *args, **kwargs):
-        data["vertices"] = json.dumps(data["vertices"])
-        return update_model_from_dict(self, data, *args, **kwargs)
+        @overload
+        def __get__(
+            self, instance: BaseModel, owner: Any
+        ) -> Optional[List[List[float]]]:
+            ...
+
+        def __get__(self, instance: Any, owner: Any) -> Any:
+            ...
+
+        def __set__(
+            self, instance: BaseModel, value: Optional[Sequence[Sequence[float]]]
+        ) -> None:
+            ...
+
+    def db_value(self, value: Optional[Sequence[Sequence[float]]]) -> Optional[bytes]:
+        if value is None:
+            return None
+        return super().db_value(pack_points(value))
+
+    def python_value(self, value: Optional[bytes]) -> Optional[List[List[float]]]:
+        if value is None:
+            return None
+        return unpack_points(value)
+
+
+class Polygon(ShapeType):
+    vertices = PointsField()
+    line_width = IntegerField()
+    open_polygon = BooleanField()
 
     def set_location(self, points: List[List[int]]) -> None:
-        self.vertices = json.dumps(points)
-        self.save()
+        self.vertices = points
 
 
 class Rect(BaseRect):
@@ -297,7 +361,7 @@ class ToggleComposite(ShapeType):
         return model
 
 
-class CompositeShapeAssociation(BaseModel):
+class CompositeShapeAssociation(RoomModel):
     variant = ForeignKeyField(Shape, backref="composite_parent", on_delete="CASCADE")
     parent = ForeignKeyField(Shape, backref="shape_variants", on_delete="CASCADE")
     name = TextField()
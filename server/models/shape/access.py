@@ -1,8 +1,241 @@
-from models.campaign import PlayerRoom
+from threading import Lock
+from typing import Dict, Optional, Set, Tuple
+
+from peewee import Model
+
+import cluster
+from models.campaign import Floor, Layer, Location, PlayerRoom, Room
 from models.role import Role
 from models.shape import Shape, ShapeOwner
 
 
+class ShapePermissions:
+    __slots__ = ("layer_id", "default_edit_access", "default_movement_access", "owners")
+
+    def __init__(
+        self,
+        layer_id: int,
+        default_edit_access: bool,
+        default_movement_access: bool,
+        owners: Set[int],
+    ) -> None:
+        self.layer_id = layer_id
+        self.default_edit_access = default_edit_access
+        self.default_movement_access = default_movement_access
+        self.owners = owners
+
+
+class PermissionIndex:
+    """
+    In-memory index of the information needed to check shape ownership.
+
+    The index is kept per location and only for the locations that have clients on this server process,
+    it is dropped when the last client leaves a location (see state.game).
+    The permissions of all shapes on a layer are loaded together the first time one of them is checked
+    and are afterwards kept up to date by the model signals and the in-memory room state.
+    The other workers drop their copy of entries whose ownership changed when running with multiple worker processes.
+    """
+
+    def __init__(self) -> None:
+        # location id -> shape uuid -> permissions
+        self._locations: Dict[int, Dict[str, ShapePermissions]] = {}
+        # layer id -> (location id, player_editable), for the loaded layers
+        self._layers: Dict[int, Tuple[int, bool]] = {}
+        self._lock = Lock()
+
+    def activate(self, location_id: int) -> None:
+        """
+        Starts indexing the shapes on the location.
+        """
+        with self._lock:
+            self._locations.setdefault(location_id, {})
+
+    def evict(self, location_id: int) -> None:
+        """
+        Drops the index of the location and stops indexing it.
+        """
+        with self._lock:
+            self._locations.pop(location_id, None)
+            self._layers = {
+                layer: info
+                for layer, info in self._layers.items()
+                if info[0] != location_id
+            }
+
+    def get(self, shape: Shape) -> ShapePermissions:
+        info = self._layers.get(shape.layer_id)
+        location_id = self._load_layer(shape.layer_id) if info is None else info[0]
+
+        with self._lock:
+            shapes = self._locations.get(location_id)
+            permissions = None if shapes is None else shapes.get(shape.uuid)
+        if permissions is not None:
+            return permissions
+
+        permissions = ShapePermissions(
+            shape.layer_id,
+            shape.default_edit_access,
+            shape.default_movement_access,
+            {
+                owner.user_id
+                for owner in ShapeOwner.select(ShapeOwner.user).where(
+                    ShapeOwner.shape == shape.uuid
+                )
+            },
+        )
+        with self._lock:
+            shapes = self._locations.get(location_id)
+            if shapes is None:
+                # The location is not indexed, so don't keep the layer either
+                self._layers.pop(shape.layer_id, None)
+                return permissions
+            return shapes.setdefault(shape.uuid, permissions)
+
+    def is_layer_editable(self, layer_id: int) -> bool:
+        info = self._layers.get(layer_id)
+        if info is not None:
+            return info[1]
+        return Layer.select(Layer.player_editable).where(Layer.id == layer_id).scalar()
+
+    def remove_owner(self, shape_id: str, user_id: int) -> None:
+        permissions = self._find(shape_id)
+        if permissions is None or user_id in permissions.owners:
+            if permissions is not None:
+                permissions.owners.discard(user_id)
+            cluster.publish("cache.permissions", shape_id, None)
+
+    def forget(self, shape_id: str) -> None:
+        self._forget(shape_id)
+        cluster.publish("cache.permissions", shape_id, None)
+
+    def _find(self, shape_id: str) -> Optional[ShapePermissions]:
+        with self._lock:
+            for shapes in self._locations.values():
+                if shape_id in shapes:
+                    return shapes[shape_id]
+        return None
+
+    def _forget(self, shape_id: str) -> None:
+        with self._lock:
+            for shapes in self._locations.values():
+                shapes.pop(shape_id, None)
+
+    def _forget_layer(self, layer_id: int) -> None:
+        with self._lock:
+            info = self._layers.pop(layer_id, None)
+            if info is None or info[0] not in self._locations:
+                return
+            shapes = self._locations[info[0]]
+            for uuid in [u for u, p in shapes.items() if p.layer_id == layer_id]:
+                del shapes[uuid]
+
+    def update_instance(self, instance: Model) -> None:
+        """
+        Applies a (pending) write of the given instance to the index.
+
+        The other workers are only notified when the ownership actually changed,
+        or when it is unknown whether it did because the shape is not indexed here.
+        """
+        if isinstance(instance, Shape):
+            permissions = self._find(instance.uuid)
+            if permissions is not None and (
+                permissions.layer_id,
+                permissions.default_edit_access,
+                permissions.default_movement_access,
+            ) == (
+                instance.layer_id,
+                instance.default_edit_access,
+                instance.default_movement_access,
+            ):
+                return
+            # Loaded again on the next check, the shape can also have moved to another location
+            self._forget(instance.uuid)
+            cluster.publish("cache.permissions", instance.uuid, None)
+        elif isinstance(instance, ShapeOwner):
+            permissions = self._find(instance.shape_id)
+            if permissions is not None:
+                if instance.user_id in permissions.owners:
+                    return
+                permissions.owners.add(instance.user_id)
+            cluster.publish("cache.permissions", instance.shape_id, None)
+        elif isinstance(instance, Layer):
+            info = self._layers.get(instance.id)
+            if info is not None:
+                if info[1] == instance.player_editable:
+                    return
+                self._layers[instance.id] = (info[0], instance.player_editable)
+            cluster.publish("cache.permissions", None, instance.id)
+
+    def delete_instance(self, instance: Model) -> None:
+        """
+        Removes a deleted instance from the index.
+        """
+        if isinstance(instance, Shape):
+            self.forget(instance.uuid)
+        elif isinstance(instance, ShapeOwner):
+            self.remove_owner(instance.shape_id, instance.user_id)
+        # The shapes of the containers below are removed by the database cascade,
+        # the other workers drop the stale entries when their clients leave the location.
+        elif isinstance(instance, Layer):
+            self._forget_layer(instance.id)
+        elif isinstance(instance, Floor):
+            for layer in Layer.select(Layer.id).where(Layer.floor == instance):
+                self._forget_layer(layer.id)
+        elif isinstance(instance, Location):
+            self.evict(instance.id)
+        elif isinstance(instance, Room):
+            for location in Location.select(Location.id).where(
+                Location.room == instance
+            ):
+                self.evict(location.id)
+
+    def _load_layer(self, layer_id: int) -> int:
+        """
+        Loads the permissions of all shapes on the layer if its location is indexed and returns the location id.
+        """
+        layer = (
+            Layer.select(Layer.player_editable, Floor.location)
+            .join(Floor)
+            .where(Layer.id == layer_id)
+            .get()
+        )
+        location_id = layer.floor.location_id
+        permissions: Dict[str, ShapePermissions] = {}
+        if location_id in self._locations:
+            shapes = Shape.select(
+                Shape.uuid, Shape.default_edit_access, Shape.default_movement_access
+            ).where(Shape.layer == layer_id)
+            for shape in shapes:
+                permissions[shape.uuid] = ShapePermissions(
+                    layer_id,
+                    shape.default_edit_access,
+                    shape.default_movement_access,
+                    set(),
+                )
+            for owner in ShapeOwner.select(ShapeOwner.shape, ShapeOwner.user).where(
+                ShapeOwner.shape << shapes.select(Shape.uuid)
+            ):
+                permissions[owner.shape_id].owners.add(owner.user_id)
+
+        with self._lock:
+            self._layers[layer_id] = (location_id, layer.player_editable)
+            if location_id in self._locations:
+                for uuid, shape_permissions in permissions.items():
+                    self._locations[location_id].setdefault(uuid, shape_permissions)
+        return location_id
+
+
+permission_index = PermissionIndex()
+
+
+@cluster.on("cache.permissions")
+def _forget_remote(shape_id: Optional[str], layer_id: Optional[int]) -> None:
+    if shape_id is not None:
+        permission_index._forget(shape_id)
+    if layer_id is not None:
+        permission_index._forget_layer(layer_id)
+
+
 def has_ownership(shape: Shape, pr: PlayerRoom, movement=False) -> bool:
     if shape is None:
         return False
@@ -10,13 +243,15 @@ def has_ownership(shape: Shape, pr: PlayerRoom, movement=False) -> bool:
     if pr.role == Role.DM:
         return True
 
-    if not shape.layer.player_editable:
+    permissions = permission_index.get(shape)
+
+    if not permission_index.is_layer_editable(permissions.layer_id):
         return False
 
-    if shape.default_edit_access:
+    if permissions.default_edit_access:
         return True
 
-    if movement and shape.default_movement_access:
+    if movement and permissions.default_movement_access:
         return True
 
-    return ShapeOwner.get_or_none(shape=shape, user=pr.player) is not None
+    return pr.player_id in permissions.owners
@@ -0,0 +1,238 @@
+"""
+Bulk operations on shapes.
+
+Handling shapes one by one needs a handful of queries for every single shape (owners, trackers, auras, labels, subtype, ...),
+which adds up quickly on big maps.
+The functions in this module work on a whole group of shapes with a fixed number of queries,
+e.g. by serializing all shapes of a set of layers at once and assembling the shape dicts in memory.
+"""
+
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Tuple
+
+from peewee import Case, chunked, fn
+from playhouse.shortcuts import model_to_dict
+
+from ..campaign import Floor, Layer, Location
+from ..db import db
+from ..groups import Group
+from ..label import Label
+from ..user import User
+from ..utils import get_table
+from . import (
+    Aura,
+    CompositeShapeAssociation,
+    Shape,
+    ShapeLabel,
+    ShapeOwner,
+    ToggleComposite,
+    Tracker,
+)
+from .access import permission_index
+from .cache import shape_payloads
+from .order import ORDER_STEP, get_next_index
+from .spatial import spatial_index
+
+ShapeDict = Dict[str, Any]
+LayerShapeData = Tuple[List[ShapeDict], List[Dict[str, Any]]]
+
+# Keeps the number of bound parameters per statement below sqlite's limit
+CHUNK_SIZE = 100
+
+
+def get_layers_shape_data(
+    layers: List[Layer], floor_name: str
+) -> Dict[int, LayerShapeData]:
+    """
+    Serializes all shapes on the provided layers.
+
+    The returned mapping contains for every layer id the full (owner-level) shape dicts sorted by index
+    and the info of the groups used by those shapes.
+    Use `get_shape_view` to get the version of a shape that a specific user is allowed to see.
+    """
+    layer_names = {layer.id: layer.name for layer in layers}
+    data: Dict[int, LayerShapeData] = {layer.id: ([], []) for layer in layers}
+
+    if not layers:
+        return data
+
+    version = shape_payloads.version
+    shape_query = Shape.select().where(Shape.layer << list(layer_names.keys()))
+    uuid_query = Shape.select(Shape.uuid).where(Shape.layer << list(layer_names.keys()))
+
+    shapes: List[Shape] = list(shape_query.order_by(Shape.index))
+    if not shapes:
+        return data
+
+    owners: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for owner in (
+        ShapeOwner.select(ShapeOwner, User.name)
+        .join(User)
+        .where(ShapeOwner.shape << uuid_query)
+    ):
+        owners[owner.shape_id].append(
+            {
+                "shape": owner.shape_id,
+                "user": owner.user.name,
+                "edit_access": owner.edit_access,
+                "movement_access": owner.movement_access,
+                "vision_access": owner.vision_access,
+            }
+        )
+
+    trackers: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for tracker in Tracker.select().where(Tracker.shape << uuid_query):
+        trackers[tracker.shape_id].append(tracker.as_dict())
+
+    auras: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for aura in Aura.select().where(Aura.shape << uuid_query):
+        auras[aura.shape_id].append(aura.as_dict())
+
+    labels: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for shape_label in (
+        ShapeLabel.select(ShapeLabel, Label, User)
+        .join(Label)
+        .join(User)
+        .where(ShapeLabel.shape << uuid_query)
+    ):
+        labels[shape_label.shape_id].append(shape_label.label.as_dict())
+
+    subtypes: Dict[str, Dict[str, Any]] = {}
+    for type_ in {shape.type_ for shape in shapes}:
+        type_table = get_table(type_)
+        for subshape in type_table.select().where(type_table.shape << uuid_query):
+            if type_table is ToggleComposite:
+                # The variants are added below in a single query for all composites
+                subtype_data = model_to_dict(subshape, exclude=[type_table.shape])
+                subtype_data["variants"] = []
+            else:
+                subtype_data = subshape.as_dict(exclude=[type_table.shape])
+            subtypes[subshape.shape_id] = subtype_data
+
+    for association in CompositeShapeAssociation.select().where(
+        CompositeShapeAssociation.parent << uuid_query
+    ):
+        if association.parent_id in subtypes:
+            subtypes[association.parent_id]["variants"].append(
+                {"uuid": association.variant_id, "name": association.name}
+            )
+
+    groups: Dict[str, Dict[str, Any]] = {
+        group.uuid: model_to_dict(group)
+        for group in Group.select().where(
+            Group.uuid << uuid_query.select(fn.DISTINCT(Shape.group))
+        )
+    }
+
+    # The layers are all on the same floor
+    location_id = shape_payloads.get_location_id(layers[0].id)
+    groups_added: Dict[int, set] = defaultdict(set)
+    for shape in shapes:
+        shape_data = model_to_dict(
+            shape, recurse=False, exclude=[Shape.layer, Shape.index]
+        )
+        shape_data["owners"] = owners.get(shape.uuid, [])
+        shape_data["layer"] = layer_names[shape.layer_id]
+        shape_data["floor"] = floor_name
+        shape_data["trackers"] = trackers.get(shape.uuid, [])
+        shape_data["auras"] = auras.get(shape.uuid, [])
+        shape_data["labels"] = labels.get(shape.uuid, [])
+        shape_data.update(**subtypes.get(shape.uuid, {}))
+        if location_id is not None:
+            shape_payloads.store(shape.uuid, location_id, shape_data, version)
+
+        layer_shapes, layer_groups = data[shape.layer_id]
+        layer_shapes.append(shape_data)
+        if (
+            shape.group_id in groups
+            and shape.group_id not in groups_added[shape.layer_id]
+        ):
+            groups_added[shape.layer_id].add(shape.group_id)
+            layer_groups.append(groups[shape.group_id])
+
+    return data
+
+
+def get_location_shapes(location: Location, uuids: Iterable[str]) -> List[Shape]:
+    """
+    Returns the shapes with the given uuids that are on the given location, together with their layer.
+    """
+    shapes: List[Shape] = []
+    for chunk in chunked(list(uuids), CHUNK_SIZE):
+        shapes.extend(
+            Shape.select(Shape, Layer)
+            .join(Layer)
+            .join(Floor)
+            .where((Floor.location == location) & (Shape.uuid << chunk))
+        )
+    return shapes
+
+
+def delete_shapes(uuids: List[str]) -> None:
+    """
+    Removes the shapes and all rows that depend on them (subtype, trackers, auras, owners, labels, markers, ...).
+
+    Every dependent table is cleared with a single statement per chunk instead of a query per shape.
+    """
+    with db.atomic():
+        for chunk in chunked(uuids, CHUNK_SIZE):
+            for fk, rel_model in Shape._meta.backrefs.items():
+                if fk.null:
+                    rel_model.update(**{fk.name: None}).where(fk << chunk).execute()
+                else:
+                    rel_model.delete().where(fk << chunk).execute()
+            Shape.delete().where(Shape.uuid << chunk).execute()
+
+    shape_payloads.invalidate(uuids)
+    for uuid in uuids:
+        permission_index.forget(uuid)
+        spatial_index.forget(uuid)
+
+
+def move_shapes_to_floor(
+    uuids: List[str], floor: Floor, x: float, y: float
+) -> List[Shape]:
+    """
+    Moves the shapes to the layers with the same name on the given floor and centers each of them at (x, y).
+
+    The moved shapes are returned with their new values.
+    """
+    layers = {layer.name: layer for layer in floor.layers}
+    shapes: List[Shape] = list(
+        Shape.select(Shape, Layer).join(Layer).where(Shape.uuid << uuids)
+    )
+
+    subtypes: Dict[str, Any] = {}
+    for type_ in {shape.type_ for shape in shapes}:
+        type_table = get_table(type_)
+        for subshape in type_table.select().where(
+            type_table.shape << [shape.uuid for shape in shapes if shape.type_ == type_]
+        ):
+            subtypes[subshape.shape_id] = subshape
+
+    next_indices: Dict[int, int] = {}
+    for shape in shapes:
+        layer = layers[shape.layer.name]
+        if layer.id not in next_indices:
+            next_indices[layer.id] = get_next_index(layer)
+        shape.layer = layer
+        shape.index = next_indices[layer.id]
+        next_indices[layer.id] += ORDER_STEP
+        x_off, y_off = subtypes[shape.uuid].get_center_offset(x, y)
+        shape.x = x - x_off
+        shape.y = y - y_off
+
+    with db.atomic():
+        for chunk in chunked(shapes, CHUNK_SIZE):
+            Shape.update(
+                layer=Case(Shape.uuid, [(s.uuid, s.layer_id) for s in chunk]),
+                index=Case(Shape.uuid, [(s.uuid, s.index) for s in chunk]),
+                x=Case(Shape.uuid, [(s.uuid, s.x) for s in chunk]),
+                y=Case(Shape.uuid, [(s.uuid, s.y) for s in chunk]),
+            ).where(Shape.uuid << [s.uuid for s in chunk]).execute()
+
+    shape_payloads.invalidate([shape.uuid for shape in shapes])
+    for shape in shapes:
+        permission_index.update_instance(shape)
+        spatial_index.update_instance(shape)
+    return shapes
@@ -0,0 +1,261 @@
+"""
+Cache of serialized shape payloads.
+
+A shape is sent to clients in one of three visibility classes:
+the DM view, the owner view (which contains the same information) and the public view for everyone else.
+The payload of every class is computed at most once after each change to the shape,
+no matter how many clients it is sent to.
+
+Payloads are only cached for the locations that have clients on this server process
+and are dropped when the last client leaves a location (see state.game).
+
+Entries are invalidated from the model signals and the in-memory room state whenever a shape
+or one of the rows that end up in its payload (subtype, trackers, auras, owners, labels, layer name, ...) is written.
+Invalidations are shared with the other workers when running with multiple worker processes
+and are recorded in the shape journal (see models.shape.journal).
+"""
+
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+
+from peewee import Model
+
+import cluster
+from ..asset import Asset
+from ..campaign import Floor, Layer, Location, Room
+from ..db import get_room_scopes, use_room
+from ..label import Label
+from ..user import User
+from . import (
+    Aura,
+    CompositeShapeAssociation,
+    Shape,
+    ShapeLabel,
+    ShapeOwner,
+    ShapeType,
+    Tracker,
+    get_shape_view,
+)
+from .journal import shape_journal
+
+ShapeDict = Dict[str, Any]
+
+DM = "dm"
+OWNER = "owner"
+PUBLIC = "public"
+
+
+def get_asset_shapes(asset: Asset) -> List[str]:
+    """
+    Returns the uuids of the shapes that use the asset or one of the assets in its folder.
+    """
+    asset_ids = [asset.id]
+    parents = [asset.id]
+    while parents:
+        parents = [a.id for a in Asset.select(Asset.id).where(Asset.parent << parents)]
+        asset_ids.extend(parents)
+    return [s.uuid for s in Shape.select(Shape.uuid).where(Shape.asset << asset_ids)]
+
+
+def get_dependent_shapes(instance: Model) -> List[str]:
+    """
+    Returns the uuids of the shapes whose payload contains (part of) the given shared instance.
+    """
+    if isinstance(instance, (Label, User, Asset)):
+        # These can be used by every room
+        uuids: List[str] = []
+        for room_id in get_room_scopes():
+            with use_room(room_id):
+                uuids.extend(_get_room_dependent_shapes(instance))
+        return uuids
+    return _get_room_dependent_shapes(instance)
+
+
+def _get_room_dependent_shapes(instance: Model) -> List[str]:
+    if isinstance(instance, Label):
+        query = ShapeLabel.select(ShapeLabel.shape).where(
+            ShapeLabel.label == instance.uuid
+        )
+        return [sl.shape_id for sl in query]
+    if isinstance(instance, User):
+        owned = ShapeOwner.select(ShapeOwner.shape).where(ShapeOwner.user == instance)
+        labelled = (
+            ShapeLabel.select(ShapeLabel.shape)
+            .join(Label)
+            .where(Label.user == instance)
+        )
+        return list({row.shape_id for row in owned} | {sl.shape_id for sl in labelled})
+    if isinstance(instance, Asset):
+        return get_asset_shapes(instance)
+
+    shapes = Shape.select(Shape.uuid)
+    if isinstance(instance, Layer):
+        shapes = shapes.where(Shape.layer == instance)
+    elif isinstance(instance, Floor):
+        shapes = shapes.join(Layer).where(Layer.floor == instance)
+    else:
+        return []
+    return [shape.uuid for shape in shapes]
+
+
+class ShapePayloadCache:
+    def __init__(self) -> None:
+        # location id -> (shape uuid, visibility) -> payload
+        self._payloads: Dict[int, Dict[Tuple[str, str], ShapeDict]] = {}
+        # layer id -> location id, for the layers of the cached locations
+        self._layers: Dict[int, int] = {}
+        # Bumped on every invalidation, so that a serialization that was running concurrently
+        # (e.g. on the database thread) does not store outdated data.
+        self._version = 0
+        self._lock = Lock()
+
+    def activate(self, location_id: int) -> None:
+        """
+        Starts caching the payloads of the shapes on the location.
+        """
+        with self._lock:
+            self._payloads.setdefault(location_id, {})
+
+    def evict(self, location_id: int) -> None:
+        """
+        Drops the cached payloads of the location and stops caching them.
+        """
+        with self._lock:
+            self._payloads.pop(location_id, None)
+            self._layers = {
+                layer: location
+                for layer, location in self._layers.items()
+                if location != location_id
+            }
+
+    def get_location_id(self, layer_id: int) -> Optional[int]:
+        """
+        Returns the id of the location of the layer, if payloads are cached for that location.
+        """
+        location_id = self._layers.get(layer_id)
+        if location_id is not None:
+            return location_id
+
+        location_id = (
+            Floor.select(Floor.location)
+            .join(Layer)
+            .where(Layer.id == layer_id)
+            .scalar()
+        )
+        if location_id not in self._payloads:
+            return None
+        layers = Layer.select(Layer.id).join(Floor).where(Floor.location == location_id)
+        with self._lock:
+            if location_id not in self._payloads:
+                return None
+            for layer in layers:
+                self._layers[layer.id] = location_id
+            self._layers[layer_id] = location_id
+        return location_id
+
+    def get(self, shape: Shape, user: User, dm: bool) -> ShapeDict:
+        """
+        Returns the payload of the shape for the given user, serializing it if it is not cached.
+
+        The returned dict is shared, it should not be modified.
+        """
+        version = self._version
+        location_id = self.get_location_id(shape.layer_id)
+        payloads = None if location_id is None else self._payloads.get(location_id)
+        data = None if payloads is None else payloads.get((shape.uuid, DM))
+        if data is None:
+            data = shape.serialize()
+            if location_id is not None:
+                self.store(shape.uuid, location_id, data, version)
+
+        view = get_shape_view(data, user, dm)
+        if view is data:
+            return data
+
+        with self._lock:
+            payloads = None if location_id is None else self._payloads.get(location_id)
+            if version != self._version or payloads is None:
+                return view
+            return payloads.setdefault((shape.uuid, PUBLIC), view)
+
+    def store(
+        self,
+        uuid: str,
+        location_id: int,
+        data: ShapeDict,
+        version: Optional[int] = None,
+    ) -> None:
+        """
+        Caches the full serialization of a shape on the given location.
+
+        Pass the `version` that was current when the serialization started to ignore outdated data.
+        """
+        with self._lock:
+            if version is not None and version != self._version:
+                return
+            payloads = self._payloads.get(location_id)
+            if payloads is None:
+                return
+            payloads[(uuid, DM)] = data
+            payloads[(uuid, OWNER)] = data
+            payloads.pop((uuid, PUBLIC), None)
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def invalidate(self, uuids: List[str]) -> None:
+        if not uuids:
+            return
+        self._invalidate(uuids)
+        cluster.publish("cache.shape", cluster.WORKER_ID, uuids)
+
+    def _invalidate(self, uuids: List[str], worker_id: Optional[int] = None) -> None:
+        with self._lock:
+            self._version += 1
+            for payloads in self._payloads.values():
+                for uuid in uuids:
+                    for visibility in (DM, OWNER, PUBLIC):
+                        payloads.pop((uuid, visibility), None)
+        for uuid in uuids:
+            shape_journal.record(uuid, worker_id)
+
+    def invalidate_instance(self, instance: Model) -> None:
+        """
+        Drops the cached payloads that depend on the given (saved) instance.
+        """
+        if isinstance(instance, Shape):
+            self.invalidate([instance.uuid])
+        elif isinstance(instance, (ShapeType, Tracker, Aura, ShapeOwner, ShapeLabel)):
+            self.invalidate([instance.shape_id])
+        elif isinstance(instance, CompositeShapeAssociation):
+            self.invalidate([instance.parent_id])
+        elif isinstance(instance, (Label, Layer, Floor)):
+            # Their names and visibility are part of the payloads.
+            # User names can not be changed and locations, rooms and assets are only referenced by id.
+            self.invalidate(get_dependent_shapes(instance))
+
+    def delete_instance(self, instance: Model) -> None:
+        """
+        Drops the cached payloads that depend on the given (deleted) instance.
+        """
+        if isinstance(instance, (Label, User, Layer, Floor, Asset)):
+            # The rows that refer to it are removed or cleared by the database cascade
+            self.invalidate(get_dependent_shapes(instance))
+        elif isinstance(instance, Location):
+            self.evict(instance.id)
+        elif isinstance(instance, Room):
+            for location in Location.select(Location.id).where(
+                Location.room == instance
+            ):
+                self.evict(location.id)
+        else:
+            self.invalidate_instance(instance)
+
+
+shape_payloads = ShapePayloadCache()
+
+
+@cluster.on("cache.shape")
+def _invalidate_remote(worker_id: int, uuids: List[str]) -> None:
+    shape_payloads._invalidate(uuids, worker_id)
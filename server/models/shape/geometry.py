@@ -0,0 +1,82 @@
+"""
+Geometry of serialized shapes.
+
+The extents of a shape depend on its subtype (width/height, radius, end point, vertices, ...),
+these helpers work on the shape dicts so that they can be used on cached payloads without extra queries.
+"""
+
+import math
+import sys
+from array import array
+from typing import Any, Dict, List, Sequence, Tuple
+
+ShapeDict = Dict[str, Any]
+# min x, min y, max x, max y
+BoundingBox = Tuple[float, float, float, float]
+
+
+def pack_points(points: Sequence[Sequence[float]]) -> bytes:
+    """
+    Packs a list of [x, y] points into little-endian float64 values.
+    """
+    values = array("d", [c for point in points for c in point[:2]])
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+
+def unpack_points(data: bytes) -> List[List[float]]:
+    """
+    Returns the [x, y] points packed by `pack_points`.
+    """
+    values = array("d")
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    coordinates = iter(values.tolist())
+    return [[x, y] for x, y in zip(coordinates, coordinates)]
+
+
+def get_bounding_box(shape: ShapeDict) -> BoundingBox:
+    """
+    Returns the axis-aligned box that contains the shape, including its rotation.
+
+    Text has no known width on the server, so its box is an estimate based on the font size.
+    """
+    x, y = shape["x"], shape["y"]
+    type_ = shape["type_"]
+
+    if type_ in ("rect", "assetrect"):
+        box = (x, y, x + shape["width"], y + shape["height"])
+    elif type_ in ("circle", "circulartoken"):
+        r = shape["radius"]
+        box = (x - r, y - r, x + r, y + r)
+    elif type_ == "line":
+        box = (
+            min(x, shape["x2"]),
+            min(y, shape["y2"]),
+            max(x, shape["x2"]),
+            max(y, shape["y2"]),
+        )
+    elif type_ == "polygon":
+        xs = [x, *(v[0] for v in shape["vertices"])]
+        ys = [y, *(v[1] for v in shape["vertices"])]
+        box = (min(xs), min(ys), max(xs), max(ys))
+    elif type_ == "text":
+        half_width = shape["font_size"] * len(shape["text"]) / 2
+        half_height = shape["font_size"]
+        box = (x - half_width, y - half_height, x + half_width, y + half_height)
+    else:
+        box = (x, y, x, y)
+
+    if shape.get("angle"):
+        # Any rotation around the center stays within the circle through the corners
+        cx, cy = (box[0] + box[2]) / 2, (box[1] + box[3]) / 2
+        r = math.hypot(box[2] - box[0], box[3] - box[1]) / 2
+        box = (cx - r, cy - r, cx + r, cy + r)
+
+    return box
+
+
+def intersects(a: BoundingBox, b: BoundingBox) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
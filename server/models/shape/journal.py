@@ -0,0 +1,233 @@
+"""
+Journal of recent location changes, used to resynchronize reconnecting clients.
+
+Every change to a shape (or to one of the rows that end up in its payload) is recorded with an increasing version,
+together with the invalidation of its cached payload (see models.shape.cache).
+A client that reconnects with the last version it was synchronized to only needs the shapes that changed since,
+as long as the journal still reaches back that far.
+Changes to rows that are shared by many shapes (e.g. a layer or label) are recorded for every shape that refers to them.
+
+Other changes that clients receive while on a location (location options, groups, notes, markers, the player list, ...)
+are recorded for the location, room or user they belong to, see `get_instance_entries`.
+A client that missed such a change, or a change that affects an unknown set of shapes (a reset), reloads the location.
+
+A version is only acknowledged to clients once the changes up to it were emitted:
+the socket handlers run as operations (see `begin` and `end`) and changes recorded by other workers
+are held back until that worker reports that it emitted them.
+
+The versions are local to a server process, the journal id lets clients detect a restart or a different worker.
+"""
+
+from collections import deque
+from itertools import count
+from threading import Lock
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple, Union
+from uuid import uuid4
+
+from peewee import Model
+
+import cluster
+from config import config
+from ..campaign import Floor, Layer, Location, LocationOptions, Note, PlayerRoom, Room
+from ..groups import Group
+from ..label import Label, LabelSelection
+from ..marker import Marker
+from . import Shape
+
+JOURNAL_SIZE = config.getint("Persistence", "resync_journal_size", fallback=2000)
+
+# ("location" | "room" | "user", id)
+Scope = Tuple[str, int]
+# A shape uuid, a scope or None for a reset
+Entry = Union[str, Scope, None]
+
+
+class ShapeJournal:
+    def __init__(self, size: int) -> None:
+        self.id = uuid4().hex
+        self._entries: Deque[Tuple[int, Entry]] = deque(maxlen=size)
+        self._version = 0
+        self._lock = Lock()
+        self._operation_ids = count()
+        # operation id -> version when the operation started
+        self._operations: Dict[int, int] = {}
+        # worker id -> first version recorded for that worker that it did not report as emitted yet
+        self._unsettled: Dict[int, int] = {}
+        # Whether this process recorded changes since it last reported them as emitted
+        self._unreported = False
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def acknowledged_version(self) -> int:
+        """
+        The latest version of which all changes were emitted to the clients.
+        """
+        with self._lock:
+            return min(
+                [
+                    self._version,
+                    *self._operations.values(),
+                    *(version - 1 for version in self._unsettled.values()),
+                ]
+            )
+
+    def record(self, entry: Entry, worker_id: Optional[int] = None) -> None:
+        """
+        Records a change to the given shape or scope, or to an unknown set of shapes if None is given.
+
+        Changes received from another worker are recorded with its `worker_id`.
+        """
+        with self._lock:
+            self._version += 1
+            self._entries.append((self._version, entry))
+            if worker_id is None:
+                self._unreported = True
+            else:
+                self._unsettled.setdefault(worker_id, self._version)
+
+    def begin(self) -> int:
+        """
+        Starts an operation that emits the changes it makes, returns the id to pass to `end`.
+
+        Changes recorded while an operation runs are not acknowledged until it ends.
+        """
+        with self._lock:
+            operation_id = next(self._operation_ids)
+            self._operations[operation_id] = self._version
+            return operation_id
+
+    def end(self, operation_id: int) -> None:
+        with self._lock:
+            del self._operations[operation_id]
+        self.report()
+
+    def report(self) -> None:
+        """
+        Lets the other workers know that the changes recorded by this process were emitted,
+        as long as no operation is running.
+        """
+        with self._lock:
+            if self._operations or not self._unreported:
+                return
+            self._unreported = False
+        cluster.publish("journal.settle", cluster.WORKER_ID)
+
+    def settle(self, worker_id: int) -> None:
+        with self._lock:
+            self._unsettled.pop(worker_id, None)
+
+    def get_changes(
+        self, version: int, scopes: Iterable[Scope] = ()
+    ) -> Optional[Set[str]]:
+        """
+        Returns the uuids of the shapes that changed after the given version.
+
+        None is returned when this can not be determined, because the journal no longer reaches back to the version,
+        a reset happened since or one of the given scopes changed.
+        """
+        scopes = set(scopes)
+        with self._lock:
+            if version > self._version:
+                return None
+            changes: Set[str] = set()
+            if version == self._version:
+                return changes
+            if not self._entries or self._entries[0][0] > version + 1:
+                return None
+            for entry_version, entry in reversed(self._entries):
+                if entry_version <= version:
+                    break
+                if entry is None or entry in scopes:
+                    return None
+                if isinstance(entry, str):
+                    changes.add(entry)
+            return changes
+
+
+shape_journal = ShapeJournal(JOURNAL_SIZE)
+
+
+def get_instance_entries(instance: Model, structural: bool) -> List[Entry]:
+    """
+    Returns the journal entries for a write of an instance that is not part of a shape payload.
+
+    `structural` is set when the instance is created or deleted.
+    This runs before the write, so the changed fields of the instance can be checked.
+    """
+    if isinstance(instance, LocationOptions):
+        if instance.id is None:
+            # New options are not used by a location or room yet
+            return []
+        return [
+            *(
+                ("location", l.id)
+                for l in Location.select().where(Location.options == instance)
+            ),
+            *(
+                ("room", r.id)
+                for r in Room.select().where(Room.default_options == instance)
+            ),
+        ]
+    if isinstance(instance, PlayerRoom):
+        # The player list contains the role and location of every player
+        if structural or {"role", "active_location"} & instance._dirty:
+            return [("room", instance.room_id)]
+        return []
+    if isinstance(instance, Room):
+        return [("room", instance.id)]
+    if isinstance(instance, Location):
+        # The locations are listed for the whole room
+        return [("room", instance.room_id)]
+    if isinstance(instance, Floor):
+        return [("location", instance.location_id)]
+    if isinstance(instance, Layer):
+        floor = Floor.get_or_none(id=instance.floor_id)
+        return [] if floor is None else [("location", floor.location_id)]
+    if isinstance(instance, Group):
+        locations = (
+            Floor.select(Floor.location)
+            .join(Layer)
+            .join(Shape)
+            .where(Shape.group == instance)
+            .distinct()
+        )
+        return [("location", floor.location_id) for floor in locations]
+    if isinstance(instance, (Note, Marker, LabelSelection)):
+        return [("user", instance.user_id)]
+    if isinstance(instance, Label):
+        # Visible labels are sent to everyone
+        if instance.visible or (not structural and "visible" in instance._dirty):
+            return [None]
+        return [("user", instance.user_id)]
+    return []
+
+
+def record_entries(entries: List[Entry]) -> None:
+    """
+    Records changes made by this process and shares them with the other workers.
+    """
+    for entry in entries:
+        shape_journal.record(entry)
+    if entries:
+        cluster.publish("journal.record", cluster.WORKER_ID, entries)
+
+
+def record_instance(instance: Model, structural: bool = False) -> None:
+    """
+    Records a write of an instance that is not part of a shape payload, see `get_instance_entries`.
+    """
+    record_entries(get_instance_entries(instance, structural))
+
+
+@cluster.on("journal.record")
+def _record_remote(worker_id: int, entries: List[Entry]) -> None:
+    for entry in entries:
+        shape_journal.record(entry, worker_id)
+
+
+@cluster.on("journal.settle")
+def _settle_remote(worker_id: int) -> None:
+    shape_journal.settle(worker_id)
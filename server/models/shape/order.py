@@ -0,0 +1,88 @@
+"""
+Ordering of the shapes within a layer.
+
+Shapes are drawn in the order of their `index`, which is a sparse key instead of a position.
+Keys are handed out ORDER_STEP apart, so that adding, moving or removing a shape only writes that shape's row.
+When a shape has to be placed between two keys without room left in between, the layer is renumbered.
+
+These writes bypass the model signals, so order changes are recorded in the shape journal here.
+"""
+
+from typing import Optional
+
+from peewee import fn
+
+from ..campaign import Floor, Layer
+from ..db import db
+from . import Shape
+from .journal import record_entries
+
+ORDER_STEP = 2 ** 16
+
+
+def get_next_index(layer: Layer) -> int:
+    """
+    Returns the index that places a shape on top of all shapes of the layer.
+    """
+    top = Shape.select(fn.MAX(Shape.index)).where(Shape.layer == layer).scalar()
+    return 0 if top is None else top + ORDER_STEP
+
+
+def rebalance_layer(layer: Layer) -> None:
+    """
+    Spreads the indices of all shapes on the layer ORDER_STEP apart again, keeping their order.
+    """
+    uuids = [
+        shape.uuid
+        for shape in Shape.select(Shape.uuid)
+        .where(Shape.layer == layer)
+        .order_by(Shape.index)
+    ]
+    with db.atomic():
+        for i, uuid in enumerate(uuids):
+            Shape.update(index=i * ORDER_STEP).where(Shape.uuid == uuid).execute()
+    _record_order_change(layer)
+
+
+def _record_order_change(layer: Layer) -> None:
+    # Resynchronized shapes are sent without their order, so clients that missed this reload the location
+    location_id = (
+        Floor.select(Floor.location).where(Floor.id == layer.floor_id).scalar()
+    )
+    record_entries([("location", location_id)])
+
+
+def _get_index_at(shape: Shape, position: int) -> Optional[int]:
+    others = (
+        Shape.select(Shape.index)
+        .where((Shape.layer == shape.layer_id) & (Shape.uuid != shape.uuid))
+        .order_by(Shape.index)
+    )
+    position = max(0, min(position, others.count()))
+
+    below = others.offset(position - 1).limit(1).scalar() if position > 0 else None
+    above = others.offset(position).limit(1).scalar()
+
+    if below is None and above is None:
+        return 0
+    if below is None:
+        return above - ORDER_STEP  # type: ignore
+    if above is None:
+        return below + ORDER_STEP
+    if above - below > 1:
+        return (below + above) // 2
+    return None
+
+
+def set_order_position(shape: Shape, position: int) -> None:
+    """
+    Moves the shape to the given position (0 being the bottom) among the shapes of its layer.
+    """
+    index = _get_index_at(shape, position)
+    if index is None:
+        rebalance_layer(shape.layer)
+        index = _get_index_at(shape, position)
+
+    shape.index = index
+    Shape.update(index=index).where(Shape.uuid == shape.uuid).execute()
+    _record_order_change(shape.layer)
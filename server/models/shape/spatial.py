@@ -0,0 +1,332 @@
+"""
+In-memory spatial index of the shapes on every floor.
+
+Shapes are bucketed by their bounding box (see models.shape.geometry) in a uniform grid per floor,
+so that the shapes in an area (e.g. a client's viewport) can be found without going over every shape of the floor.
+Shapes that cover a lot of cells (e.g. map backgrounds) are kept aside and always checked.
+
+Floors are only kept for the locations that have clients on this server process (see state.game).
+A floor is loaded the first time it is queried and is afterwards kept up to date by the model signals,
+the in-memory room state and the bulk operations whenever a shape is added, moved, resized or removed.
+The other workers drop their copy of changed floors when running with multiple worker processes.
+"""
+
+import math
+from collections import defaultdict
+from threading import Lock
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from peewee import Model
+
+import cluster
+from ..campaign import Floor, Layer, Location, Room
+from ..utils import get_table
+from . import Shape, ShapeType
+from .geometry import BoundingBox, ShapeDict, get_bounding_box, intersects
+
+# Size of a grid cell in board units, the default grid size is 50
+CELL_SIZE = 500
+# Shapes that span more cells are not bucketed
+MAX_CELLS = 64
+
+SHAPE_FIELDS = ("type_", "x", "y", "angle")
+SUBTYPE_FIELDS = (
+    "width",
+    "height",
+    "radius",
+    "x2",
+    "y2",
+    "vertices",
+    "text",
+    "font_size",
+)
+
+Cell = Tuple[int, int]
+
+
+def _get_subtype_geometry(subshape: ShapeType) -> ShapeDict:
+    data = subshape.as_dict(exclude=[type(subshape).shape])
+    return {field: data[field] for field in SUBTYPE_FIELDS if field in data}
+
+
+def _get_cells(box: BoundingBox) -> Tuple[range, range]:
+    """
+    Returns the columns and rows of the cells that the box covers.
+    """
+    return (
+        range(math.floor(box[0] / CELL_SIZE), math.floor(box[2] / CELL_SIZE) + 1),
+        range(math.floor(box[1] / CELL_SIZE), math.floor(box[3] / CELL_SIZE) + 1),
+    )
+
+
+class FloorGrid:
+    def __init__(self, location_id: int, layer_ids: Iterable[int]) -> None:
+        self.location_id = location_id
+        self.layers: Set[int] = set(layer_ids)
+        self.boxes: Dict[str, BoundingBox] = {}
+        self.cells: Dict[Cell, Set[str]] = defaultdict(set)
+        self.large: Set[str] = set()
+
+    def insert(self, uuid: str, box: BoundingBox) -> None:
+        self.boxes[uuid] = box
+        columns, rows = _get_cells(box)
+        if len(columns) * len(rows) > MAX_CELLS:
+            self.large.add(uuid)
+            return
+        for column in columns:
+            for row in rows:
+                self.cells[(column, row)].add(uuid)
+
+    def remove(self, uuid: str) -> None:
+        box = self.boxes.pop(uuid, None)
+        if box is None:
+            return
+        columns, rows = _get_cells(box)
+        if len(columns) * len(rows) > MAX_CELLS:
+            self.large.discard(uuid)
+            return
+        for column in columns:
+            for row in rows:
+                cell = self.cells[(column, row)]
+                cell.discard(uuid)
+                if not cell:
+                    del self.cells[(column, row)]
+
+    def query(self, box: BoundingBox) -> Set[str]:
+        candidates = set(self.large)
+        columns, rows = _get_cells(box)
+        if len(columns) * len(rows) > len(self.cells):
+            # Going over the occupied cells is cheaper than going over the whole area
+            for (column, row), uuids in self.cells.items():
+                if column in columns and row in rows:
+                    candidates.update(uuids)
+        else:
+            for column in columns:
+                for row in rows:
+                    candidates.update(self.cells.get((column, row), ()))
+        return {uuid for uuid in candidates if intersects(self.boxes[uuid], box)}
+
+
+class SpatialIndex:
+    def __init__(self) -> None:
+        self._floors: Dict[int, FloorGrid] = {}
+        # ids of the locations whose floors are kept
+        self._locations: Set[int] = set()
+        # layer id -> floor id, for the layers of the loaded floors
+        self._layers: Dict[int, int] = {}
+        # shape uuid -> (floor id, geometry), for the shapes on the loaded floors
+        self._shapes: Dict[str, Tuple[int, ShapeDict]] = {}
+        # Bumped on every change, so that a floor that was being loaded concurrently is not stored
+        self.version = 0
+        self._lock = Lock()
+
+    def activate(self, location_id: int) -> None:
+        """
+        Starts keeping the floors of the location.
+        """
+        with self._lock:
+            self._locations.add(location_id)
+
+    def evict(self, location_id: int) -> None:
+        """
+        Drops the floors of the location and stops keeping them.
+        """
+        with self._lock:
+            self._locations.discard(location_id)
+            for floor_id, grid in list(self._floors.items()):
+                if grid.location_id == location_id:
+                    self._drop_floor(floor_id)
+
+    def query_box(self, floor_id: int, box: BoundingBox) -> Set[str]:
+        """
+        Returns the uuids of the shapes on the floor whose bounding box intersects the given box.
+        """
+        grid = self._get_floor(floor_id)
+        with self._lock:
+            return grid.query(box)
+
+    def query_radius(
+        self, floor_id: int, x: float, y: float, radius: float
+    ) -> Set[str]:
+        """
+        Returns the uuids of the shapes on the floor whose bounding box is within `radius` of the given point.
+        """
+        grid = self._get_floor(floor_id)
+        with self._lock:
+            uuids = set()
+            for uuid in grid.query((x - radius, y - radius, x + radius, y + radius)):
+                box = grid.boxes[uuid]
+                dx = max(box[0] - x, 0, x - box[2])
+                dy = max(box[1] - y, 0, y - box[3])
+                if math.hypot(dx, dy) <= radius:
+                    uuids.add(uuid)
+            return uuids
+
+    def load_floor(
+        self,
+        floor_id: int,
+        location_id: int,
+        layer_ids: Iterable[int],
+        shapes: Iterable[ShapeDict],
+        version: int,
+    ) -> FloorGrid:
+        """
+        Indexes a floor from already serialized shapes, unless the floor was already loaded.
+
+        The floor is only kept if its location is active and nothing changed since `version` was read,
+        otherwise the shapes might be outdated by the time they are stored.
+        """
+        grid = FloorGrid(location_id, layer_ids)
+        geometries: Dict[str, ShapeDict] = {}
+        for shape in shapes:
+            geometry = geometries[shape["uuid"]] = {
+                field: shape[field]
+                for field in (*SHAPE_FIELDS, *SUBTYPE_FIELDS)
+                if field in shape
+            }
+            grid.insert(shape["uuid"], self._get_box(geometry))
+
+        with self._lock:
+            if floor_id in self._floors:
+                return self._floors[floor_id]
+            if version != self.version or location_id not in self._locations:
+                return grid
+            for layer_id in grid.layers:
+                self._layers[layer_id] = floor_id
+            for uuid, geometry in geometries.items():
+                self._shapes[uuid] = (floor_id, geometry)
+            self._floors[floor_id] = grid
+        return grid
+
+    def _get_floor(self, floor_id: int) -> FloorGrid:
+        grid = self._floors.get(floor_id)
+        if grid is not None:
+            return grid
+
+        version = self.version
+        location_id = Floor.select(Floor.location).where(Floor.id == floor_id).scalar()
+        layer_ids = [
+            layer.id for layer in Layer.select(Layer.id).where(Layer.floor == floor_id)
+        ]
+        uuid_query = Shape.select(Shape.uuid).where(Shape.layer << layer_ids)
+        shapes: Dict[str, ShapeDict] = {}
+        for shape in Shape.select(
+            Shape.uuid, Shape.type_, Shape.x, Shape.y, Shape.angle
+        ).where(Shape.layer << layer_ids):
+            shapes[shape.uuid] = {
+                "uuid": shape.uuid,
+                **{field: getattr(shape, field) for field in SHAPE_FIELDS},
+            }
+        for type_ in {shape["type_"] for shape in shapes.values()}:
+            type_table = get_table(type_)
+            for subshape in type_table.select().where(type_table.shape << uuid_query):
+                shapes[subshape.shape_id].update(_get_subtype_geometry(subshape))
+        return self.load_floor(
+            floor_id, location_id, layer_ids, shapes.values(), version
+        )
+
+    def _get_box(self, geometry: ShapeDict) -> BoundingBox:
+        try:
+            return get_bounding_box(geometry)
+        except KeyError:
+            # The subtype is saved right after the shape itself
+            return (geometry["x"], geometry["y"], geometry["x"], geometry["y"])
+
+    def _set(self, uuid: str, floor_id: int, geometry: ShapeDict) -> None:
+        previous = self._shapes.get(uuid)
+        if previous is not None:
+            self._floors[previous[0]].remove(uuid)
+        self._shapes[uuid] = (floor_id, geometry)
+        self._floors[floor_id].insert(uuid, self._get_box(geometry))
+
+    def _remove(self, uuid: str) -> None:
+        previous = self._shapes.pop(uuid, None)
+        if previous is not None:
+            self._floors[previous[0]].remove(uuid)
+
+    def forget(self, uuid: str) -> None:
+        with self._lock:
+            self.version += 1
+            self._remove(uuid)
+        cluster.publish("cache.spatial", uuid, None)
+
+    def clear(self) -> None:
+        self._clear()
+        cluster.publish("cache.spatial", None, None)
+
+    def _clear(self) -> None:
+        with self._lock:
+            self.version += 1
+            self._floors.clear()
+            self._layers.clear()
+            self._shapes.clear()
+
+    def _forget_floors(self, uuid: str, layer_id: Optional[int]) -> None:
+        with self._lock:
+            self.version += 1
+            self._drop_floors(uuid, layer_id)
+
+    def _drop_floors(self, uuid: str, layer_id: Optional[int]) -> None:
+        """
+        Drops the floors that contain the shape or layer, they are loaded again on the next query.
+        """
+        if uuid in self._shapes:
+            self._drop_floor(self._shapes[uuid][0])
+        if layer_id in self._layers:
+            self._drop_floor(self._layers[layer_id])
+
+    def _drop_floor(self, floor_id: int) -> None:
+        grid = self._floors.pop(floor_id)
+        for layer_id in grid.layers:
+            del self._layers[layer_id]
+        for uuid in grid.boxes:
+            del self._shapes[uuid]
+
+    def update_instance(self, instance: Model) -> None:
+        """
+        Applies a (pending) write of the given instance to the index.
+        """
+        if isinstance(instance, Shape):
+            with self._lock:
+                self.version += 1
+                previous = self._shapes.get(instance.uuid)
+                floor_id = self._layers.get(instance.layer_id)
+                if any(getattr(instance, field) is None for field in SHAPE_FIELDS):
+                    # Only part of the shape was loaded, so start over for its floors
+                    self._drop_floors(instance.uuid, instance.layer_id)
+                elif floor_id is None:
+                    self._remove(instance.uuid)
+                else:
+                    geometry: ShapeDict = {} if previous is None else previous[1]
+                    geometry.update({f: getattr(instance, f) for f in SHAPE_FIELDS})
+                    self._set(instance.uuid, floor_id, geometry)
+            cluster.publish("cache.spatial", instance.uuid, instance.layer_id)
+        elif isinstance(instance, ShapeType):
+            with self._lock:
+                self.version += 1
+                previous = self._shapes.get(instance.shape_id)
+                if previous is not None:
+                    previous[1].update(_get_subtype_geometry(instance))
+                    self._set(instance.shape_id, *previous)
+            cluster.publish("cache.spatial", instance.shape_id, None)
+
+    def delete_instance(self, instance: Model) -> None:
+        """
+        Removes a deleted instance from the index.
+        """
+        if isinstance(instance, Shape):
+            self.forget(instance.uuid)
+        elif isinstance(instance, (Layer, Floor, Location, Room)):
+            # The shapes are removed by the database cascade
+            self.clear()
+
+
+spatial_index = SpatialIndex()
+
+
+@cluster.on("cache.spatial")
+def _forget_remote(uuid: Optional[str], layer_id: Optional[int]) -> None:
+    if uuid is None:
+        spatial_index._clear()
+    else:
+        spatial_index._forget_floors(uuid, layer_id)
@@ -1,7 +1,12 @@
-from playhouse.signals import post_save, pre_delete
+from playhouse.signals import post_delete, post_save, pre_delete, pre_save
 
+from .asset import Asset, asset_trees
 from .campaign import Location, LocationUserOption, PlayerRoom
-from .db import db
+from .db import db, use_room
+from .shape.access import permission_index
+from .shape.cache import shape_payloads
+from .shape.journal import record_instance
+from .shape.spatial import spatial_index
 from .user import User
 
 
@@ -25,15 +30,65 @@ def on_location_save(model_class, instance, created):
 def on_player_join(model_class, instance, created):
     if not created:
         return
-    with db.atomic():
+    with use_room(instance.room_id), db.atomic():
         for location in instance.room.locations:
             LocationUserOption.get_or_create(location=location, user=instance.player)
 
 
 @pre_delete(sender=PlayerRoom)
 def on_player_leave(model_class, instance):
-    with db.atomic():
+    with use_room(instance.room_id), db.atomic():
         for location in instance.room.locations:
             LocationUserOption.get(
                 location=location, user=instance.player
             ).delete_instance()
+
+
+@post_save()
+def on_save_invalidate_shape_payloads(model_class, instance, created):
+    shape_payloads.invalidate_instance(instance)
+
+
+@pre_delete()
+def on_delete_invalidate_shape_payloads(model_class, instance):
+    shape_payloads.delete_instance(instance)
+
+
+@pre_save()
+def on_save_record_journal(model_class, instance, created):
+    record_instance(instance, created)
+
+
+@pre_delete()
+def on_delete_record_journal(model_class, instance):
+    record_instance(instance, True)
+
+
+@post_save()
+def on_save_update_permissions(model_class, instance, created):
+    permission_index.update_instance(instance)
+
+
+@pre_delete()
+def on_delete_update_permissions(model_class, instance):
+    permission_index.delete_instance(instance)
+
+
+@post_save()
+def on_save_update_spatial_index(model_class, instance, created):
+    spatial_index.update_instance(instance)
+
+
+@pre_delete()
+def on_delete_update_spatial_index(model_class, instance):
+    spatial_index.delete_instance(instance)
+
+
+@post_save(sender=Asset)
+def on_asset_save(model_class, instance, created):
+    asset_trees.invalidate(instance.owner_id)
+
+
+@post_delete(sender=Asset)
+def on_asset_delete(model_class, instance):
+    asset_trees.invalidate(instance.owner_id)
@@ -0,0 +1,135 @@
+"""
+Creation and extraction of .paa asset archives.
+
+A .paa file is a tar archive containing a `data` json file with the asset tree
+and a `files` folder with the asset files named by their hash.
+
+The functions in this module are run in worker processes (see api.socket.asset_manager.archive)
+and threads (see api.http.assets), so they only depend on the standard library
+and report their progress through a queue.
+"""
+
+import bz2
+import gzip
+import io
+import json
+import tarfile
+import time
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple
+
+
+def _bz2_writer(fileobj: BinaryIO) -> BinaryIO:
+    return bz2.BZ2File(fileobj, "wb")  # type: ignore
+
+
+def _gz_writer(fileobj: BinaryIO) -> BinaryIO:
+    return gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=1)  # type: ignore
+
+
+# codec name -> wraps a binary file in a compressing writer (None for no compression)
+# The compression is applied outside of tarfile, so that archives can also be written to non-seekable streams.
+CODECS: Dict[str, Callable[[BinaryIO], Optional[BinaryIO]]] = {
+    "bz2": _bz2_writer,
+    "gz": _gz_writer,
+    "none": lambda fileobj: None,
+}
+
+
+def get_safe_members(members: List[tarfile.TarInfo]) -> List[tarfile.TarInfo]:
+    safe_members: List[tarfile.TarInfo] = []
+    for member in members:
+        if member.islnk() or member.issym():
+            continue
+        if member.name.startswith("/") or ".." in member.name:
+            continue
+        # there is no real harm in extracting other files, but doesn't hurt to be a bit more strict
+        if member.name != "data" and not member.name.startswith("files"):
+            continue
+        safe_members.append(member)
+    return safe_members
+
+
+def _report(progress, done: int, total: int) -> None:
+    if progress is not None:
+        progress.put((done, total))
+
+
+def create_archive(
+    path: str,
+    data: List[Dict[str, Any]],
+    files: List[Tuple[str, str]],
+    codec: str,
+    progress=None,
+) -> None:
+    """
+    Writes the asset `data` and the (name, path) `files` to a new archive at `path`.
+    """
+    with open(path, "wb") as f:
+        write_archive(f, data, files, codec, progress)
+
+
+def write_archive(
+    fileobj: BinaryIO,
+    data: List[Dict[str, Any]],
+    files: List[Tuple[str, str]],
+    codec: str,
+    progress=None,
+) -> None:
+    """
+    Writes an archive with the asset `data` and the (name, path) `files` to `fileobj`.
+
+    The archive is written sequentially, `fileobj` does not need to be seekable.
+    """
+    json_data = json.dumps(data).encode("utf-8")
+
+    data_tar_info = tarfile.TarInfo("data")
+    data_tar_info.size = len(json_data)
+    data_tar_info.mode = 0o755
+    data_tar_info.mtime = time.time()  # type: ignore
+
+    files_tar_info = tarfile.TarInfo("files")
+    files_tar_info.type = tarfile.DIRTYPE
+    files_tar_info.mode = 0o755
+    files_tar_info.mtime = time.time()  # type: ignore
+
+    compressed = CODECS[codec](fileobj)
+    try:
+        with tarfile.open(fileobj=compressed or fileobj, mode="w|") as tar:
+            tar.addfile(data_tar_info, io.BytesIO(json_data))
+            tar.addfile(files_tar_info)
+            for i, (name, file_path) in enumerate(files):
+                try:
+                    info = tar.gettarinfo(file_path)
+                    info.name = f"files/{name}"
+                    info.mtime = time.time()  # type: ignore
+                    info.mode = 0o755
+                    with open(file_path, "rb") as f:
+                        tar.addfile(info, f)
+                except FileNotFoundError:
+                    pass
+                _report(progress, i + 1, len(files))
+    finally:
+        if compressed is not None:
+            compressed.close()
+
+
+def extract_archive(path: str, tmp_dir: str, progress=None) -> List[Dict[str, Any]]:
+    """
+    Extracts the archive at `path` to `tmp_dir` and returns the asset data.
+
+    The asset files are extracted to the `files` subdirectory.
+
+    The compression is detected from the file, so archives made with any of the CODECS can be imported.
+    """
+    tmp_path = Path(tmp_dir)
+    with tarfile.open(path, mode="r:*") as tar:
+        # We need to explicitly list our members for security reasons
+        # this is upload data so people could upload malicious stuff that breaks out of the path etc
+        members = get_safe_members(tar.getmembers())
+        for i, member in enumerate(members):
+            tar.extract(member, path=tmp_dir)
+            _report(progress, i + 1, len(members))
+
+    with open(tmp_path / "data") as json_data:
+        return json.load(json_data)
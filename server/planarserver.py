@@ -26,22 +26,46 @@ save.check_save()
 
 import asyncio
 import configparser
+import signal
+import socket
 
 from aiohttp import web
 
 import api.http
+import cluster
 import routes
 from state.asset import asset_state
-from state.game import game_state
+from state.game import game_state, start_presence
+from state.room import room_state
 
 # Force loading of socketio routes
 from api.socket import *
+from api.socket.asset_manager.archive import clean_exports, shutdown_archive_workers
+from api.socket.asset_manager.store import collect_garbage
+from api.socket.asset_manager.upload import clean_uploads, remove_stale_upload_files
+from api.socket.asset_manager.variants import shutdown_variant_workers
 from api.socket.constants import GAME_NS
+from api.socket.location import send_sync_versions
+from api.socket.shape.position import position_broadcaster
 from app import api_app, app as main_app, runners, setup_runner, sio
 from config import config
+from models.db import (
+    DB_PROFILE,
+    ROOM_STORAGE,
+    claim_connection,
+    close_db,
+    close_idle_rooms,
+    db_executor,
+    inherit_room,
+    maintain_db,
+    optimize_db,
+    room_databases,
+    run_db,
+)
 from utils import logger
 
 loop = asyncio.get_event_loop()
+loop.set_task_factory(inherit_room)
 
 # This is a fix for asyncio problems on windows that make it impossible to do ctrl+c
 if sys.platform.startswith("win"):
@@ -52,9 +76,37 @@ if sys.platform.startswith("win"):
     loop.call_later(0.1, _wakeup)
 
 
+async def on_startup(_):
+    logger.info(
+        f"Using the '{DB_PROFILE}' database profile with '{ROOM_STORAGE}' room storage"
+    )
+    claim_connection()
+    if room_databases.enabled:
+        asyncio.ensure_future(close_idle_rooms())
+    asyncio.ensure_future(clean_uploads())
+    asyncio.ensure_future(send_sync_versions())
+    if cluster.is_worker():
+        start_presence()
+    # With multiple workers, the server wide tasks only run on the primary worker
+    if cluster.is_primary():
+        asyncio.ensure_future(maintain_db())
+        asyncio.ensure_future(clean_exports())
+        asyncio.ensure_future(collect_garbage())
+    if room_state.enabled:
+        asyncio.ensure_future(room_state.persist())
+
+
 async def on_shutdown(_):
     for sid in [*game_state._sid_map.keys(), *asset_state._sid_map.keys()]:
         await sio.disconnect(sid, namespace=GAME_NS)
+    await position_broadcaster.persist()
+    await run_db(room_state.flush)
+    shutdown_archive_workers()
+    shutdown_variant_workers()
+    if cluster.is_primary():
+        await run_db(optimize_db)
+    await run_db(close_db)
+    db_executor.shutdown()
 
 
 async def start_http(app: web.Application, host, port):
@@ -62,7 +114,7 @@ async def start_http(app: web.Application, host, port):
     await setup_runner(app, web.TCPSite, host=host, port=port)
 
 
-async def start_https(app: web.Application, host, port, chain, key):
+def get_ssl_context(chain, key):
     import ssl
 
     ctx = ssl.SSLContext()
@@ -71,9 +123,16 @@ async def start_https(app: web.Application, host, port, chain, key):
     except FileNotFoundError:
         logger.critical("SSL FILES ARE NOT FOUND. ABORTING LAUNCH.")
         sys.exit(2)
+    return ctx
+
 
+async def start_https(app: web.Application, host, port, chain, key):
     await setup_runner(
-        app, web.TCPSite, host=host, port=port, ssl_context=ctx,
+        app,
+        web.TCPSite,
+        host=host,
+        port=port,
+        ssl_context=get_ssl_context(chain, key),
     )
 
 
@@ -81,39 +140,73 @@ async def start_socket(app: web.Application, sock):
     await setup_runner(app, web.UnixSite, path=sock)
 
 
+def get_ssl_files(server_section: str):
+    try:
+        chain = config.get(server_section, "ssl_fullchain")
+        key = config.get(server_section, "ssl_privkey")
+    except configparser.NoOptionError:
+        logger.critical(
+            "SSL CONFIGURATION IS NOT CORRECTLY CONFIGURED. ABORTING LAUNCH."
+        )
+        sys.exit(2)
+    return chain, key
+
+
+def get_server_url(server_section: str) -> str:
+    path = config.get(server_section, "socket", fallback=None)
+    if path:
+        return path
+
+    host = config.get(server_section, "host")
+    port = config.getint(server_section, "port")
+    environ = os.environ.get("PA_BASEPATH", "/")
+    scheme = "https" if config.getboolean(server_section, "ssl") else "http"
+    return f"{scheme}://{host}:{port}{environ}"
+
+
 async def start_server(server_section: str):
     socket = config.get(server_section, "socket", fallback=None)
     app = main_app
-    method = "unknown"
     if server_section == "APIserver":
         app = api_app
 
     if socket:
         await start_socket(app, socket)
-        method = socket
     else:
         host = config.get(server_section, "host")
         port = config.getint(server_section, "port")
 
-        environ = os.environ.get("PA_BASEPATH", "/")
-
         if config.getboolean(server_section, "ssl"):
-            try:
-                chain = config.get(server_section, "ssl_fullchain")
-                key = config.get(server_section, "ssl_privkey")
-            except configparser.NoOptionError:
-                logger.critical(
-                    "SSL CONFIGURATION IS NOT CORRECTLY CONFIGURED. ABORTING LAUNCH."
-                )
-                sys.exit(2)
-
-            await start_https(app, host, port, chain, key)
-            method = f"https://{host}:{port}{environ}"
+            await start_https(app, host, port, *get_ssl_files(server_section))
         else:
             await start_http(app, host, port)
-            method = f"http://{host}:{port}{environ}"
 
-    print(f"======== Starting {server_section} on {method} ========")
+    print(
+        f"======== Starting {server_section} on {get_server_url(server_section)} ========"
+    )
+
+
+async def start_worker():
+    """
+    Serves clients on the listening socket created by the supervisor process (see cluster.supervise).
+    """
+    ssl_context = None
+    if config.get("Webserver", "socket", fallback=None) is None:
+        if config.getboolean("Webserver", "ssl"):
+            ssl_context = get_ssl_context(*get_ssl_files("Webserver"))
+        else:
+            logger.warning(" RUNNING IN NON SSL CONTEXT ")
+
+    await setup_runner(
+        main_app,
+        web.SockSite,
+        sock=cluster.get_listen_socket(),
+        ssl_context=ssl_context,
+    )
+    logger.info(f"Worker {cluster.WORKER_ID} started")
+
+    if cluster.is_primary():
+        await start_server("APIserver")
 
 
 async def start_servers():
@@ -126,16 +219,71 @@ async def start_servers():
     print()
 
 
+def create_listen_socket() -> socket.socket:
+    """
+    Creates the socket that all workers accept their connections on.
+    """
+    path = config.get("Webserver", "socket", fallback=None)
+    if path:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(path):
+            os.unlink(path)
+        sock.bind(path)
+    else:
+        host = config.get("Webserver", "host")
+        port = config.getint("Webserver", "port")
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_supervisor():
+    remove_stale_upload_files()
+    sock = create_listen_socket()
+
+    print()
+    print(
+        f"======== Starting {cluster.WORKERS} workers on {get_server_url('Webserver')} ========"
+    )
+    print()
+    print("(Press CTRL+C to quit)")
+    print()
+
+    try:
+        loop.run_until_complete(cluster.supervise(sock))
+    finally:
+        sock.close()
+
+
+main_app.on_startup.append(on_startup)
 main_app.on_shutdown.append(on_shutdown)
 
 
 if __name__ == "__main__":
-    loop.create_task(start_servers())
+    if cluster.is_supervisor():
+        run_supervisor()
+        sys.exit(0)
+
+    if cluster.is_worker():
+        # Stop gracefully when the supervisor forwards a SIGTERM
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        loop.create_task(start_worker())
+    else:
+        remove_stale_upload_files()
+        loop.create_task(start_servers())
 
     try:
         loop.run_forever()
     except:
         pass
     finally:
+        if cluster.is_worker():
+            # Signals sent to both the process group and by the supervisor should not interrupt the shutdown
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
         for runner in runners:
             loop.run_until_complete(runner.cleanup())
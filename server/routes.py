@@ -1,5 +1,6 @@
 import os
 import sys
+from typing import Dict, Optional, Tuple
 
 import aiohttp
 import aiohttp_jinja2
@@ -9,6 +10,7 @@ from aiohttp_security import authorized_userid, check_authorized, forget, rememb
 import api.http
 from app import api_app, app as main_app
 from models import Room, User
+from models.db import run_db
 from models.role import Role
 from utils import logger
 
@@ -18,11 +20,27 @@ if subpath[-1] != "/":
     subpath = subpath + "/"
 
 
+# basepath -> (modification time of the template, rendered index.html)
+_index_cache: Dict[str, Tuple[float, bytes]] = {}
+
+
+def render_index(basepath: str) -> bytes:
+    mtime = os.stat("./templates/index.html").st_mtime
+    cached = _index_cache.get(basepath)
+    if cached is None or cached[0] != mtime:
+        with open("./templates/index.html", "rb") as f:
+            data = f.read()
+        data = data.replace(b"/static", bytes(basepath, "utf-8")[:-1] + b"/static")
+        cached = _index_cache[basepath] = (mtime, data)
+    return cached[1]
+
+
 async def root(request):
-    with open("./templates/index.html", "rb") as f:
-        data = f.read()
-        data = data.replace(b"/static", bytes(subpath, "utf-8")[:-1] + b"/static")
-        return web.Response(body=data, content_type="text/html")
+    return web.Response(
+        body=render_index(subpath),
+        content_type="text/html",
+        headers={"Cache-Control": "no-cache"},
+    )
 
 
 async def root_dev(request):
@@ -42,19 +60,27 @@ async def root_dev(request):
 @aiohttp_jinja2.template("planarally.jinja2")
 async def show_room(request):
     user = await check_authorized(request)
-    creator = User.by_name(request.match_info["username"])
-    try:
-        room = Room.select().where(
-            (Room.creator == creator) & (Room.name == request.match_info["roomname"])
-        )[0]
-    except IndexError:
-        logger.info(
-            f"{user.name} attempted to load non existing room {request.match_info['username']}/{request.match_info['roomname']}"
-        )
-    else:
-        for pr in room.players:
-            if pr.user == user:
-                return {"dm": pr.role == Role.DM}
+
+    def get_role() -> Optional[int]:
+        creator = User.by_name(request.match_info["username"])
+        try:
+            room = Room.select().where(
+                (Room.creator == creator)
+                & (Room.name == request.match_info["roomname"])
+            )[0]
+        except IndexError:
+            logger.info(
+                f"{user.name} attempted to load non existing room {request.match_info['username']}/{request.match_info['roomname']}"
+            )
+        else:
+            for pr in room.players:
+                if pr.user == user:
+                    return pr.role
+        return None
+
+    role = await run_db(get_role)
+    if role is not None:
+        return {"dm": role == Role.DM}
     return web.HTTPFound("/rooms")
 
 
@@ -65,7 +91,14 @@ async def show_assets(request):
 
 # MAIN ROUTES
 
-main_app.router.add_static(f"{subpath}static", "static")
+main_app.router.add_get(
+    f"{subpath}static/assets/{{file_hash:[0-9a-f]{{4,}}}}", api.http.assets.get_file
+)
+main_app.router.add_get(
+    f"{subpath}static/variants/{{variant}}/{{file_hash:[0-9a-f]{{4,}}}}",
+    api.http.assets.get_file_variant,
+)
+main_app.router.add_get(f"{subpath}static/{{path:.*}}", api.http.static.get_static)
 main_app.router.add_get(f"{subpath}api/auth", api.http.auth.is_authed)
 main_app.router.add_post(f"{subpath}api/users/email", api.http.users.set_email)
 main_app.router.add_post(f"{subpath}api/users/password", api.http.users.set_password)
@@ -84,6 +117,7 @@ main_app.router.add_get(
 main_app.router.add_patch(
     f"{subpath}api/rooms/{{creator}}/{{roomname}}/info", api.http.rooms.set_info
 )
+main_app.router.add_get(f"{subpath}api/assets/export", api.http.assets.export)
 main_app.router.add_post(f"{subpath}api/invite", api.http.claim_invite)
 main_app.router.add_get(f"{subpath}api/version", api.http.version.get_version)
 main_app.router.add_get(f"{subpath}api/changelog", api.http.version.get_changelog)
@@ -13,7 +13,7 @@ When writing migrations make sure that these things are respected:
     - e.g. a column added to Circle also needs to be added to CircularToken
 """
 
-SAVE_VERSION = 58
+SAVE_VERSION = 61
 
 import datetime
 import json
@@ -25,16 +25,22 @@ import sys
 from pathlib import Path
 from uuid import uuid4
 
+from typing import Any, List, Optional, Tuple
+
 from peewee import (
     BooleanField,
     ForeignKeyField,
     IntegerField,
+    sort_models,
 )
 from playhouse.migrate import SqliteMigrator, migrate
 
+import cluster
 from config import SAVE_FILE
-from models import ALL_MODELS, Constants
-from models.db import db
+from models import ALL_MODELS, ROOM_MODELS, Constants, PlayerRoom, Room
+from models.base import RoomModel, create_table
+from models.db import GLOBAL_SCHEMA, db, room_databases, use_room, use_save_file
+from models.shape.geometry import pack_points
 from utils import OldVersionException, UnknownVersionException
 
 logger: logging.Logger = logging.getLogger("PlanarAllyServer")
@@ -887,6 +893,65 @@ def upgrade(version):
                 'ALTER TABLE player_room ADD COLUMN notes TEXT NOT NULL DEFAULT ""'
             )
             db.execute_sql("ALTER TABLE player_room ADD COLUMN last_played TEXT")
+    elif version == 58:
+        # Change Shape.index into sparse order keys
+        with db.atomic():
+            data = db.execute_sql(
+                'SELECT uuid, layer_id FROM shape ORDER BY layer_id, "index"'
+            ).fetchall()
+            index = 0
+            previous_layer = None
+            for uuid, layer_id in data:
+                if layer_id != previous_layer:
+                    previous_layer = layer_id
+                    index = 0
+                db.execute_sql(
+                    'UPDATE shape SET "index" = ? WHERE uuid = ?',
+                    (index * 2 ** 16, uuid),
+                )
+                index += 1
+            db.execute_sql(
+                'CREATE INDEX "shape_layer_id_index" ON "shape" ("layer_id", "index")'
+            )
+    elif version == 59:
+        # Move the asset files into the sharded content store and index Asset.file_hash
+        assets_dir = Path("static") / "assets"
+        if assets_dir.is_dir():
+            for entry in os.scandir(assets_dir):
+                if not entry.is_file() or entry.name.startswith("."):
+                    continue
+                if len(entry.name) < 4:
+                    continue
+                shard = assets_dir / entry.name[:2] / entry.name[2:4]
+                shard.mkdir(parents=True, exist_ok=True)
+                os.replace(entry.path, str(shard / entry.name))
+        db.execute_sql(
+            'CREATE INDEX IF NOT EXISTS "asset_file_hash" ON "asset" ("file_hash")'
+        )
+    elif version == 60:
+        # Store polygon vertices as packed float64 values instead of json
+        with db.atomic():
+            db.execute_sql(
+                "CREATE TEMPORARY TABLE _polygon_60 AS SELECT * FROM polygon"
+            )
+            db.execute_sql("DROP TABLE polygon")
+            db.execute_sql(
+                'CREATE TABLE "polygon" ("shape_id" TEXT NOT NULL PRIMARY KEY, "vertices" BLOB NOT NULL, "line_width" INTEGER NOT NULL, "open_polygon" INTEGER NOT NULL, FOREIGN KEY ("shape_id") REFERENCES "shape" ("uuid") ON DELETE CASCADE)'
+            )
+            data = db.execute_sql(
+                "SELECT shape_id, vertices, line_width, open_polygon FROM _polygon_60"
+            ).fetchall()
+            for shape_id, vertices, line_width, open_polygon in data:
+                try:
+                    points = json.loads(vertices)
+                except (TypeError, ValueError):
+                    logger.warning(f"Polygon {shape_id} has invalid vertices")
+                    points = []
+                db.execute_sql(
+                    "INSERT INTO polygon (shape_id, vertices, line_width, open_polygon) VALUES (?, ?, ?, ?)",
+                    (shape_id, pack_points(points), line_width, open_polygon),
+                )
+            db.execute_sql("DROP TABLE _polygon_60")
     else:
         raise UnknownVersionException(
             f"No upgrade code for save format {version} was found."
@@ -895,10 +960,201 @@ def upgrade(version):
     db.foreign_keys = True
 
 
+def backup_save(backup_path: Path) -> None:
+    """
+    Copies the save file, after moving the content of its write-ahead log into it.
+
+    Committed changes can still be in the WAL file, copying only the save file would leave them out of the backup.
+    """
+    busy, _, _ = db.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    if busy:
+        raise RuntimeError("The save file is in use by another process")
+    shutil.copyfile(SAVE_FILE, backup_path)
+    if room_databases.get_stored_rooms():
+        shutil.copytree(
+            str(room_databases.folder),
+            str(backup_path.with_name(f"{backup_path.name}.rooms")),
+        )
+
+
+def _get_columns(model) -> str:
+    return ", ".join(f'"{field.column_name}"' for field in model._meta.sorted_fields)
+
+
+def _get_owner_condition(model) -> Optional[str]:
+    """
+    Returns the condition that selects the rows of a room through the room or the (already copied) rows they belong to.
+    """
+    fields = [
+        field
+        for field in model._meta.sorted_fields
+        if isinstance(field, ForeignKeyField) and field.rel_model is not model
+    ]
+    for field in fields:
+        if field.rel_model is Room:
+            return f'"{field.column_name}" = ?'
+    for field in fields:
+        if not field.null and issubclass(field.rel_model, RoomModel):
+            return f'"{field.column_name}" IN (SELECT "{field.rel_field.column_name}" FROM main."{field.rel_model._meta.table_name}")'
+    return None
+
+
+def _get_referrer_condition(model) -> str:
+    """
+    Returns the condition that selects the rows of a room that are only referred to by other room data (e.g. groups).
+    """
+    conditions = [
+        f'"{field.rel_field.column_name}" IN (SELECT "{field.column_name}" FROM main."{referrer._meta.table_name}")'
+        for referrer in ROOM_MODELS
+        for field in referrer._meta.sorted_fields
+        if isinstance(field, ForeignKeyField) and field.rel_model is model
+    ]
+    return " OR ".join(conditions)
+
+
+def _set_location_foreign_key(enabled: bool) -> None:
+    """
+    Rebuilds player_room with or without the foreign key to the active location.
+
+    When rooms are stored in their own database, the locations are not in the save file
+    and sqlite can not enforce a foreign key across database files.
+    """
+    current = any(
+        row[2] == "location"
+        for row in db.execute_sql('PRAGMA foreign_key_list("player_room")')
+    )
+    if current == enabled:
+        return
+
+    columns = _get_columns(PlayerRoom)
+    with db.atomic():
+        db.execute_sql("ALTER TABLE player_room RENAME TO _player_room")
+        create_table(
+            PlayerRoom, lambda fk: enabled or not issubclass(fk.rel_model, RoomModel)
+        )
+        db.execute_sql(
+            f"INSERT INTO player_room ({columns}) SELECT {columns} FROM _player_room"
+        )
+        # This also drops the indexes of the old table, which share their names with the new ones
+        db.execute_sql("DROP TABLE _player_room")
+        PlayerRoom._schema.create_indexes()
+
+
+def split_rooms() -> None:
+    """
+    Moves the data of every room from the save file into the room's own database.
+
+    Rows that were already copied are skipped, so an interrupted split continues where it stopped.
+    """
+    owned: List[Tuple[Any, str]] = []
+    referred: List[Tuple[Any, str]] = []
+    for model in sort_models(ROOM_MODELS):
+        condition = _get_owner_condition(model)
+        if condition is None:
+            referred.append((model, _get_referrer_condition(model)))
+        else:
+            owned.append((model, condition))
+
+    room_ids = [room.id for room in Room.select(Room.id)]
+    if db.execute_sql("SELECT 1 FROM location LIMIT 1").fetchone() is not None:
+        logger.warning(
+            f"Moving the data of {len(room_ids)} rooms to {room_databases.folder}"
+        )
+    for room_id in room_ids:
+        with use_room(room_id):
+            db.foreign_keys = False
+            try:
+                with db.atomic():
+                    for model, condition in [*owned, *referred]:
+                        columns = _get_columns(model)
+                        table = model._meta.table_name
+                        db.execute_sql(
+                            f'INSERT OR IGNORE INTO main."{table}" ({columns}) SELECT {columns} FROM "{GLOBAL_SCHEMA}"."{table}" WHERE {condition}',
+                            [room_id] * condition.count("?"),
+                        )
+            finally:
+                db.foreign_keys = True
+
+    db.foreign_keys = False
+    try:
+        _set_location_foreign_key(False)
+        with db.atomic():
+            for model in ROOM_MODELS:
+                db.execute_sql(f'DELETE FROM "{model._meta.table_name}"')
+    finally:
+        db.foreign_keys = True
+
+    # Databases of rooms that were removed while the server was not running
+    room_databases.remove_unused(room_ids)
+
+
+def merge_rooms() -> None:
+    """
+    Moves the data of the room databases back into the save file.
+
+    The tables are copied as they are, so this also works for rooms with an older save format.
+    """
+    room_ids = room_databases.get_stored_rooms()
+    if room_ids:
+        logger.warning(
+            f"Moving the data of {len(room_ids)} rooms from {room_databases.folder} into the save file"
+        )
+    existing = {room.id for room in Room.select(Room.id)}
+    db.foreign_keys = False
+    try:
+        for room_id in room_ids:
+            if room_id in existing:
+                _merge_room(room_id)
+            room_databases.remove(room_id)
+    finally:
+        db.foreign_keys = True
+
+
+def set_room_storage() -> None:
+    """
+    Moves the room data to the storage selected by the `room_storage` option of the server config.
+    """
+    if room_databases.enabled:
+        split_rooms()
+    else:
+        merge_rooms()
+        db.foreign_keys = False
+        try:
+            _set_location_foreign_key(True)
+        finally:
+            db.foreign_keys = True
+
+
+def _merge_room(room_id: int) -> None:
+    db.execute_sql(
+        "ATTACH DATABASE ? AS room", (str(room_databases.get_path(room_id)),)
+    )
+    try:
+        with db.atomic():
+            tables = [
+                row[0]
+                for row in db.execute_sql(
+                    "SELECT name FROM room.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+                )
+            ]
+            for table in tables:
+                columns = ", ".join(
+                    f'"{row[1]}"'
+                    for row in db.execute_sql(f'PRAGMA room.table_info("{table}")')
+                )
+                db.execute_sql(
+                    f'INSERT OR IGNORE INTO main."{table}" ({columns}) SELECT {columns} FROM room."{table}"'
+                )
+    finally:
+        db.execute_sql("DETACH DATABASE room")
+
+
 def check_save():
     if not os.path.isfile(SAVE_FILE):
         logger.warning("Provided save file does not exist.  Creating a new one.")
-        db.create_tables(ALL_MODELS)
+        # The room tables are also created when rooms are stored separately, they are used when switching back
+        with use_save_file():
+            db.create_tables(ALL_MODELS)
         Constants.create(
             save_version=SAVE_VERSION,
             secret_token=secrets.token_bytes(32),
@@ -928,9 +1184,16 @@ def check_save():
                 save_backups.resolve() / f"{Path(SAVE_FILE).name}.{save_version}"
             )
             logger.warning(f"Backing up old save as {backup_path}")
-            shutil.copyfile(SAVE_FILE, backup_path)
+            try:
+                backup_save(backup_path)
+            except Exception as e:
+                logger.exception(e)
+                logger.error("ERROR: Could not back up the save, not upgrading")
+                sys.exit(2)
             logger.warning(f"Starting upgrade to {save_version + 1}")
             try:
+                # The upgrades only change the save file
+                merge_rooms()
                 upgrade(save_version)
             except Exception as e:
                 logger.exception(e)
@@ -942,3 +1205,7 @@ def check_save():
         else:
             if updated:
                 logger.warning("Upgrade process completed successfully.")
+
+    # Workers are started after the supervisor checked the save
+    if not cluster.is_worker():
+        set_room_storage()
@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
-from typing import Dict, Generator, Generic, Tuple, TypeVar
+from typing import Any, Dict, Generator, Generic, Optional, Set, Tuple, TypeVar
+
+from peewee import Model
 
 from models import User
 
@@ -7,16 +9,36 @@ from models import User
 T = TypeVar("T")
 
 
+def _get_key(value: Any) -> Any:
+    return value.get_id() if isinstance(value, Model) else value
+
+
 class State(ABC, Generic[T]):
+    # Foreign key fields of the stored values that are indexed for get_sids lookups
+    indexed_fields: Tuple[str, ...] = ()
+
     def __init__(self) -> None:
         self._sid_map: Dict[str, T] = {}
+        self._indexes: Dict[str, Dict[Any, Set[str]]] = {
+            field: {} for field in self.indexed_fields
+        }
+        self._sid_keys: Dict[str, Dict[str, Any]] = {}
 
     async def add_sid(self, sid: str, value: T) -> None:
         self._sid_map[sid] = value
+        self._index_sid(sid)
 
     async def remove_sid(self, sid: str) -> None:
+        self._unindex_sid(sid)
         del self._sid_map[sid]
 
+    def reindex_sid(self, sid: str) -> None:
+        """
+        Updates the lookup indexes after one of the indexed fields of a stored value changed.
+        """
+        self._unindex_sid(sid)
+        self._index_sid(sid)
+
     def has_sid(self, sid: str) -> bool:
         return sid in self._sid_map
 
@@ -28,8 +50,17 @@ class State(ABC, Generic[T]):
         pass
 
     def get_sids(self, skip_sid=None, **options) -> Generator[str, None, None]:
-        for sid, value in dict(self._sid_map).items():
-            if skip_sid == sid:
+        candidates: Optional[Set[str]] = None
+        for option, value in list(options.items()):
+            if option in self._indexes:
+                matches = self._indexes[option].get(_get_key(value), set())
+                candidates = (
+                    set(matches) if candidates is None else candidates & matches
+                )
+                del options[option]
+
+        for sid in list(self._sid_map if candidates is None else candidates):
+            if skip_sid == sid or sid not in self._sid_map:
                 continue
 
             if all(
@@ -41,3 +72,17 @@ class State(ABC, Generic[T]):
     def get_users(self, **options) -> Generator[Tuple[str, User], None, None]:
         for sid in self.get_sids(**options):
             yield sid, self.get_user(sid)
+
+    def _index_sid(self, sid: str) -> None:
+        value = self._sid_map[sid]
+        keys = {field: getattr(value, f"{field}_id") for field in self._indexes}
+        for field, key in keys.items():
+            self._indexes[field].setdefault(key, set()).add(sid)
+        self._sid_keys[sid] = keys
+
+    def _unindex_sid(self, sid: str) -> None:
+        for field, key in self._sid_keys.pop(sid, {}).items():
+            sids = self._indexes[field][key]
+            sids.discard(sid)
+            if not sids:
+                del self._indexes[field][key]
@@ -1,14 +1,17 @@
-from typing import Any, Dict
+from typing import Dict, TYPE_CHECKING
 
 from . import State
 from app import app
 from models import User
 
+if TYPE_CHECKING:
+    from api.socket.asset_manager.upload import PendingUpload
+
 
 class AssetState(State[User]):
     def __init__(self) -> None:
         super().__init__()
-        self.pending_file_upload_cache: Dict[str, Any] = {}
+        self.pending_file_upload_cache: Dict[str, "PendingUpload"] = {}
 
     def get_user(self, sid: str) -> User:
         return self._sid_map[sid]
@@ -1,22 +1,163 @@
-from typing import Dict, Set
+from typing import Dict, Generator, Optional, Set, Tuple, Union
 
 from . import State
+import cluster
 from api.socket.constants import GAME_NS
 from app import app, sio
-from models import PlayerRoom, User
+from models import Location, PlayerRoom, Room, User
+from models.db import run_db
+from models.role import Role
+from models.shape.access import permission_index
+from models.shape.cache import shape_payloads
+from models.shape.spatial import spatial_index
+from state.room import room_state
+
+
+def get_campaign_room(room: Room) -> str:
+    """
+    Name of the socket.io room with all clients connected to a campaign, regardless of their location.
+    """
+    return f"room:{room.id}"
+
+
+def get_campaign_user_room(room: Room, user: User) -> str:
+    """
+    Name of the socket.io room with all clients of the given user connected to a campaign.
+    """
+    return f"room:{room.id}:user:{user.id}"
+
+
+def get_role_room(location: Location, role: Role) -> str:
+    """
+    Name of the socket.io room with all clients of the given role on a location.
+    """
+    return f"location:{location.id}:role:{int(role)}"
+
+
+def get_user_room(location: Location, user: Union[User, int]) -> str:
+    """
+    Name of the socket.io room with all clients of the given user (or user id) on a location.
+    """
+    user_id = user if isinstance(user, int) else user.id
+    return f"location:{location.id}:user:{user_id}"
+
+
+# player id, role, active location id
+ClientPresence = Tuple[int, int, int]
 
 
 class GameState(State[PlayerRoom]):
+    indexed_fields = ("player", "room", "active_location")
+
     def __init__(self) -> None:
         super().__init__()
         self.client_temporaries: Dict[str, Set[str]] = {}
+        # worker id -> sid -> presence, for the clients connected to the other workers
+        self.remote_clients: Dict[int, Dict[str, ClientPresence]] = {}
 
     def get_user(self, sid: str) -> User:
         return self._sid_map[sid].player
 
     async def remove_sid(self, sid: str) -> None:
+        room_id = self._sid_map[sid].room_id
         await self.clear_temporaries(sid)
         await super().remove_sid(sid)
+        cluster.publish("game.presence", cluster.WORKER_ID, sid, None)
+        if next(self.get_sids(room=room_id), None) is None:
+            await run_db(room_state.drop, room_id)
+
+    def _index_sid(self, sid: str) -> None:
+        super()._index_sid(sid)
+        location_id = self._sid_keys[sid]["active_location"]
+        shape_payloads.activate(location_id)
+        permission_index.activate(location_id)
+        spatial_index.activate(location_id)
+        self.announce(sid)
+
+    def announce(self, sid: str) -> None:
+        """
+        Shares the presence of a client with the other workers.
+        """
+        pr = self._sid_map[sid]
+        presence = (pr.player_id, int(pr.role), pr.active_location_id)
+        cluster.publish("game.presence", cluster.WORKER_ID, sid, presence)
+
+    def _unindex_sid(self, sid: str) -> None:
+        location_id = self._sid_keys.get(sid, {}).get("active_location")
+        super()._unindex_sid(sid)
+        if (
+            location_id is not None
+            and location_id not in self._indexes["active_location"]
+        ):
+            # The last client on this process left the location
+            shape_payloads.evict(location_id)
+            permission_index.evict(location_id)
+            spatial_index.evict(location_id)
+
+    def enter_location(self, sid: str, location: Location) -> None:
+        """
+        Adds a client to the socket.io rooms of a location.
+        """
+        pr = self._sid_map[sid]
+        sio.enter_room(sid, location.get_path(), namespace=GAME_NS)
+        sio.enter_room(sid, get_role_room(location, pr.role), namespace=GAME_NS)
+        sio.enter_room(sid, get_user_room(location, pr.player), namespace=GAME_NS)
+
+    def leave_location(self, sid: str, location: Location) -> None:
+        """
+        Removes a client from the socket.io rooms of a location.
+        """
+        pr = self._sid_map[sid]
+        sio.leave_room(sid, location.get_path(), namespace=GAME_NS)
+        sio.leave_room(sid, get_role_room(location, pr.role), namespace=GAME_NS)
+        sio.leave_room(sid, get_user_room(location, pr.player), namespace=GAME_NS)
+
+    def get_audiences(
+        self, location: Location, skip_sid: Optional[str] = None
+    ) -> Generator[Tuple[str, PlayerRoom], None, None]:
+        """
+        Yields the socket.io room of every group of clients on a location that gets the same view,
+        together with a PlayerRoom representative for that group.
+
+        All DMs share a view, so they are combined in a single role room.
+        Every other user gets their own room with all of their clients on the location.
+
+        When running with multiple workers, the clients of the location are spread over the workers,
+        so the clients that the other workers announced are included as well.
+        """
+        audiences: Dict[str, PlayerRoom] = {}
+        for sid in self.get_sids(active_location=location, skip_sid=skip_sid):
+            pr = self._sid_map[sid]
+            if pr.role == Role.DM:
+                room = get_role_room(location, Role.DM)
+            else:
+                room = get_user_room(location, pr.player_id)
+            audiences.setdefault(room, pr)
+
+        # Rooms of the remote clients that no local client represents -> player id
+        remote: Dict[str, int] = {}
+        for clients in self.remote_clients.values():
+            for sid, (player_id, role, location_id) in clients.items():
+                if location_id != location.id or sid == skip_sid:
+                    continue
+                if role == Role.DM:
+                    room = get_role_room(location, Role.DM)
+                else:
+                    room = get_user_room(location, player_id)
+                if room not in audiences:
+                    remote.setdefault(room, player_id)
+        if remote:
+            players = {
+                pr.player_id: pr
+                for pr in PlayerRoom.select().where(
+                    (PlayerRoom.room == location.room_id)
+                    & (PlayerRoom.player << list(remote.values()))
+                )
+            }
+            for room, player_id in remote.items():
+                if player_id in players:
+                    audiences[room] = players[player_id]
+        yield from audiences.items()
 
     async def clear_temporaries(self, sid: str) -> None:
         if sid in self.client_temporaries:
@@ -38,3 +179,49 @@ class GameState(State[PlayerRoom]):
 
 game_state = GameState()
 app["state"]["game"] = game_state
+
+
+@cluster.on("game.presence")
+def _update_presence(
+    worker_id: int, sid: str, presence: Optional[ClientPresence]
+) -> None:
+    clients = game_state.remote_clients.setdefault(worker_id, {})
+    if presence is None:
+        clients.pop(sid, None)
+    else:
+        clients[sid] = presence
+
+
+@cluster.on("game.presence.reset")
+def _reset_presence(worker_id: int) -> None:
+    # The worker (re)started, so its previous clients are gone and it does not know ours yet
+    game_state.remote_clients.pop(worker_id, None)
+    for sid in list(game_state._sid_map):
+        game_state.announce(sid)
+
+
+def start_presence() -> None:
+    """
+    Lets the other workers know that this worker (re)started.
+    """
+    cluster.publish("game.presence.reset", cluster.WORKER_ID)
+
+
+@cluster.on("game.disconnect")
+async def _disconnect(room_id: int, player_id: Optional[int]) -> None:
+    options = {"room": room_id}
+    if player_id is not None:
+        options["player"] = player_id
+    for sid in game_state.get_sids(**options):
+        if player_id is None and game_state.get(sid).role == Role.DM:
+            continue
+        await sio.disconnect(sid, namespace=GAME_NS)
+
+
+async def disconnect_players(room: Room, player: Optional[User] = None) -> None:
+    """
+    Disconnects all clients of a player in a campaign, or of all players that are not a DM if no player is given.
+    """
+    await cluster.dispatch(
+        "game.disconnect", room.id, None if player is None else player.id
+    )
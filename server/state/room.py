@@ -0,0 +1,273 @@
+"""
+In-memory state for active rooms with write-behind persistence.
+
+When enabled in the server config, the shapes, layers and initiative data that socket handlers use
+are kept in memory for as long as a room has connected players.
+Changes are applied to these cached instances and written to the database in batched transactions
+at most `durability_window` seconds later, at shutdown or when the last player of a room leaves.
+
+The writes (`flush`, `drop` and `forget`) are blocking database calls and should be run on the database thread
+(see models.db.run_db). Pending changes are copied under a lock before they are written,
+so instances can keep being changed while a previous batch is being written.
+
+When disabled, every call falls through to the database directly,
+so handlers can use this module unconditionally.
+The in-memory state is not shared between workers, so it is always disabled when running with multiple workers.
+"""
+
+import asyncio
+from threading import Lock
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Type, TypeVar, Union
+
+from peewee import Model, Value
+
+import cluster
+from config import config
+from models import Room
+from models.db import db, run_db, use_room
+from models.shape.access import permission_index
+from models.shape.cache import shape_payloads
+from models.shape.journal import record_instance
+from models.shape.spatial import spatial_index
+from utils import logger
+
+M = TypeVar("M", bound=Model)
+
+InstanceKey = Tuple[Type[Model], Any]
+LookupKey = Tuple[Type[Model], Tuple[Tuple[str, Any], ...]]
+# An instance with the database values of its changed fields
+Write = Tuple[Model, Dict[str, Any]]
+
+
+def _get_room_id(room: Union[Room, int]) -> int:
+    return room.id if isinstance(room, Room) else room
+
+
+def _get_lookup_value(value: Any) -> Any:
+    return value.get_id() if isinstance(value, Model) else value
+
+
+def _take_write(instance: Model) -> Write:
+    """
+    Copies the changed fields of an instance and marks it as clean.
+    """
+    # Swap the set instead of clearing it afterwards,
+    # so that a field assigned while the values are copied stays dirty for the next flush
+    fields: Set[str]
+    fields, instance._dirty = instance._dirty, set()
+    return (
+        instance,
+        {
+            name: instance._meta.fields[name].db_value(instance.__data__.get(name))
+            for name in fields
+        },
+    )
+
+
+class RoomCache:
+    def __init__(self) -> None:
+        self.instances: Dict[InstanceKey, Model] = {}
+        self.lookups: Dict[LookupKey, Model] = {}
+        self.dirty: Dict[InstanceKey, Model] = {}
+
+    def take_writes(self, keys: Optional[Iterable[InstanceKey]] = None) -> List[Write]:
+        """
+        Takes the pending changes of all, or the given, dirty instances.
+        """
+        writes = []
+        for key in list(self.dirty if keys is None else keys):
+            instance = self.dirty.pop(key, None)
+            if instance is not None and instance.is_dirty():
+                writes.append(_take_write(instance))
+        return writes
+
+
+class RoomStateEngine:
+    def __init__(self) -> None:
+        self.enabled = config.getboolean(
+            "Persistence", "in_memory_state", fallback=False
+        )
+        if self.enabled and cluster.is_worker():
+            logger.warning(
+                "The in-memory room state is not supported with multiple workers and has been disabled"
+            )
+            self.enabled = False
+        self.durability_window = config.getfloat(
+            "Persistence", "durability_window", fallback=1.0
+        )
+        self._rooms: Dict[int, RoomCache] = {}
+        # The handlers and the database thread both use the room caches
+        self._lock = Lock()
+
+    def get_or_none(
+        self, room: Union[Room, int], model: Type[M], **query: Any
+    ) -> Optional[M]:
+        """
+        Returns the instance matching the query, reusing the in-memory instance if the room already loaded it.
+        """
+        room_id = _get_room_id(room)
+        if not self.enabled:
+            with use_room(room_id):
+                return model.get_or_none(**query)
+
+        key: LookupKey = (
+            model,
+            tuple(sorted((k, _get_lookup_value(v)) for k, v in query.items())),
+        )
+        with self._lock:
+            cache = self._rooms.setdefault(room_id, RoomCache())
+            if key in cache.lookups:
+                return cache.lookups[key]  # type: ignore
+
+        with use_room(room_id):
+            instance = model.get_or_none(**query)
+        if instance is not None:
+            with self._lock:
+                cache = self._rooms.setdefault(room_id, RoomCache())
+                instance = cache.instances.setdefault(
+                    (model, instance.get_id()), instance
+                )
+                cache.lookups[key] = instance
+        return instance
+
+    def get(self, room: Union[Room, int], model: Type[M], **query: Any) -> M:
+        instance = self.get_or_none(room, model, **query)
+        if instance is None:
+            raise model.DoesNotExist
+        return instance
+
+    def save(self, room: Union[Room, int], instance: Model) -> None:
+        """
+        Persists the changes made to an instance.
+
+        With the in-memory state enabled, the instance is only marked as dirty and written on the next flush.
+        """
+        room_id = _get_room_id(room)
+        if not self.enabled:
+            with use_room(room_id):
+                instance.save()
+            return
+
+        # The instance is only written later, so the model signals won't fire
+        with use_room(room_id):
+            shape_payloads.invalidate_instance(instance)
+            record_instance(instance)
+            permission_index.update_instance(instance)
+            spatial_index.update_instance(instance)
+
+        key = (type(instance), instance.get_id())
+        with self._lock:
+            cache = self._rooms.setdefault(room_id, RoomCache())
+            cache.instances.setdefault(key, instance)
+            cache.dirty[key] = instance
+
+    def forget(self, room: Union[Room, int], pks: Iterable[Any]) -> None:
+        """
+        Writes pending changes of the instances with the given primary keys and removes them from memory.
+
+        This should be used before rows are modified or deleted through other means than this engine (e.g. bulk queries),
+        so that the database is up to date and no stale copies stay around.
+        Shapes and their subtypes share their primary key, so forgetting a shape uuid releases both.
+        """
+        room_id = _get_room_id(room)
+        pks = set(pks)
+        with self._lock:
+            cache = self._rooms.get(room_id)
+            if cache is None:
+                return
+            keys = [key for key in cache.instances if key[1] in pks]
+            writes = cache.take_writes(keys)
+            for key in keys:
+                del cache.instances[key]
+            for lookup, instance in list(cache.lookups.items()):
+                if instance.get_id() in pks:
+                    del cache.lookups[lookup]
+
+        try:
+            self._write(room_id, writes)
+        except Exception:
+            self._restore(room_id, writes)
+            raise
+
+    def flush(self, room: Union[Room, int, None] = None) -> None:
+        """
+        Writes all pending changes, optionally limited to a single room, to the database.
+
+        Every room is written in its own transaction, as rooms can be stored in separate databases.
+        """
+        with self._lock:
+            if room is None:
+                room_ids = list(self._rooms)
+            else:
+                room_ids = [_get_room_id(room)]
+            pending = [
+                (room_id, self._rooms[room_id].take_writes())
+                for room_id in room_ids
+                if room_id in self._rooms
+            ]
+
+        error: Optional[Exception] = None
+        for room_id, writes in pending:
+            try:
+                self._write(room_id, writes)
+            except Exception as e:
+                # Keep the changes for the next attempt and still write the other rooms
+                self._restore(room_id, writes)
+                error = e
+        if error is not None:
+            raise error
+
+    def drop(self, room: Union[Room, int]) -> None:
+        """
+        Writes the pending changes of a room and releases its in-memory state.
+        """
+        room_id = _get_room_id(room)
+        self.flush(room_id)
+        with self._lock:
+            cache = self._rooms.get(room_id)
+            # Changes made in the meantime are written by the next flush
+            if cache is not None and not cache.dirty:
+                del self._rooms[room_id]
+
+    def _write(self, room_id: int, writes: List[Write]) -> None:
+        if not writes:
+            return
+
+        with use_room(room_id), db.atomic():
+            for instance, values in writes:
+                model = type(instance)
+                # The values are already converted, so skip the field conversions
+                model.update(
+                    {
+                        model._meta.fields[name]: Value(
+                            value, converter=False, unpack=False
+                        )
+                        for name, value in values.items()
+                    }
+                ).where(model._meta.primary_key == instance.get_id()).execute()
+
+    def _restore(self, room_id: int, writes: List[Write]) -> None:
+        """
+        Marks the instances of writes that were rolled back as dirty again, to retry them on the next flush.
+        """
+        with self._lock:
+            cache = self._rooms.setdefault(room_id, RoomCache())
+            for instance, values in writes:
+                instance._dirty.update(values)
+                key = (type(instance), instance.get_id())
+                cache.instances.setdefault(key, instance)
+                cache.dirty.setdefault(key, instance)
+
+    async def persist(self) -> None:
+        """
+        Periodically writes all pending changes to the database.
+        """
+        while True:
+            await asyncio.sleep(self.durability_window)
+            try:
+                await run_db(self.flush)
+            except Exception:
+                logger.exception("Could not persist the in-memory room state")
+
+
+room_state = RoomStateEngine()
@@ -0,0 +1,26 @@
+"""
+Tests of the server, run them from the server folder with `python -m unittest`.
+
+The tests use a temporary save file, which is set up here before any module that queries the save is imported.
+"""
+
+import atexit
+import secrets
+import shutil
+import tempfile
+from pathlib import Path
+
+from models import ALL_MODELS, Constants
+from models.db import db
+from save import SAVE_VERSION
+
+_save_dir = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, _save_dir, True)
+
+db.init(str(Path(_save_dir) / "planar.sqlite"))
+db.create_tables(ALL_MODELS)
+Constants.create(
+    save_version=SAVE_VERSION,
+    secret_token=secrets.token_bytes(32),
+    api_token=secrets.token_hex(32),
+)
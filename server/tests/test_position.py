@@ -0,0 +1,80 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from api.socket.shape import position
+from models import (
+    Asset,
+    Layer,
+    Location,
+    LocationOptions,
+    PlayerRoom,
+    Room,
+    Shape,
+    User,
+    UserOptions,
+)
+from models.role import Role
+
+
+async def _emit(*args, **kwargs):
+    pass
+
+
+class PositionBroadcasterTest(unittest.TestCase):
+    def setUp(self):
+        user = User.create(
+            name="dm", password_hash="", default_options=UserOptions.create()
+        )
+        room = Room.create(
+            name="room",
+            creator=user,
+            default_options=LocationOptions.create(),
+            logo=Asset.get_root_folder(user),
+        )
+        location = Location.create(room=room, name="start", index=1)
+        location.create_floor()
+        self.pr = PlayerRoom.create(
+            player=user, room=room, role=Role.DM, active_location=location, notes=""
+        )
+        layer = Layer.get(name="tokens")
+        self.shape = Shape.create(
+            uuid="shape", layer=layer, type_="rect", x=0, y=0, index=0
+        )
+        self.broadcaster = position.PositionBroadcaster()
+
+    def tearDown(self):
+        User.delete().execute()
+
+    def run_async(self, coro):
+        return asyncio.get_event_loop().run_until_complete(coro)
+
+    def test_failed_save_is_retried(self):
+        save = self.broadcaster._save
+        calls = []
+
+        def save_once(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise OSError("disk I/O error")
+            save(*args)
+
+        update = {"uuid": "shape", "position": {"angle": 0, "points": [[10, 20]]}}
+
+        async def move():
+            self.broadcaster.add("sid", self.pr, [update], False)
+            await self.broadcaster.flush("sid")
+            self.assertEqual(Shape.get_by_id("shape").x, 0)
+            # The positions are queued again and saved by the next flush
+            await asyncio.sleep(0.01)
+
+        with mock.patch.object(self.broadcaster, "_save", save_once):
+            with mock.patch.object(position, "RETRY_DELAY", 0):
+                with mock.patch.object(position.sio, "emit", _emit):
+                    with mock.patch.object(position.logger, "exception"):
+                        self.run_async(move())
+
+        self.assertEqual(len(calls), 2)
+        shape = Shape.get_by_id("shape")
+        self.assertEqual((shape.x, shape.y), (10, 20))
+        self.assertEqual(self.broadcaster._pending, {})
@@ -0,0 +1,116 @@
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import save
+from models import (
+    Asset,
+    Label,
+    Location,
+    LocationOptions,
+    PlayerRoom,
+    Room,
+    Shape,
+    ShapeLabel,
+    User,
+    UserOptions,
+)
+from models.db import db, room_databases, use_room
+from models.role import Role
+
+
+class PerRoomStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = Path(tempfile.mkdtemp())
+        patches = [
+            mock.patch.object(room_databases, "enabled", True),
+            mock.patch.object(room_databases, "folder", self.folder),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        save.set_room_storage()
+
+        self.user = User.create(
+            name="dm", password_hash="", default_options=UserOptions.create()
+        )
+        self.label = Label.create(
+            uuid="label", user=self.user, name="label", visible=False
+        )
+        self.rooms = [self.create_room(name) for name in ("first", "second")]
+
+    def tearDown(self):
+        room_databases.enabled = False
+        save.set_room_storage()
+        User.delete().execute()
+        shutil.rmtree(self.folder, True)
+
+    def create_room(self, name):
+        room = Room.create(
+            name=name,
+            creator=self.user,
+            default_options=LocationOptions.create(),
+            logo=Asset.get_root_folder(self.user),
+        )
+        with use_room(room.id), db.atomic():
+            location = Location.create(room=room, name="start", index=1)
+            layer = location.create_floor().layers[0]
+            PlayerRoom.create(
+                player=self.user,
+                room=room,
+                role=Role.DM,
+                active_location=location,
+                notes="",
+            )
+            shape = Shape.create(
+                uuid=name, layer=layer, type_="rect", x=0, y=0, index=0
+            )
+            ShapeLabel.create(shape=shape, label=self.label)
+        return room
+
+    def test_rooms_are_stored_separately(self):
+        self.assertEqual(
+            room_databases.get_stored_rooms(), [room.id for room in self.rooms]
+        )
+        self.assertEqual(db.execute_sql("SELECT COUNT(*) FROM shape").fetchone()[0], 0)
+        for room in self.rooms:
+            with use_room(room.id):
+                self.assertEqual([shape.uuid for shape in Shape.select()], [room.name])
+                # Global tables can still be joined
+                location = PlayerRoom.get(room=room).active_location
+                self.assertEqual(location.room.name, room.name)
+
+    def test_ids_do_not_collide(self):
+        ids = set()
+        for room in self.rooms:
+            with use_room(room.id):
+                ids.add(Location.get().id)
+        self.assertEqual(len(ids), 2)
+
+    def test_recursive_delete_reaches_every_room(self):
+        self.label.delete_instance(True)
+        for room in self.rooms:
+            with use_room(room.id):
+                self.assertEqual(ShapeLabel.select().count(), 0)
+
+    def test_room_delete_removes_its_database(self):
+        room = self.rooms[0]
+        with use_room(room.id):
+            room.delete_instance(True)
+        self.assertEqual(room_databases.get_stored_rooms(), [self.rooms[1].id])
+
+    def test_merge_and_split(self):
+        room_databases.close_all()
+        room_databases.enabled = False
+        save.set_room_storage()
+        self.assertEqual(room_databases.get_stored_rooms(), [])
+        self.assertEqual(
+            sorted(shape.uuid for shape in Shape.select()), ["first", "second"]
+        )
+
+        room_databases.enabled = True
+        save.set_room_storage()
+        with use_room(self.rooms[1].id):
+            self.assertEqual([shape.uuid for shape in Shape.select()], ["second"])